@@ -3,25 +3,47 @@
 Forex News Subscription Bot — الإصدار النهائي الكامل
 """
 import asyncio
+import cProfile
+import functools
+import hashlib
+import heapq
+import html
 import json
 import logging
 import os
+import pstats
+import re
+import shutil
 import sqlite3
+import tempfile
+import threading
 import time
+import uuid
+import zipfile
+import zlib
+from collections import Counter, OrderedDict, defaultdict, deque
 from contextlib import closing
-from types import SimpleNamespace
-from typing import Optional, Dict, Tuple
+from contextvars import ContextVar
+from datetime import datetime, timedelta
+from email.utils import parsedate_to_datetime
+from enum import IntEnum
+from logging.handlers import RotatingFileHandler
+from typing import Any, Optional, Dict, Tuple
+from xml.etree import ElementTree
+import aiohttp
 import pandas as pd
-from aiogram import Bot, Dispatcher, Router, F
-from aiogram.enums import ParseMode
+from aiogram import BaseMiddleware, Bot, Dispatcher, Router, F
+from aiogram.enums import ChatMemberStatus, ParseMode
+from aiogram.exceptions import TelegramRetryAfter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.filters import CommandStart, ChatMemberUpdatedFilter, IS_NOT_MEMBER, IS_MEMBER
 from aiogram.types import (
-    Message, CallbackQuery, ChatMemberUpdated,
-    InlineKeyboardMarkup, InlineKeyboardButton, FSInputFile
+    Message, CallbackQuery, ChatMemberUpdated, PreCheckoutQuery,
+    InlineKeyboardMarkup, InlineKeyboardButton, FSInputFile, LabeledPrice
 )
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
 
 # --- 🔽 قراءة ملف .env ---
 from dotenv import load_dotenv 
@@ -43,6 +65,7 @@ PRIVATE_CHANNEL_ID = os.getenv("PRIVATE_CHANNEL_ID")
 
 LINKS_FILE = "links.json"
 WALLETS_FILE = "wallets.json"
+NEWS_FEEDS_FILE = os.getenv("NEWS_FEEDS_FILE", "news_feeds.json")
 BUTTONS_FILE = "buttons.json"
 DB_FILE = os.getenv("DB_FILE", "subscriptions.db")
 TEXTS_AR_FILE = "texts_ar.json"
@@ -50,9 +73,147 @@ TEXTS_EN_FILE = "texts_en.json"
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s | %(levelname)s | %(message)s")
 
-# تخزين آخر وقت أرسل فيه المستخدم طلب دعم
-last_support_request = {}
-SUPPORT_COOLDOWN = 180  # 3 دقائق
+# ---------------------- التتبع وقياس الأداء ----------------------
+SLOW_UPDATE_MS = float(os.getenv("SLOW_UPDATE_MS", "500"))
+SLOW_LOG_FILE = os.getenv("SLOW_LOG_FILE", "slow_updates.jsonl")
+PROFILE_DIR = "profiles"
+
+slow_log = logging.getLogger("slow_updates")
+slow_log.propagate = False
+_slow_handler = RotatingFileHandler(SLOW_LOG_FILE, maxBytes=5 * 1024 * 1024, backupCount=3, encoding="utf-8", delay=True)
+_slow_handler.setFormatter(logging.Formatter("%(message)s"))
+slow_log.addHandler(_slow_handler)
+
+class Trace:
+    __slots__ = ("trace_id", "update_type", "user_id", "started", "spans")
+
+    def __init__(self, update_type: str, user_id: Optional[int]):
+        self.trace_id = uuid.uuid4().hex[:12]
+        self.update_type = update_type
+        self.user_id = user_id
+        self.started = time.perf_counter()
+        self.spans: list = []
+
+    def add_span(self, kind: str, name: str, started: float):
+        self.spans.append((kind, name, round((time.perf_counter() - started) * 1000, 2)))
+
+current_trace: ContextVar[Optional[Trace]] = ContextVar("current_trace", default=None)
+
+def traced(kind: str):
+    """يسجل زمن تنفيذ الدالة كـ span في تتبع التحديث الحالي (إن وجد)."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            trace = current_trace.get()
+            if trace is None:
+                return func(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                trace.add_span(kind, func.__name__, started)
+        return wrapper
+    return decorator
+
+class TracingMiddleware(BaseMiddleware):
+    """يعطي كل تحديث معرف تتبع، ويكتب التحديثات الأبطأ من SLOW_UPDATE_MS في سجل JSON."""
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        trace = Trace(getattr(event, "event_type", type(event).__name__), user.id if user else None)
+        token = current_trace.set(trace)
+        error = None
+        try:
+            return await handler(event, data)
+        except Exception as e:
+            error = repr(e)
+            raise
+        finally:
+            current_trace.reset(token)
+            total_ms = (time.perf_counter() - trace.started) * 1000
+            if total_ms >= SLOW_UPDATE_MS:
+                slow_log.info(json.dumps({
+                    "ts": int(time.time()),
+                    "trace_id": trace.trace_id,
+                    "update_id": getattr(event, "update_id", None),
+                    "type": trace.update_type,
+                    "user_id": trace.user_id,
+                    "total_ms": round(total_ms, 2),
+                    "spans": [{"kind": k, "name": n, "ms": ms} for k, n, ms in trace.spans],
+                    "error": error,
+                }, ensure_ascii=False))
+
+class TracingRequestMiddleware(BaseRequestMiddleware):
+    """يقيس زمن كل استدعاء لـ Bot API ضمن تتبع التحديث الحالي."""
+
+    async def __call__(self, make_request, bot, method):
+        trace = current_trace.get()
+        if trace is None:
+            return await make_request(bot, method)
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        finally:
+            trace.add_span("api", type(method).__name__, started)
+
+# ---------------------- تسجيل التحديثات لإعادة التشغيل (Replay) ----------------------
+CAPTURE_UPDATES = os.getenv("CAPTURE_UPDATES", "0") == "1"
+CAPTURE_FILE = os.getenv("CAPTURE_FILE", "captured_updates.jsonl")
+# ملح ثابت يجعل المعرفات المجهّلة متسقة بين عدة ملفات تسجيل؛ بدونه يتغير مع كل تشغيل
+CAPTURE_SALT = os.getenv("CAPTURE_SALT") or uuid.uuid4().hex
+# الأدمن يُسجل دائماً بهذا المعرف حتى تعمل صلاحياته عند إعادة التشغيل
+CAPTURE_ADMIN_ID = 1
+CAPTURE_ID_KEYS = {"id", "user_id", "chat_id", "sender_chat_id"}
+CAPTURE_FILE_KEYS = {"file_id", "file_unique_id"}
+CAPTURE_NAME_KEYS = {"first_name", "last_name", "username", "title", "phone_number", "invite_link", "bio"}
+_CAPTURE_NUMBER_RE = re.compile(r"\d{5,}")
+
+capture_log = logging.getLogger("captured_updates")
+capture_log.propagate = False
+_capture_handler = RotatingFileHandler(CAPTURE_FILE, maxBytes=20 * 1024 * 1024, backupCount=5, encoding="utf-8", delay=True)
+_capture_handler.setFormatter(logging.Formatter("%(message)s"))
+capture_log.addHandler(_capture_handler)
+
+def _capture_digest(value) -> bytes:
+    return hashlib.sha256(f"{CAPTURE_SALT}:{value}".encode()).digest()
+
+def anonymize_id(value: int) -> int:
+    if value == ADMIN_ID:
+        return CAPTURE_ADMIN_ID
+    # نحافظ على الإشارة لأن معرفات القنوات والمجموعات سالبة
+    anon = int.from_bytes(_capture_digest(abs(value))[:5], "big") + 1000
+    return -anon if value < 0 else anon
+
+def anonymize_update(value, key: str = None):
+    """
+    يجهّل تحديثاً بصيغة JSON: المعرفات والأرقام الطويلة في النصوص تُستبدل بقيم مشتقة ثابتة،
+    والأسماء تُستبدل برموز، وfile_id يتحول إلى رمز لا يمكن تنزيله.
+    """
+    if isinstance(value, dict):
+        return {k: anonymize_update(v, k) for k, v in value.items()}
+    if isinstance(value, list):
+        return [anonymize_update(v, key) for v in value]
+    if key in CAPTURE_ID_KEYS and isinstance(value, int) and not isinstance(value, bool):
+        return anonymize_id(value)
+    if key in CAPTURE_FILE_KEYS and isinstance(value, str):
+        return f"file_{_capture_digest(value)[:8].hex()}"
+    if key in CAPTURE_NAME_KEYS and isinstance(value, str):
+        return f"{key}_{_capture_digest(value)[:4].hex()}"
+    if key in ("text", "data", "caption") and isinstance(value, str):
+        return _CAPTURE_NUMBER_RE.sub(lambda m: str(anonymize_id(int(m.group()))), value)
+    return value
+
+class UpdateCaptureMiddleware(BaseMiddleware):
+    """يسجل كل تحديث وارد (مجهّلاً) في ملف JSONL دوّار لإعادة تشغيله لاحقاً بـ replay.py."""
+
+    async def __call__(self, handler, event, data):
+        try:
+            payload = anonymize_update(event.model_dump(mode="json", exclude_none=True, by_alias=True))
+            capture_log.info(json.dumps({"ts": round(time.time(), 3), "update": payload}, ensure_ascii=False))
+        except Exception as e:
+            logging.warning("فشل تسجيل التحديث: %s", e)
+        return await handler(event, data)
+
 
 # ---------------------- تحميل الأزرار ----------------------
 def load_buttons():
@@ -72,7 +233,22 @@ def btn(key: str, lang: str = "ar") -> str:
     else:
         return BTN_EN.get(key, BTN_AR.get(key, key))
 
+def parse_prices(value: str) -> Dict[int, int]:
+    """'1:150,3:300' -> {1: 150, 3: 300}"""
+    prices = {}
+    for part in value.split(","):
+        months, price = part.split(":")
+        prices[int(months)] = int(price)
+    return prices
+
+# مصدر واحد لأسعار الخطط: أزرار المدة تحتوي %price% ويُملأ من هنا، والتحقق من الدفع يستخدم نفس القيم
+PLAN_PRICES_USD = parse_prices(os.getenv("PLAN_PRICES_USD", "1:150,3:300,6:500"))
+
+def duration_button(months: int, lang: str = "ar") -> str:
+    return btn(f"duration_{months}", lang).replace("%price%", str(PLAN_PRICES_USD.get(months, "")))
+
 # ---------------------- تحميل النصوص ----------------------
+@traced("file")
 def load_texts(lang: str) -> Dict[str, str]:
     file_path = TEXTS_AR_FILE if lang == "ar" else TEXTS_EN_FILE
     try:
@@ -92,6 +268,7 @@ def get_text(key: str, lang: str = "ar", **kwargs) -> str:
     return text
 
 # ---------------------- تحميل الروابط والمحافظ ----------------------
+@traced("file")
 def load_links():
     try:
         with open(LINKS_FILE, "r", encoding="utf-8") as f:
@@ -100,6 +277,7 @@ def load_links():
         logging.error("❌ Failed to load links: %s", e)
         return []
 
+@traced("file")
 def save_links(links):
     try:
         with open(LINKS_FILE, "w", encoding="utf-8") as f:
@@ -116,6 +294,18 @@ def get_channel_link() -> Optional[str]:
             return channel["link"]
     return PRIVATE_CHANNEL_LINK.strip()
 
+def release_channel_link(link: Optional[str]):
+    """يعيد رابطاً محجوزاً إلى المتاح عندما تُلغى المعاملة التي حجزته."""
+    if not link:
+        return
+    links = load_links()
+    for channel in links:
+        if channel.get("link", "").strip() == link and channel.get("used", False):
+            channel["used"] = False
+            save_links(links)
+            return
+
+@traced("file")
 def load_wallets():
     try:
         with open(WALLETS_FILE, "r", encoding="utf-8") as f:
@@ -125,6 +315,7 @@ def load_wallets():
         logging.error("❌ Failed to load wallets: %s", e)
         return {"USDT TRC20": "غير متوفر"}
 
+@traced("file")
 def save_wallets(wallets):
     try:
         with open(WALLETS_FILE, "w", encoding="utf-8") as f:
@@ -133,74 +324,669 @@ def save_wallets(wallets):
         logging.error("❌ Failed to save wallets: %s", e)
 
 # ---------------------- قاعدة البيانات ----------------------
+SUB_STATES = ("new", "pending", "active", "ended", "rejected")
+SUB_LANGUAGES = ("ar", "en")
+_STATES_SQL = ", ".join(f"'{s}'" for s in SUB_STATES)
+_LANGUAGES_SQL = ", ".join(f"'{l}'" for l in SUB_LANGUAGES)
+
+# كل ترحيل: (رقم الإصدار، الوصف، أوامر SQL). تُنفذ بالترتيب مرة واحدة فقط
+# داخل معاملة، ويُسجل رقمها في جدول schema_version.
+MIGRATIONS = [
+    (1, "base subscriptions table", [
+        """
+        CREATE TABLE IF NOT EXISTS subscriptions (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            method TEXT,
+            duration_months INTEGER,
+            start_ts INTEGER,
+            end_ts INTEGER,
+            state TEXT,
+            receipt_file_id TEXT,
+            language TEXT
+        )
+        """,
+    ]),
+    (2, "typed columns and CHECK constraints", [
+        f"""
+        CREATE TABLE subscriptions_new (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            method TEXT,
+            duration_months INTEGER CHECK (duration_months IS NULL OR duration_months > 0),
+            start_ts INTEGER,
+            end_ts INTEGER,
+            state TEXT NOT NULL DEFAULT 'new'
+                CHECK (state IN ({_STATES_SQL})),
+            receipt_file_id TEXT,
+            language TEXT NOT NULL DEFAULT 'ar'
+                CHECK (language IN ({_LANGUAGES_SQL}))
+        )
+        """,
+        f"""
+        INSERT INTO subscriptions_new
+        SELECT user_id, username, method,
+               CASE WHEN duration_months > 0 THEN duration_months END,
+               start_ts, end_ts,
+               CASE WHEN state IN ({_STATES_SQL}) THEN state ELSE 'new' END,
+               receipt_file_id,
+               CASE WHEN language IN ({_LANGUAGES_SQL}) THEN language ELSE 'ar' END
+        FROM subscriptions
+        """,
+        "DROP TABLE subscriptions",
+        "ALTER TABLE subscriptions_new RENAME TO subscriptions",
+    ]),
+    (3, "indexes on state, end_ts and username", [
+        "CREATE INDEX IF NOT EXISTS idx_subscriptions_state ON subscriptions(state)",
+        "CREATE INDEX IF NOT EXISTS idx_subscriptions_end_ts ON subscriptions(end_ts)",
+        "CREATE INDEX IF NOT EXISTS idx_subscriptions_username ON subscriptions(username)",
+    ]),
+    (4, "scheduled jobs", [
+        """
+        CREATE TABLE IF NOT EXISTS scheduled_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            target TEXT,
+            payload TEXT,
+            run_at INTEGER NOT NULL,
+            cron TEXT,
+            enabled INTEGER NOT NULL DEFAULT 1,
+            last_run_ts INTEGER,
+            created_ts INTEGER
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_scheduled_jobs_enabled ON scheduled_jobs(enabled, run_at)",
+    ]),
+    (5, "on-chain payment checkouts", [
+        """
+        CREATE TABLE IF NOT EXISTS payment_checkouts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            method TEXT NOT NULL,
+            network TEXT NOT NULL CHECK (network IN ('TRC20', 'ERC20')),
+            token TEXT NOT NULL,
+            address TEXT NOT NULL,
+            duration_months INTEGER NOT NULL,
+            amount_units INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'open' CHECK (status IN ('open', 'paid', 'expired')),
+            tx_hash TEXT UNIQUE,
+            created_ts INTEGER NOT NULL,
+            expires_ts INTEGER NOT NULL,
+            paid_ts INTEGER
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_payment_checkouts_status ON payment_checkouts(status, network, address)",
+        # لا يمكن أن يتشارك طلبان مفتوحان نفس المبلغ على نفس العنوان
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_payment_checkouts_open_amount ON payment_checkouts(address, token, amount_units) WHERE status = 'open'",
+    ]),
+    (6, "telegram stars payments", [
+        """
+        CREATE TABLE IF NOT EXISTS star_payments (
+            charge_id TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            duration_months INTEGER NOT NULL,
+            amount INTEGER NOT NULL,
+            invite_link TEXT,
+            created_ts INTEGER NOT NULL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_star_payments_user ON star_payments(user_id)",
+    ]),
+    (7, "news ingestion index", [
+        """
+        CREATE TABLE IF NOT EXISTS news_items (
+            hash TEXT PRIMARY KEY,
+            feed TEXT NOT NULL,
+            tier TEXT NOT NULL CHECK (tier IN ('free', 'premium')),
+            title TEXT,
+            body TEXT,
+            published_ts INTEGER,
+            seen_ts INTEGER NOT NULL,
+            posted_ts INTEGER,
+            chat TEXT
+        ) WITHOUT ROWID
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_news_items_seen ON news_items(seen_ts)",
+        "CREATE INDEX IF NOT EXISTS idx_news_items_unposted ON news_items(seen_ts) WHERE posted_ts IS NULL",
+        """
+        CREATE TABLE IF NOT EXISTS news_feed_state (
+            url TEXT PRIMARY KEY,
+            etag TEXT,
+            last_modified TEXT,
+            last_fetch_ts INTEGER
+        )
+        """,
+    ]),
+    (8, "per-subscriber pair alerts", [
+        """
+        CREATE TABLE IF NOT EXISTS alert_pairs (
+            user_id INTEGER NOT NULL,
+            pair TEXT NOT NULL,
+            PRIMARY KEY (user_id, pair)
+        ) WITHOUT ROWID
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_alert_pairs_pair ON alert_pairs(pair)",
+        """
+        CREATE TABLE IF NOT EXISTS alert_settings (
+            user_id INTEGER PRIMARY KEY,
+            min_impact TEXT NOT NULL DEFAULT 'low' CHECK (min_impact IN ('low', 'medium', 'high'))
+        )
+        """,
+    ]),
+    (9, "hot/cold archive", [
+        "ALTER TABLE subscriptions ADD COLUMN updated_ts INTEGER",
+        "UPDATE subscriptions SET updated_ts = COALESCE(end_ts, start_ts, CAST(strftime('%s', 'now') AS INTEGER))",
+        "CREATE INDEX IF NOT EXISTS idx_subscriptions_cold ON subscriptions(state, updated_ts)",
+        f"""
+        CREATE TABLE IF NOT EXISTS subscriptions_archive (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            method TEXT,
+            duration_months INTEGER,
+            start_ts INTEGER,
+            end_ts INTEGER,
+            state TEXT NOT NULL CHECK (state IN ({_STATES_SQL})),
+            receipt_file_id TEXT,
+            language TEXT NOT NULL DEFAULT 'ar',
+            updated_ts INTEGER,
+            archived_ts INTEGER NOT NULL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_subscriptions_archive_username ON subscriptions_archive(username)",
+    ]),
+    (10, "payment transfer cursors", [
+        """
+        CREATE TABLE IF NOT EXISTS payment_cursors (
+            network TEXT NOT NULL,
+            address TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            position_ts INTEGER NOT NULL,
+            PRIMARY KEY (network, address)
+        )
+        """,
+    ]),
+    (11, "renewal requests of active members", [
+        """
+        CREATE TABLE IF NOT EXISTS renewal_requests (
+            user_id INTEGER PRIMARY KEY,
+            method TEXT NOT NULL,
+            duration_months INTEGER NOT NULL CHECK (duration_months > 0),
+            receipt_file_id TEXT,
+            created_ts INTEGER NOT NULL
+        )
+        """,
+    ]),
+]
+
+def get_schema_version(conn: sqlite3.Connection) -> int:
+    conn.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER PRIMARY KEY, description TEXT, applied_ts INTEGER)")
+    row = conn.execute("SELECT MAX(version) FROM schema_version").fetchone()
+    return row[0] or 0
+
+def run_migrations(db_file: str = None):
+    # isolation_level=None: نتحكم بالمعاملات يدويًا حتى يكون كل ترحيل ذريًا
+    with closing(sqlite3.connect(db_file or DB_FILE, isolation_level=None)) as conn:
+        current = get_schema_version(conn)
+        for version, description, statements in MIGRATIONS:
+            if version <= current:
+                continue
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                for sql in statements:
+                    conn.execute(sql)
+                conn.execute(
+                    "INSERT INTO schema_version (version, description, applied_ts) VALUES (?, ?, ?)",
+                    (version, description, int(time.time())),
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                logging.exception("❌ Migration %s (%s) failed", version, description)
+                raise
+            logging.info("🗄 Applied migration %s: %s", version, description)
+
+# المشتركون النشطون في الذاكرة: فحص O(1) عند كل انضمام للقناة
+active_user_ids: set = set()
+
+def load_active_user_ids():
+    with closing(sqlite3.connect(DB_FILE)) as conn:
+        rows = conn.execute("SELECT user_id FROM subscriptions WHERE state = 'active'").fetchall()
+    active_user_ids.clear()
+    active_user_ids.update(row[0] for row in rows)
+
 def init_db():
+    run_migrations()
+    load_active_user_ids()
+    alert_index.load()
+
+# رقم إصدار البيانات: يزداد مع كل كتابة على جدول الاشتراكات،
+# وتستخدمه لوحة التحكم لمعرفة ما إذا كانت النتائج المحفوظة ما زالت صالحة.
+# يُستدعى أيضاً من خيوط asyncio.to_thread، فالزيادة محمية بقفل
+_data_version = 0
+_data_version_lock = threading.Lock()
+
+def bump_data_version():
+    global _data_version
+    with _data_version_lock:
+        _data_version += 1
+
+def data_version() -> int:
+    return _data_version
+
+SUBSCRIPTION_COLUMNS = ["user_id", "username", "method", "duration_months", "start_ts", "end_ts", "state", "receipt_file_id", "language"]
+SUBSCRIPTION_SELECT = f"SELECT {', '.join(SUBSCRIPTION_COLUMNS)} FROM subscriptions"
+ARCHIVE_COLUMNS_SQL = ", ".join(SUBSCRIPTION_COLUMNS + ["updated_ts"])
+DAY_SECONDS = 24 * 3600
+
+class SubState(IntEnum):
+    NEW = 0
+    PENDING = 1
+    ACTIVE = 2
+    ENDED = 3
+    REJECTED = 4
+
+    @property
+    def db_value(self) -> str:
+        return self.name.lower()
+
+    @classmethod
+    def parse(cls, value) -> "SubState":
+        if isinstance(value, cls):
+            return value
+        return cls.__members__.get(str(value).upper(), cls.NEW)
+
+class Lang(IntEnum):
+    AR = 0
+    EN = 1
+
+    @property
+    def code(self) -> str:
+        return self.name.lower()
+
+    @classmethod
+    def parse(cls, value) -> "Lang":
+        if isinstance(value, cls):
+            return value
+        return cls.__members__.get(str(value).upper(), cls.AR)
+
+class Subscription:
+    """
+    صف اشتراك مضغوط (__slots__) بحالة ولغة مرمزتين كأعداد صحيحة.
+    الحقول المشتقة (التواريخ المنسقة والأيام المتبقية) تُحسب مرة وتُخزن حتى يتغير الوقت المرتبط بها.
+    """
+
+    __slots__ = (
+        "user_id", "username", "method", "duration_months", "_start_ts", "_end_ts",
+        "state", "receipt_file_id", "language", "_start_date", "_end_date", "_days_left",
+    )
+
+    def __init__(self, user_id: int, username: str = None, method: str = None, duration_months: int = None,
+                 start_ts: int = None, end_ts: int = None, state=SubState.NEW, receipt_file_id: str = None,
+                 language=Lang.AR):
+        self.user_id = user_id
+        self.username = username
+        self.method = method
+        self.duration_months = duration_months
+        self.start_ts = start_ts
+        self.end_ts = end_ts
+        self.state = SubState.parse(state)
+        self.receipt_file_id = receipt_file_id
+        self.language = Lang.parse(language)
+
+    @property
+    def start_ts(self) -> Optional[int]:
+        return self._start_ts
+
+    @start_ts.setter
+    def start_ts(self, value: Optional[int]):
+        self._start_ts = value
+        self._start_date = None
+
+    @property
+    def end_ts(self) -> Optional[int]:
+        return self._end_ts
+
+    @end_ts.setter
+    def end_ts(self, value: Optional[int]):
+        self._end_ts = value
+        self._end_date = None
+        self._days_left = None
+
+    @property
+    def lang(self) -> str:
+        return self.language.code
+
+    @property
+    def is_active(self) -> bool:
+        return self.state is SubState.ACTIVE
+
+    @property
+    def start_date(self) -> Optional[str]:
+        if self._start_date is None and self._start_ts:
+            self._start_date = time.strftime('%Y-%m-%d', time.localtime(self._start_ts))
+        return self._start_date
+
+    @property
+    def end_date(self) -> Optional[str]:
+        if self._end_date is None and self._end_ts:
+            self._end_date = time.strftime('%Y-%m-%d', time.localtime(self._end_ts))
+        return self._end_date
+
+    @property
+    def days_left(self) -> int:
+        if not self._end_ts:
+            return 0
+        # يُعاد الحساب مرة في الدقيقة على الأكثر
+        minute = int(time.time()) // 60
+        if self._days_left is None or self._days_left[0] != minute:
+            self._days_left = (minute, max(0, (self._end_ts - int(time.time())) // DAY_SECONDS))
+        return self._days_left[1]
+
+    def to_params(self) -> tuple:
+        return (
+            self.user_id,
+            self.username,
+            self.method,
+            self.duration_months,
+            self._start_ts,
+            self._end_ts,
+            self.state.db_value,
+            self.receipt_file_id,
+            self.language.code,
+        )
+
+    def __repr__(self) -> str:
+        return f"Subscription(user_id={self.user_id}, state={self.state.name}, end_ts={self._end_ts})"
+
+def subscription_factory(cursor: sqlite3.Cursor, row: tuple) -> Subscription:
+    """row_factory لاستعلامات SUBSCRIPTION_SELECT: يبني Subscription مباشرة بدون dict وسيط."""
+    return Subscription(*row)
+
+UPSERT_SUBSCRIPTION_SQL = """
+    INSERT INTO subscriptions (user_id, username, method, duration_months, start_ts, end_ts, state, receipt_file_id, language, updated_ts)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, CAST(strftime('%s', 'now') AS INTEGER))
+    ON CONFLICT(user_id) DO UPDATE SET
+      username=excluded.username,
+      method=excluded.method,
+      duration_months=excluded.duration_months,
+      start_ts=excluded.start_ts,
+      end_ts=excluded.end_ts,
+      state=excluded.state,
+      receipt_file_id=excluded.receipt_file_id,
+      language=excluded.language,
+      updated_ts=excluded.updated_ts
+"""
+
+def on_subscription_written(sub: Subscription):
+    if sub.is_active:
+        active_user_ids.add(sub.user_id)
+    else:
+        active_user_ids.discard(sub.user_id)
+    bump_data_version()
+
+@traced("db")
+def upsert_subscription(sub: Subscription):
     with closing(sqlite3.connect(DB_FILE)) as conn:
         cur = conn.cursor()
-        cur.execute(
-            """
-            CREATE TABLE IF NOT EXISTS subscriptions (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                method TEXT,
-                duration_months INTEGER,
-                start_ts INTEGER,
-                end_ts INTEGER,
-                state TEXT,
-                receipt_file_id TEXT,
-                language TEXT
-            )
-            """
-        )
+        cur.execute(UPSERT_SUBSCRIPTION_SQL, sub.to_params())
         conn.commit()
+    on_subscription_written(sub)
+
+COMPARE_AND_SET_SQL = f"""
+UPDATE subscriptions SET {', '.join(f'{c} = ?' for c in SUBSCRIPTION_COLUMNS[1:])},
+    updated_ts = CAST(strftime('%s', 'now') AS INTEGER)
+WHERE user_id = ? AND state = ? AND end_ts IS ?
+"""
 
-def upsert_subscription(sub: SimpleNamespace):
+@traced("db")
+def compare_and_set_subscription(sub: Subscription, expected_state: SubState, expected_end_ts: Optional[int]) -> bool:
+    """كتابة شرطية: تنجح فقط إذا لم تتغير الحالة وتاريخ الانتهاء منذ قراءة الصف."""
+    params = sub.to_params()[1:] + (sub.user_id, expected_state.db_value, expected_end_ts)
     with closing(sqlite3.connect(DB_FILE)) as conn:
-        cur = conn.cursor()
-        cur.execute(
-            """
-            INSERT INTO subscriptions (user_id, username, method, duration_months, start_ts, end_ts, state, receipt_file_id, language)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ON CONFLICT(user_id) DO UPDATE SET
-              username=excluded.username,
-              method=excluded.method,
-              duration_months=excluded.duration_months,
-              start_ts=excluded.start_ts,
-              end_ts=excluded.end_ts,
-              state=excluded.state,
-              receipt_file_id=excluded.receipt_file_id,
-              language=excluded.language
-            """,
-            (
-                sub.user_id,
-                sub.username,
-                sub.method,
-                sub.duration_months,
-                sub.start_ts,
-                sub.end_ts,
-                sub.state,
-                sub.receipt_file_id,
-                getattr(sub, "language", "ar"),
-            ),
-        )
+        cur = conn.execute(COMPARE_AND_SET_SQL, params)
         conn.commit()
+        if cur.rowcount != 1:
+            return False
+    on_subscription_written(sub)
+    return True
+
+@traced("db")
+def get_subscription(user_id: int) -> Optional[Subscription]:
+    pending = write_queue.peek(user_id)
+    if pending is not None:
+        return pending
+    with closing(sqlite3.connect(DB_FILE)) as conn:
+        conn.row_factory = subscription_factory
+        sub = conn.execute(f"{SUBSCRIPTION_SELECT} WHERE user_id=?", (user_id,)).fetchone()
+        if sub is None and rehydrate_subscription(conn, user_id):
+            conn.commit()
+            sub = conn.execute(f"{SUBSCRIPTION_SELECT} WHERE user_id=?", (user_id,)).fetchone()
+        return sub
+
+def rehydrate_subscription(conn: sqlite3.Connection, user_id: int) -> bool:
+    """يعيد مستخدماً مؤرشفاً إلى الجدول الحي عند عودته. الالتزام (commit) على المستدعي."""
+    # قراءة فقط في الحالة الشائعة (مستخدم جديد ليس في الأرشيف)، والكتابة عند وجود صف فعلاً
+    if conn.execute("SELECT 1 FROM subscriptions_archive WHERE user_id = ?", (user_id,)).fetchone() is None:
+        return False
+    cur = conn.execute(
+        f"INSERT OR IGNORE INTO subscriptions ({ARCHIVE_COLUMNS_SQL}) "
+        f"SELECT {ARCHIVE_COLUMNS_SQL} FROM subscriptions_archive WHERE user_id = ?",
+        (user_id,),
+    )
+    if cur.rowcount != 1:
+        return False
+    conn.execute("DELETE FROM subscriptions_archive WHERE user_id = ?", (user_id,))
+    bump_data_version()
+    logging.info("🗄 Rehydrated user %s from archive", user_id)
+    return True
+
+@traced("db")
+def find_archived_user_id(username: str) -> Optional[int]:
+    with closing(sqlite3.connect(DB_FILE)) as conn:
+        row = conn.execute("SELECT user_id FROM subscriptions_archive WHERE username = ? LIMIT 1", (username,)).fetchone()
+    return row[0] if row else None
 
-def get_subscription(user_id: int) -> Optional[dict]:
+@traced("db")
+def list_subscriptions(where: str = "", params: Tuple = ()) -> list:
     with closing(sqlite3.connect(DB_FILE)) as conn:
-        cur = conn.cursor()
-        cur.execute(
-            "SELECT user_id, username, method, duration_months, start_ts, end_ts, state, receipt_file_id, language FROM subscriptions WHERE user_id=?",
-            (user_id,),
-        )
-        row = cur.fetchone()
-        if not row:
-            return None
-        keys = ["user_id", "username", "method", "duration_months", "start_ts", "end_ts", "state", "receipt_file_id", "language"]
-        return dict(zip(keys, row))
+        conn.row_factory = subscription_factory
+        return conn.execute(f"{SUBSCRIPTION_SELECT} {where}", params).fetchall()
 
+def user_lang(user_id: int) -> str:
+    sub = get_subscription(user_id)
+    return sub.lang if sub else "ar"
+
+def apply_subscription_period(sub: Subscription, months: int, now: int = None) -> bool:
+    """يعيد True إذا كان تجديداً لاشتراك ما زال سارياً (المستخدم عضو في القناة بالفعل)."""
+    now = now or int(time.time())
+    add_seconds = months * 30 * DAY_SECONDS
+    renewal = bool(sub.is_active and sub.end_ts and sub.end_ts > now)
+    if renewal:
+        # تجديد قبل الانتهاء: تُضاف المدة إلى نهاية الاشتراك الحالي
+        sub.end_ts += add_seconds
+    else:
+        sub.start_ts = now
+        sub.end_ts = now + add_seconds
+    sub.state = SubState.ACTIVE
+    return renewal
+
+def activate_in_transaction(conn: sqlite3.Connection, user_id: int, months: int, method: str,
+                            now: int, username: Optional[str] = None) -> Tuple[Subscription, bool]:
+    """
+    يفعّل أو يجدد الاشتراك داخل معاملة مفتوحة على conn (BEGIN IMMEDIATE على المستدعي).
+    يُنشئ الصف إذا لم يكن موجوداً، ويعيد (الاشتراك، هل كان تجديداً لاشتراك سارٍ).
+    """
+    row = conn.execute(f"{SUBSCRIPTION_SELECT} WHERE user_id = ?", (user_id,)).fetchone()
+    if row is None and rehydrate_subscription(conn, user_id):
+        row = conn.execute(f"{SUBSCRIPTION_SELECT} WHERE user_id = ?", (user_id,)).fetchone()
+    sub = Subscription(*row) if row else Subscription(user_id, username=username)
+    sub.username = username or sub.username
+    sub.method = method
+    sub.duration_months = months
+    renewal = apply_subscription_period(sub, months, now)
+    conn.execute(UPSERT_SUBSCRIPTION_SQL, sub.to_params())
+    return sub, renewal
+
+@traced("db")
 def list_df(query: str = "SELECT * FROM subscriptions", params: Tuple = ()) -> pd.DataFrame:
     with closing(sqlite3.connect(DB_FILE)) as conn:
         return pd.read_sql_query(query, conn, params=params)
 
+# ---------------------- طابور الكتابة المؤجلة (Group Commit) ----------------------
+WRITE_FLUSH_INTERVAL = float(os.getenv("WRITE_FLUSH_INTERVAL_MS", "5")) / 1000
+WRITE_MAX_BATCH = int(os.getenv("WRITE_MAX_BATCH", "200"))
+WRITE_RETRY_MIN_DELAY = 0.1
+WRITE_RETRY_MAX_DELAY = 30.0
+
+class WriteBehindQueue:
+    """
+    يجمع كتابات الاشتراكات في دفعات: الكتابات المتتالية لنفس المستخدم تُدمج (آخر كتابة تفوز)،
+    وتُكتب كل دفعة بـ executemany داخل معاملة واحدة كل بضع ميلي ثوانٍ أو عند بلوغ WRITE_MAX_BATCH.
+    """
+
+    def __init__(self, flush_interval: float = WRITE_FLUSH_INTERVAL, max_batch: int = WRITE_MAX_BATCH):
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self._pending: Dict[int, tuple] = {}
+        self._inflight: Dict[int, tuple] = {}
+        self._waiters: Dict[int, list] = {}
+        self._wakeup: Optional[asyncio.Event] = None
+        self._flush_lock: Optional[asyncio.Lock] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task = asyncio.create_task(self._run())
+
+    def peek(self, user_id: int) -> Optional[Subscription]:
+        """قراءة الكتابة المعلقة لمستخدم حتى ترى القراءات آخر حالة قبل وصولها للقرص."""
+        params = self._pending.get(user_id) or self._inflight.get(user_id)
+        return Subscription(*params) if params else None
+
+    def pending_user_ids(self) -> set:
+        return set(self._pending) | set(self._inflight)
+
+    def submit(self, sub: Subscription, durable: bool = False) -> Optional[asyncio.Future]:
+        self._pending[sub.user_id] = sub.to_params()
+        future = None
+        if durable:
+            future = asyncio.get_running_loop().create_future()
+            self._waiters.setdefault(sub.user_id, []).append(future)
+        self._wakeup.set()
+        return future
+
+    async def _run(self):
+        delay = self.flush_interval
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            if len(self._pending) < self.max_batch:
+                await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+                delay = self.flush_interval
+            except Exception:
+                # الدفعة أُعيدت إلى الطابور: نعيد المحاولة بتأخير متزايد بدل إيقاف الحلقة
+                delay = min(max(delay * 2, WRITE_RETRY_MIN_DELAY), WRITE_RETRY_MAX_DELAY)
+                logging.warning("Write queue retrying %d rows in %.1fs", len(self._pending), delay)
+                await asyncio.sleep(delay)
+                self._wakeup.set()
+
+    async def flush(self):
+        if self._flush_lock is None:
+            return
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            # الدفعة تبقى مرئية للقراءات (peek) حتى تنتهي كتابتها
+            self._inflight, self._pending = self._pending, {}
+            waiters, self._waiters = self._waiters, {}
+            try:
+                failed = await asyncio.to_thread(self._write_batch, list(self._inflight.values()))
+            except Exception as e:
+                logging.error("❌ Write batch of %d rows failed, requeued: %s", len(self._inflight), e)
+                # كتابة أحدث لنفس المستخدم وصلت أثناء المحاولة تفوز على الصف المعاد
+                for user_id, params in self._inflight.items():
+                    self._pending.setdefault(user_id, params)
+                for futures in waiters.values():
+                    for future in futures:
+                        if not future.done():
+                            future.set_exception(e)
+                raise
+            finally:
+                self._inflight = {}
+            bump_data_version()
+            for user_id, futures in waiters.items():
+                error = failed.get(user_id)
+                for future in futures:
+                    if future.done():
+                        continue
+                    if error is None:
+                        future.set_result(True)
+                    else:
+                        future.set_exception(error)
+
+    @staticmethod
+    @traced("db")
+    def _write_batch(rows: list) -> Dict[int, Exception]:
+        with closing(sqlite3.connect(DB_FILE)) as conn:
+            try:
+                conn.executemany(UPSERT_SUBSCRIPTION_SQL, rows)
+                conn.commit()
+                return {}
+            except sqlite3.Error as e:
+                conn.rollback()
+                logging.warning("Batch write failed (%s), retrying rows one by one", e)
+            # صف واحد معطوب لا يجب أن يُسقط باقي الدفعة
+            failed = {}
+            for row in rows:
+                try:
+                    conn.execute(UPSERT_SUBSCRIPTION_SQL, row)
+                    conn.commit()
+                except sqlite3.Error as e:
+                    conn.rollback()
+                    logging.error("❌ Failed to write subscription %s: %s", row[0], e)
+                    failed[row[0]] = e
+            return failed
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+write_queue = WriteBehindQueue()
+
+async def save_subscription(sub: Subscription, durable: bool = False):
+    """
+    حفظ الاشتراك عبر طابور الكتابة المؤجلة. durable=True ينتظر حتى تُكتب الدفعة على القرص
+    (للعمليات التي يجب تأكيدها مثل التفعيل). بدون طابور يعمل كتابة مباشرة.
+    """
+    if not write_queue.running:
+        upsert_subscription(sub)
+        return
+    future = write_queue.submit(sub, durable=durable)
+    if sub.is_active:
+        active_user_ids.add(sub.user_id)
+    else:
+        active_user_ids.discard(sub.user_id)
+    if future is not None:
+        await future
+
+async def transition_subscription(sub: Subscription, expected_state: SubState, expected_end_ts: Optional[int]) -> bool:
+    """
+    انتقال حالة ذري لعمليات الأدمن والتفعيل: يُفرغ طابور الكتابة ثم يكتب بشرط أن الصف لم يتغير.
+    استدعاءان متزامنان على نفس الصف ينجح أحدهما فقط، فلا يُستهلك رابط دعوة مرتين.
+    """
+    await write_queue.flush()
+    return await asyncio.to_thread(compare_and_set_subscription, sub, expected_state, expected_end_ts)
+
 # ---------------------- FSM ----------------------
 class Flow(StatesGroup):
     choosing_language = State()
@@ -215,13 +1001,16 @@ class Flow(StatesGroup):
     add_links_waiting = State()
     add_new_wallet_method_name = State()
     add_new_wallet_method_address = State()
+    schedule_time_waiting = State()
+    schedule_message_waiting = State()
 
 # ---------------------- الكيبوردات ----------------------
 def main_keyboard(lang: str = "ar", user_id: int = None) -> InlineKeyboardMarkup:
     kb = [
         [InlineKeyboardButton(text=btn("free_news", lang), callback_data="free_news")],
         [InlineKeyboardButton(text=btn("paid_sub", lang), callback_data="paid_sub")],
-        [InlineKeyboardButton(text=btn("my_account", lang), callback_data="my_account")]
+        [InlineKeyboardButton(text=btn("my_account", lang), callback_data="my_account"),
+         InlineKeyboardButton(text=btn("alerts", lang), callback_data="alerts")]
     ]
     if user_id == ADMIN_ID:
         kb.append([InlineKeyboardButton(text=btn("admin_panel", lang), callback_data="admin_panel")])
@@ -237,7 +1026,9 @@ def admin_keyboard(lang: str = "ar") -> InlineKeyboardMarkup:
         [InlineKeyboardButton(text=btn("admin_links", lang), callback_data="admin_links")],
         [InlineKeyboardButton(text=btn("admin_wallets", lang), callback_data="admin_wallets")],
         [InlineKeyboardButton(text=btn("admin_broadcast", lang), callback_data="admin_broadcast")],
-        [InlineKeyboardButton(text=btn("admin_export", lang), callback_data="admin_export")],
+        [InlineKeyboardButton(text="⏰ المنشورات المجدولة", callback_data="sched_list")],
+        [InlineKeyboardButton(text=btn("admin_export", lang), callback_data="admin_export"),
+         InlineKeyboardButton(text=btn("admin_export_all", lang), callback_data="admin_export_all")],
         [InlineKeyboardButton(text=btn("back", lang), callback_data="go_start")],
     ]
     return InlineKeyboardMarkup(inline_keyboard=kb)
@@ -265,8 +1056,331 @@ def wallets_keyboard(lang: str = "ar") -> InlineKeyboardMarkup:
     kb.append([InlineKeyboardButton(text=btn("back", lang), callback_data="admin_panel")])
     return InlineKeyboardMarkup(inline_keyboard=kb)
 
+# ---------------------- الحد من الإغراق (Throttling) ----------------------
+_MISSING = object()
+
+class TTLCache:
+    """قاموس محدود الحجم: يُحذف الأقدم عند الامتلاء وتنتهي صلاحية العناصر بعد ttl ثانية."""
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 60.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Any, Tuple[float, Any]]" = OrderedDict()
+
+    def _evict(self, now: float):
+        while self._data:
+            key, (expires, _) = next(iter(self._data.items()))
+            if expires > now and len(self._data) <= self.maxsize:
+                break
+            self._data.popitem(last=False)
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            return default
+        if item[0] <= time.monotonic():
+            del self._data[key]
+            return default
+        return item[1]
+
+    def set(self, key, value, ttl: float = None):
+        now = time.monotonic()
+        self._data.pop(key, None)
+        self._data[key] = (now + (ttl if ttl is not None else self.ttl), value)
+        self._evict(now)
+
+    def pop(self, key, default=None):
+        item = self._data.pop(key, None)
+        return default if item is None else item[1]
+
+    def clear(self):
+        self._data.clear()
+
+    def __contains__(self, key) -> bool:
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __len__(self) -> int:
+        self._evict(time.monotonic())
+        return len(self._data)
+
+class SlidingWindowLimiter:
+    """نافذة منزلقة لكل مفتاح: يسمح بـ limit حدث خلال window ثانية."""
+
+    def __init__(self, maxsize: int = 10000):
+        self._hits = TTLCache(maxsize=maxsize)
+
+    def hit(self, key, limit: int, window: float) -> bool:
+        now = time.monotonic()
+        hits = self._hits.get(key)
+        if hits is None:
+            hits = deque()
+        while hits and hits[0] <= now - window:
+            hits.popleft()
+        if len(hits) >= limit:
+            self._hits.set(key, hits, ttl=window)
+            return False
+        hits.append(now)
+        self._hits.set(key, hits, ttl=window)
+        return True
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """
+    يُسقط التحديثات الزائدة قبل وصولها للمعالجات:
+    حد عام لكل مستخدم + حد لكل معالج (حسب اسم الدالة).
+    """
+
+    def __init__(
+        self,
+        user_limit: Tuple[int, float] = (30, 10.0),
+        handler_limit: Tuple[int, float] = (6, 5.0),
+        handler_overrides: Optional[Dict[str, Tuple[int, float]]] = None,
+        exempt_ids: Tuple[int, ...] = (),
+        exempt_handlers: Tuple[str, ...] = (),
+        maxsize: int = 10000,
+    ):
+        self.user_limit = user_limit
+        self.handler_limit = handler_limit
+        self.handler_overrides = handler_overrides or {}
+        self.exempt_ids = set(exempt_ids)
+        self.exempt_handlers = set(exempt_handlers)
+        self._limiter = SlidingWindowLimiter(maxsize=maxsize)
+        self._notified = TTLCache(maxsize=maxsize, ttl=user_limit[1])
+        self.rejections: Counter = Counter()
+        self.enabled = True
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if not self.enabled or user is None or user.id in self.exempt_ids:
+            return await handler(event, data)
+
+        handler_obj = data.get("handler")
+        name = getattr(getattr(handler_obj, "callback", None), "__name__", "unknown")
+        if name in self.exempt_handlers:
+            return await handler(event, data)
+        limit, window = self.handler_overrides.get(name, self.handler_limit)
+
+        if not self._limiter.hit(("user", user.id), *self.user_limit):
+            reason = "user"
+        elif not self._limiter.hit((name, user.id), limit, window):
+            reason = name
+        else:
+            return await handler(event, data)
+
+        self.rejections[reason] += 1
+        # نُبلغ المستخدم مرة واحدة فقط خلال النافذة حتى لا يتحول الإغراق إلى إرسال
+        if isinstance(event, CallbackQuery) and user.id not in self._notified:
+            self._notified.set(user.id, True)
+            try:
+                await event.answer("⏳ طلبات كثيرة، حاول بعد قليل.")
+            except Exception as e:
+                logging.debug("Throttle notice failed: %s", e)
+        return None
+
+CALLBACK_IDEMPOTENCY_TTL = 120.0
+_IN_PROGRESS = object()
+
+class IdempotencyMiddleware(BaseMiddleware):
+    """
+    يمنع تكرار تنفيذ أزرار الأدمن عند الضغط المزدوج: المفتاح (الرسالة، callback data).
+    التكرار أثناء التنفيذ أو بعده بقليل يُجاب فوراً دون أي عمل على قاعدة البيانات أو الـ API.
+    تُحفظ النتيجة فقط إذا أعاد المعالج True (تم الانتقال فعلاً)، وإلا يمكن إعادة المحاولة فوراً.
+    """
+
+    def __init__(self, handlers: Tuple[str, ...], ttl: float = CALLBACK_IDEMPOTENCY_TTL, maxsize: int = 10000):
+        self.handlers = set(handlers)
+        self._seen = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.duplicates = 0
+
+    @staticmethod
+    def callback_key(cq: CallbackQuery) -> tuple:
+        if cq.message:
+            return (cq.message.chat.id, cq.message.message_id, cq.data)
+        return (cq.inline_message_id, cq.data)
+
+    async def __call__(self, handler, event, data):
+        handler_obj = data.get("handler")
+        name = getattr(getattr(handler_obj, "callback", None), "__name__", "unknown")
+        if name not in self.handlers:
+            return await handler(event, data)
+
+        key = self.callback_key(event)
+        previous = self._seen.get(key, _MISSING)
+        if previous is not _MISSING:
+            self.duplicates += 1
+            text = "⏳ جاري التنفيذ..." if previous is _IN_PROGRESS else previous
+            try:
+                await event.answer(text)
+            except Exception as e:
+                logging.debug("Duplicate callback answer failed: %s", e)
+            return None
+
+        self._seen.set(key, _IN_PROGRESS)
+        result = None
+        try:
+            result = await handler(event, data)
+            return result
+        finally:
+            if result is True:
+                self._seen.set(key, "✅ تم تنفيذ هذا الإجراء مسبقاً.")
+            else:
+                # الفشل أو عدم التنفيذ لا يُحفظ حتى يمكن إعادة المحاولة
+                self._seen.pop(key)
+
+class SingleFlight:
+    """
+    يدمج الحسابات المتطابقة: الطلبات المتزامنة لنفس المفتاح تنتظر حسابًا واحدًا،
+    وتُعاد النتيجة المحفوظة ما دام إصدار البيانات لم يتغير.
+    """
+
+    def __init__(self, maxsize: int = 128, ttl: float = 600.0):
+        self._inflight: Dict[Tuple[str, Any], asyncio.Future] = {}
+        self._results = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    async def do(self, key: str, version, func, *args):
+        cached = self._results.get(key)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        flight_key = (key, version)
+        future = self._inflight.get(flight_key)
+        if future is not None:
+            return await asyncio.shield(future)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[flight_key] = future
+        try:
+            # الحساب (pandas/SQLite) يتم في خيط منفصل حتى لا يوقف حلقة الأحداث
+            result = await asyncio.to_thread(func, *args)
+        except Exception as e:
+            future.set_exception(e)
+            # نمنع تحذير "exception was never retrieved" إذا لم ينتظر أحد
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            self._results.set(key, (version, result))
+            return result
+        finally:
+            self._inflight.pop(flight_key, None)
+
+    def invalidate(self, key: str = None):
+        if key is None:
+            self._results.clear()
+        else:
+            self._results.pop(key)
+
+admin_views = SingleFlight()
+# آخر عرض تم رسمه في كل رسالة: (chat_id, message_id) -> (view, version, text)
+rendered_views = TTLCache(maxsize=256, ttl=3600)
+
+def view_is_fresh(message: Message, view: str, version) -> bool:
+    # نقارن النص أيضًا: قد تكون الرسالة عُدلت لاحقًا إلى شاشة أخرى
+    return rendered_views.get((message.chat.id, message.message_id)) == (view, version, message.text)
+
+def mark_view_rendered(edited, view: str, version):
+    if isinstance(edited, Message):
+        rendered_views.set((edited.chat.id, edited.message_id), (view, version, edited.text))
+
+throttler = ThrottlingMiddleware(
+    handler_overrides={
+        "receive_receipt": (3, 60.0),
+        "invalid_receipt": (3, 30.0),
+        "choose_language": (4, 10.0),
+    },
+    exempt_ids=(ADMIN_ID,),
+    # رسائل الدفع المؤكد لا يجوز إسقاطها أبدًا
+    exempt_handlers=("stars_successful_payment",),
+)
+
+idempotency = IdempotencyMiddleware(
+    handlers=("approve_user_handler", "reject_user_handler", "modify_duration", "delete_user_handler", "restore_do"),
+)
+
+# ---------------------- دورة حياة البوت والإيقاف الآمن ----------------------
+DRAIN_TIMEOUT = float(os.getenv("DRAIN_TIMEOUT", "20"))
+
+class Lifecycle:
+    """
+    يتتبع المهام الخلفية والتحديثات قيد المعالجة، وعند الإيقاف:
+    يوقف الاستقبال، يلغي المهام الخلفية، ينتظر المعالجات الجارية حتى مهلة محددة،
+    ثم ينفذ خطافات الإغلاق بالترتيب.
+    """
+
+    def __init__(self, drain_timeout: float = DRAIN_TIMEOUT):
+        self.drain_timeout = drain_timeout
+        self.accepting = True
+        self.background: set = set()
+        self.inflight: set = set()
+        self._shutdown_hooks: list = []
+
+    def spawn(self, coro, name: str = None) -> asyncio.Task:
+        task = asyncio.create_task(coro, name=name)
+        self.background.add(task)
+        task.add_done_callback(self._on_background_done)
+        return task
+
+    def _on_background_done(self, task: asyncio.Task):
+        self.background.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logging.error("Background task %s crashed: %s", task.get_name(), task.exception())
+
+    def track(self, task: asyncio.Task):
+        self.inflight.add(task)
+        task.add_done_callback(self.inflight.discard)
+
+    async def critical(self, coro):
+        """ينفذ عملية لا يجب قطعها في منتصفها (مثل الطرد ثم فك الحظر) حتى لو أُلغي المستدعي."""
+        task = asyncio.create_task(coro)
+        self.track(task)
+        return await asyncio.shield(task)
+
+    def on_shutdown(self, hook):
+        self._shutdown_hooks.append(hook)
+
+    async def shutdown(self):
+        if not self.accepting:
+            return
+        self.accepting = False
+        deadline = time.monotonic() + self.drain_timeout
+        logging.info("🛑 Shutting down: %d background tasks, %d in-flight", len(self.background), len(self.inflight))
+
+        for task in list(self.background):
+            task.cancel()
+        await asyncio.gather(*self.background, return_exceptions=True)
+
+        current = asyncio.current_task()
+        pending = [t for t in self.inflight if t is not current]
+        if pending:
+            _, still_running = await asyncio.wait(pending, timeout=max(0.0, deadline - time.monotonic()))
+            if still_running:
+                logging.warning("⚠️ %d in-flight tasks did not finish before the drain deadline", len(still_running))
+                for task in still_running:
+                    task.cancel()
+                await asyncio.gather(*still_running, return_exceptions=True)
+
+        for hook in self._shutdown_hooks:
+            try:
+                await hook()
+            except Exception as e:
+                logging.exception("Shutdown hook %s failed: %s", getattr(hook, "__name__", hook), e)
+        logging.info("🛑 Shutdown complete")
+
+lifecycle = Lifecycle()
+
+class LifecycleMiddleware(BaseMiddleware):
+    """يسجل كل تحديث كمهمة جارية، ويرفض التحديثات الجديدة بعد بدء الإيقاف."""
+
+    async def __call__(self, handler, event, data):
+        if not lifecycle.accepting:
+            return None
+        lifecycle.track(asyncio.current_task())
+        return await handler(event, data)
+
 # ---------------------- الروتر ----------------------
 router = Router()
+router.message.middleware(throttler)
+router.callback_query.middleware(throttler)
+router.callback_query.middleware(idempotency)
 
 @router.message(CommandStart())
 async def cmd_start(message: Message, state: FSMContext):
@@ -283,30 +1397,69 @@ async def admin_command(message: Message):
     if message.from_user.id != ADMIN_ID:
         await message.answer("🚫 هذا الأمر مخصص للمشرف فقط.")
         return
-    lang = (get_subscription(message.from_user.id) or {}).get("language", "ar")
+    lang = user_lang(message.from_user.id)
     markup = admin_keyboard(lang)
     await message.answer("🔧 *لوحة التحكم*", reply_markup=markup, parse_mode="Markdown")
 
+@router.message(F.text == "/throttle")
+async def throttle_stats_command(message: Message):
+    if message.from_user.id != ADMIN_ID:
+        return
+    if not throttler.rejections:
+        await message.answer("🛡 لا توجد طلبات مرفوضة حتى الآن.")
+        return
+    lines = [f"• {name}: <code>{count}</code>" for name, count in throttler.rejections.most_common(20)]
+    await message.answer("🛡 <b>الطلبات المرفوضة (Throttling):</b>\n\n" + "\n".join(lines))
+
+_profiling = False
+
+async def capture_profile(bot: Bot, chat_id: int, seconds: int):
+    global _profiling
+    _profiling = True
+    profiler = cProfile.Profile()
+    try:
+        # cProfile يلتقط خيط حلقة الأحداث، حيث تعمل كل المعالجات
+        profiler.enable()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            profiler.disable()
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        prof_path = os.path.join(PROFILE_DIR, f"profile-{stamp}.prof")
+        txt_path = os.path.join(PROFILE_DIR, f"profile-{stamp}.txt")
+        profiler.dump_stats(prof_path)
+        with open(txt_path, "w", encoding="utf-8") as f:
+            pstats.Stats(prof_path, stream=f).sort_stats("cumulative").print_stats(60)
+        await bot.send_document(chat_id, FSInputFile(txt_path), caption=f"🧪 نتائج التحليل ({seconds} ثانية)")
+        await bot.send_document(chat_id, FSInputFile(prof_path))
+    except Exception as e:
+        logging.exception("Profiler capture failed: %s", e)
+    finally:
+        _profiling = False
+
+@router.message(F.text.startswith("/profile"))
+async def profile_command(message: Message, bot: Bot):
+    if message.from_user.id != ADMIN_ID:
+        return
+    if _profiling:
+        await message.answer("⏳ يوجد تحليل قيد التشغيل بالفعل.")
+        return
+    parts = message.text.split()
+    seconds = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else 30
+    seconds = max(5, min(seconds, 300))
+    await message.answer(f"🧪 بدأ تحليل الأداء لمدة {seconds} ثانية...")
+    lifecycle.spawn(capture_profile(bot, message.chat.id, seconds), name="profiler")
+
 @router.callback_query(F.data.in_(["lang_ar", "lang_en"]))
 async def choose_language(cq: CallbackQuery, state: FSMContext):
     lang = "ar" if cq.data == "lang_ar" else "en"
-    sub_dict = get_subscription(cq.from_user.id)
-    if not sub_dict:
-        sub = SimpleNamespace(
-            user_id=cq.from_user.id,
-            username=cq.from_user.username,
-            method=None,
-            duration_months=None,
-            start_ts=None,
-            end_ts=None,
-            state="new",
-            receipt_file_id=None,
-            language=lang,
-        )
+    sub = get_subscription(cq.from_user.id)
+    if not sub:
+        sub = Subscription(cq.from_user.id, username=cq.from_user.username, language=lang)
     else:
-        sub = SimpleNamespace(**sub_dict)
-        sub.language = lang
-    upsert_subscription(sub)
+        sub.language = Lang.parse(lang)
+    await save_subscription(sub)
 
     markup = main_keyboard(lang=lang, user_id=cq.from_user.id)
     await cq.message.edit_text(get_text("choose_service", lang), reply_markup=markup)
@@ -315,8 +1468,7 @@ async def choose_language(cq: CallbackQuery, state: FSMContext):
 
 @router.callback_query(F.data == "go_start")
 async def go_start(cq: CallbackQuery, state: FSMContext):
-    sub = get_subscription(cq.from_user.id)
-    lang = (sub or {}).get("language", "ar")
+    lang = user_lang(cq.from_user.id)
     markup = main_keyboard(lang=lang, user_id=cq.from_user.id)
     await cq.message.edit_text(get_text("choose_service", lang), reply_markup=markup)
     await state.set_state(Flow.choosing_subscription)
@@ -324,7 +1476,7 @@ async def go_start(cq: CallbackQuery, state: FSMContext):
 
 @router.callback_query(F.data == "free_news")
 async def free_news(cq: CallbackQuery):
-    lang = (get_subscription(cq.from_user.id) or {}).get("language", "ar")
+    lang = user_lang(cq.from_user.id)
     channel = f"https://t.me/{PUBLIC_CHANNEL_USERNAME}"
     text = f"📰 القناة العامة: {channel}"
     kb = InlineKeyboardMarkup(inline_keyboard=[
@@ -336,11 +1488,11 @@ async def free_news(cq: CallbackQuery):
 
 @router.callback_query(F.data == "paid_sub")
 async def paid_sub(cq: CallbackQuery, state: FSMContext):
-    lang = (get_subscription(cq.from_user.id) or {}).get("language", "ar")
+    lang = user_lang(cq.from_user.id)
     kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text=btn("duration_1", lang), callback_data="duration_1")],
-        [InlineKeyboardButton(text=btn("duration_3", lang), callback_data="duration_3")],
-        [InlineKeyboardButton(text=btn("duration_6", lang), callback_data="duration_6")],
+        [InlineKeyboardButton(text=duration_button(1, lang), callback_data="duration_1")],
+        [InlineKeyboardButton(text=duration_button(3, lang), callback_data="duration_3")],
+        [InlineKeyboardButton(text=duration_button(6, lang), callback_data="duration_6")],
         [InlineKeyboardButton(text=btn("back", lang), callback_data="go_start")],
     ])
     await cq.message.edit_text(get_text("sub_duration", lang), reply_markup=kb)
@@ -350,11 +1502,13 @@ async def paid_sub(cq: CallbackQuery, state: FSMContext):
 @router.callback_query(F.data.startswith("duration_"))
 async def choose_duration(cq: CallbackQuery, state: FSMContext):
     months = int(cq.data.split("_")[1])
-    lang = (get_subscription(cq.from_user.id) or {}).get("language", "ar")
+    lang = user_lang(cq.from_user.id)
     wallets = load_wallets()
     kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text=method, callback_data=f"method_{method}")]
         for method in wallets.keys()
+    ] + [
+        [InlineKeyboardButton(text=btn("method_stars", lang), callback_data=f"stars_{months}")]
     ] + [[InlineKeyboardButton(text=btn("back", lang), callback_data="paid_sub")]])
     await cq.message.edit_text(get_text("payment_method", lang, months=months), reply_markup=kb)
     await state.update_data(duration_months=months)
@@ -364,40 +1518,196 @@ async def choose_duration(cq: CallbackQuery, state: FSMContext):
 @router.callback_query(F.data.startswith("method_"))
 async def choose_payment(cq: CallbackQuery, state: FSMContext):
     method = cq.data.split("_", 1)[1]
-    lang = (get_subscription(cq.from_user.id) or {}).get("language", "ar")
+    lang = user_lang(cq.from_user.id)
     wallets = load_wallets()
     address = wallets.get(method, "غير متوفر")
     await state.update_data(payment_method=method)
-    await cq.message.edit_text(get_text("send_receipt", lang, address=address))
+    data = await state.get_data()
+    checkout = None
+    if AUTO_VERIFY_PAYMENTS and method in wallets:
+        checkout = await asyncio.to_thread(create_checkout, cq.from_user.id, method, address, data.get("duration_months"))
+    if checkout:
+        text = get_text(
+            "send_exact_amount", lang,
+            amount=format_amount(checkout["amount_units"]), token=checkout["token"],
+            network=checkout["network"], address=address,
+        )
+    else:
+        text = get_text("send_receipt", lang, address=address)
+    await cq.message.edit_text(text)
     await state.set_state(Flow.waiting_receipt)
     await cq.answer()
 
+# ---------------------- الدفع بنجوم تيليجرام ----------------------
+# الأسعار في الذاكرة: الرد على pre_checkout_query يجب أن يتم خلال 10 ثوانٍ
+STARS_PRICES = parse_prices(os.getenv("STARS_PRICES", "1:7500,3:15000,6:25000"))
+STARS_METHOD = "Telegram Stars"
+
+def parse_stars_payload(payload: str) -> Optional[Tuple[int, int]]:
+    """'sub:<months>:<stars>' -> (months, stars)"""
+    parts = payload.split(":")
+    if len(parts) != 3 or parts[0] != "sub" or not parts[1].isdigit() or not parts[2].isdigit():
+        return None
+    return int(parts[1]), int(parts[2])
+
+def record_star_payment(user_id: int, username: Optional[str], months: int, charge_id: str, amount: int) -> Optional[Tuple[Subscription, Optional[str]]]:
+    """
+    يسجل الدفع ويفعل الاشتراك ويحجز رابط الدعوة في معاملة واحدة.
+    charge_id يُدرج أولاً، فالتحديث المكرر يفشل قبل حجز أي رابط.
+    يعيد None إذا كان هذا الدفع قد عولج من قبل، وإلا (الاشتراك، الرابط أو None عند تجديد اشتراك سارٍ).
+    """
+    now = int(time.time())
+    link = None
+    with closing(sqlite3.connect(DB_FILE, isolation_level=None)) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "INSERT INTO star_payments (charge_id, user_id, duration_months, amount, created_ts) VALUES (?, ?, ?, ?, ?)",
+                (charge_id, user_id, months, amount, now),
+            )
+            sub, renewal = activate_in_transaction(conn, user_id, months, STARS_METHOD, now, username)
+            if not renewal:
+                link = get_channel_link().strip()
+                conn.execute("UPDATE star_payments SET invite_link = ? WHERE charge_id = ?", (link, charge_id))
+            conn.execute("COMMIT")
+        except sqlite3.IntegrityError:
+            conn.execute("ROLLBACK")
+            release_channel_link(link)
+            return None
+        except Exception:
+            conn.execute("ROLLBACK")
+            release_channel_link(link)
+            raise
+    on_subscription_written(sub)
+    return sub, link
+
+@router.callback_query(F.data.startswith("stars_"))
+async def stars_checkout(cq: CallbackQuery, state: FSMContext, bot: Bot):
+    months = int(cq.data.split("_")[1])
+    stars = STARS_PRICES.get(months)
+    if not stars:
+        await cq.answer("❌ هذه المدة غير متاحة بالنجوم.", show_alert=True)
+        return
+    lang = user_lang(cq.from_user.id)
+    await bot.send_invoice(
+        cq.from_user.id,
+        title=get_text("stars_invoice_title", lang),
+        description=get_text("stars_invoice_description", lang, months=months),
+        payload=f"sub:{months}:{stars}",
+        currency="XTR",
+        # أزرار المدة تحمل السعر بالدولار، ولا يجوز عرضه على فاتورة بالنجوم
+        prices=[LabeledPrice(label=btn(f"stars_duration_{months}", lang), amount=stars)],
+    )
+    await state.set_state(Flow.choosing_subscription)
+    await cq.answer()
+
+@router.pre_checkout_query()
+async def stars_pre_checkout(query: PreCheckoutQuery):
+    # التحقق من الذاكرة فقط، بدون قراءة ملفات أو قاعدة البيانات
+    parsed = parse_stars_payload(query.invoice_payload)
+    if query.currency != "XTR" or not parsed or STARS_PRICES.get(parsed[0]) != parsed[1] or query.total_amount != parsed[1]:
+        await query.answer(ok=False, error_message="❌ انتهت صلاحية هذه الفاتورة، يرجى طلب فاتورة جديدة.")
+        return
+    await query.answer(ok=True)
+
+@router.message(F.successful_payment)
+async def stars_successful_payment(message: Message, bot: Bot):
+    payment = message.successful_payment
+    parsed = parse_stars_payload(payment.invoice_payload)
+    if not parsed:
+        logging.error("Unknown Stars payload %s (charge %s)", payment.invoice_payload, payment.telegram_payment_charge_id)
+        return
+    months = parsed[0]
+    user = message.from_user
+    # المعاملة تقرأ الصف من القرص مباشرة، فنكتب التعديلات المعلقة أولًا
+    await write_queue.flush()
+    recorded = await asyncio.to_thread(
+        record_star_payment, user.id, user.username, months, payment.telegram_payment_charge_id, payment.total_amount
+    )
+    if recorded is None:
+        logging.info("Duplicate Stars payment %s ignored", payment.telegram_payment_charge_id)
+        return
+    sub, link = recorded
+    if link:
+        await send_activation_link(bot, user.id, link)
+    else:
+        await send_renewal_notice(bot, sub)
+    try:
+        username = f"@{user.username}" if user.username else f"ID: {user.id}"
+        await bot.send_message(
+            ADMIN_ID,
+            f"⭐ دفع بالنجوم مؤكد!\n"
+            f"👤 المستخدم: {username}\n"
+            f"📅 المدة: {months} شهر\n"
+            f"💫 المبلغ: {payment.total_amount} ⭐"
+        )
+    except Exception as e:
+        logging.warning("فشل إرسال إشعار النجوم للمشرف: %s", e)
+
+# طلبات التجديد: عضو نشط يرسل إيصال تجديد يبقى ACTIVE (البوابة والمطابقة تعتمدان على active_user_ids)،
+# ويُحفظ طلبه هنا حتى يراجعه المشرف، فلا يُطرد من القناة ولا يخسر أيامه المتبقية.
+PENDING_REQUESTS_SQL = """
+    SELECT user_id, username, duration_months, method, receipt_file_id, 0 AS renewal
+    FROM subscriptions WHERE state = 'pending'
+    UNION ALL
+    SELECT r.user_id, s.username, r.duration_months, r.method, r.receipt_file_id, 1 AS renewal
+    FROM renewal_requests r JOIN subscriptions s ON s.user_id = r.user_id
+"""
+
+def save_renewal_request(user_id: int, method: str, duration_months: int, receipt_file_id: str):
+    with closing(sqlite3.connect(DB_FILE)) as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO renewal_requests (user_id, method, duration_months, receipt_file_id, created_ts) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (user_id, method, duration_months, receipt_file_id, int(time.time())),
+        )
+        conn.commit()
+    bump_data_version()
+
+def load_renewal_request(user_id: int) -> Optional[Tuple[str, int, str]]:
+    """(method, duration_months, receipt_file_id) أو None."""
+    with closing(sqlite3.connect(DB_FILE)) as conn:
+        return conn.execute(
+            "SELECT method, duration_months, receipt_file_id FROM renewal_requests WHERE user_id = ?", (user_id,),
+        ).fetchone()
+
+def delete_renewal_request(user_id: int) -> bool:
+    with closing(sqlite3.connect(DB_FILE)) as conn:
+        cur = conn.execute("DELETE FROM renewal_requests WHERE user_id = ?", (user_id,))
+        conn.commit()
+    bump_data_version()
+    return cur.rowcount > 0
+
 @router.message(Flow.waiting_receipt, F.photo)
 async def receive_receipt(message: Message, state: FSMContext, bot: Bot):
     user_id = message.from_user.id
-    lang = (get_subscription(user_id) or {}).get("language", "ar")
     data = await state.get_data()
-    sub_dict = get_subscription(user_id)
-    sub = SimpleNamespace(**(sub_dict or {}))
-    sub.user_id = user_id
-    sub.username = message.from_user.username
-    sub.method = data["payment_method"]
-    sub.duration_months = data["duration_months"]
-    sub.receipt_file_id = message.photo[-1].file_id
-    sub.state = "pending"
-    upsert_subscription(sub)
+    sub = get_subscription(user_id) or Subscription(user_id)
+    lang = sub.lang
+    method, months = data["payment_method"], data["duration_months"]
+    receipt_file_id = message.photo[-1].file_id
+    renewal = bool(sub.is_active and sub.end_ts and sub.end_ts > int(time.time()))
+    if renewal:
+        await asyncio.to_thread(save_renewal_request, user_id, method, months, receipt_file_id)
+    else:
+        sub.username = message.from_user.username
+        sub.method = method
+        sub.duration_months = months
+        sub.receipt_file_id = receipt_file_id
+        sub.state = SubState.PENDING
+        await save_subscription(sub, durable=True)
 
     try:
         username = f"@{message.from_user.username}" if message.from_user.username else f"ID: {user_id}"
         await bot.send_message(
             ADMIN_ID,
-            f"📥 طلب اشتراك جديد!\n"
+            f"{'🔁 طلب تجديد اشتراك!' if renewal else '📥 طلب اشتراك جديد!'}\n"
             f"👤 المستخدم: {username}\n"
             f"🆔 الرقم: {user_id}\n"
-            f"📅 المدة: {sub.duration_months} شهر\n"
-            f"🏦 الطريقة: {sub.method}"
+            f"📅 المدة: {months} شهر\n"
+            f"🏦 الطريقة: {method}"
         )
-        await bot.send_photo(ADMIN_ID, sub.receipt_file_id)
+        await bot.send_photo(ADMIN_ID, receipt_file_id)
         kb = InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text=btn("admin_pending", lang), callback_data="admin_pending")]
         ])
@@ -415,13 +1725,11 @@ async def invalid_receipt(message: Message):
 @router.callback_query(F.data == "my_account")
 async def my_account(cq: CallbackQuery):
     sub = get_subscription(cq.from_user.id)
-    lang = (sub or {}).get("language", "ar")
-    if not sub or sub["state"] != "active":
+    lang = sub.lang if sub else "ar"
+    if not sub or not sub.is_active:
         await cq.message.edit_text(get_text("account_inactive", lang), reply_markup=main_keyboard(lang, user_id=cq.from_user.id))
     else:
-        end_date = time.strftime('%Y-%m-%d', time.localtime(sub["end_ts"]))
-        days_left = max(0, (sub["end_ts"] - int(time.time())) // (24 * 3600))
-        text = get_text("account_active", lang, end_date=end_date, days_left=days_left)
+        text = get_text("account_active", lang, end_date=sub.end_date, days_left=sub.days_left)
         kb = InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text=btn("back", lang), callback_data="go_start")]
         ])
@@ -433,56 +1741,68 @@ async def admin_panel(cq: CallbackQuery):
     if cq.from_user.id != ADMIN_ID:
         await cq.answer("🚫 غير مصرح", show_alert=True)
         return
-    lang = (get_subscription(cq.from_user.id) or {}).get("language", "ar")
+    lang = user_lang(cq.from_user.id)
     await cq.message.edit_text("🔧 *لوحة التحكم*", reply_markup=admin_keyboard(lang))
     await cq.answer()
 
+def build_admin_stats_text() -> str:
+    df = list_df()
+    if df.empty:
+        return "📊 لا توجد بيانات حتى الآن."
+
+    total = len(df)
+    active = len(df[df["state"] == "active"])
+    pending = len(df[df["state"] == "pending"])
+    ended = len(df[df["state"] == "ended"])
+    rejected = len(df[df["state"] == "rejected"])
+
+    ar_count = len(df[df["language"] == "ar"])
+    en_count = len(df[df["language"] == "en"])
+
+    months_1 = len(df[df["duration_months"] == 1])
+    months_3 = len(df[df["duration_months"] == 3])
+    months_6 = len(df[df["duration_months"] == 6])
+
+    _, archived = count_rows()
+
+    top_users = df[df["state"] == "active"].nlargest(5, 'duration_months')
+    top_text = ""
+    for _, row in top_users.iterrows():
+        username = f"@{row['username']}" if row['username'] else f"ID: {row['user_id']}"
+        top_text += f"• {username} - {row['duration_months']} شهر\n"
+
+    return (
+        f"<b>📊 الإحصائيات التفصيلية</b>\n\n"
+        f"👥 <b>الإجمالي:</b> <code>{total}</code>\n"
+        f"✅ <b>نشط:</b> <code>{active}</code> | ⏳ <b>معلق:</b> <code>{pending}</code>\n"
+        f"❌ <b>منتهي:</b> <code>{ended}</code> | 🚫 <b>مرفوض:</b> <code>{rejected}</code>\n"
+        f"🗄 <b>في الأرشيف:</b> <code>{archived}</code>\n\n"
+        f"🔹 <b>حسب اللغة:</b>\n"
+        f"  🇸🇦 عربي: <code>{ar_count}</code> | 🇬🇧 إنجليزي: <code>{en_count}</code>\n\n"
+        f"🔹 <b>مدة الاشتراك:</b>\n"
+        f"  1 شهر: <code>{months_1}</code> | 3 شهور: <code>{months_3}</code> | 6 شهور: <code>{months_6}</code>\n\n"
+        f"🏆 <b>الأعلى دفعًا (5 أعضاء نشطين):</b>\n"
+        f"{top_text if top_text else 'لا يوجد'}"
+    )
+
 @router.callback_query(F.data == "admin_stats")
 async def admin_stats(cq: CallbackQuery):
     if cq.from_user.id != ADMIN_ID:
         await cq.answer("🚫 غير مصرح", show_alert=True)
         return
-    df = list_df()
-    lang = (get_subscription(cq.from_user.id) or {}).get("language", "ar")
-    
-    if df.empty:
-        text = "📊 لا توجد بيانات حتى الآن."
-    else:
-        total = len(df)
-        active = len(df[df["state"] == "active"])
-        pending = len(df[df["state"] == "pending"])
-        ended = len(df[df["state"] == "ended"])
-        rejected = len(df[df["state"] == "rejected"])
-
-        ar_count = len(df[df["language"] == "ar"])
-        en_count = len(df[df["language"] == "en"])
-
-        months_1 = len(df[df["duration_months"] == 1])
-        months_3 = len(df[df["duration_months"] == 3])
-        months_6 = len(df[df["duration_months"] == 6])
-
-        top_users = df[df["state"] == "active"].nlargest(5, 'duration_months')
-        top_text = ""
-        for _, row in top_users.iterrows():
-            username = f"@{row['username']}" if row['username'] else f"ID: {row['user_id']}"
-            top_text += f"• {username} - {row['duration_months']} شهر\n"
+    version = data_version()
+    # لم تتغير البيانات منذ آخر عرض في هذه الرسالة: لا حاجة لإعادة الحساب
+    if view_is_fresh(cq.message, "admin_stats", version):
+        await cq.answer("📊 البيانات محدثة بالفعل.", show_alert=True)
+        return
 
-        text = (
-            f"<b>📊 الإحصائيات التفصيلية</b>\n\n"
-            f"👥 <b>الإجمالي:</b> <code>{total}</code>\n"
-            f"✅ <b>نشط:</b> <code>{active}</code> | ⏳ <b>معلق:</b> <code>{pending}</code>\n"
-            f"❌ <b>منتهي:</b> <code>{ended}</code> | 🚫 <b>مرفوض:</b> <code>{rejected}</code>\n\n"
-            f"🔹 <b>حسب اللغة:</b>\n"
-            f"  🇸🇦 عربي: <code>{ar_count}</code> | 🇬🇧 إنجليزي: <code>{en_count}</code>\n\n"
-            f"🔹 <b>مدة الاشتراك:</b>\n"
-            f"  1 شهر: <code>{months_1}</code> | 3 شهور: <code>{months_3}</code> | 6 شهور: <code>{months_6}</code>\n\n"
-            f"🏆 <b>الأعلى دفعًا (5 أعضاء نشطين):</b>\n"
-            f"{top_text if top_text else 'لا يوجد'}"
-        )
+    text = await admin_views.do("admin_stats", version, build_admin_stats_text)
+    lang = user_lang(cq.from_user.id)
 
     try:
         if cq.message.text != text:
-            await cq.message.edit_text(text, reply_markup=admin_keyboard(lang), parse_mode="HTML")
+            edited = await cq.message.edit_text(text, reply_markup=admin_keyboard(lang), parse_mode="HTML")
+            mark_view_rendered(edited, "admin_stats", version)
         else:
             await cq.answer("📊 البيانات محدثة بالفعل.", show_alert=True)
     except Exception as e:
@@ -499,8 +1819,8 @@ async def admin_pending(cq: CallbackQuery):
     if cq.from_user.id != ADMIN_ID:
         await cq.answer("🚫 غير مصرح", show_alert=True)
         return
-    df = list_df("SELECT * FROM subscriptions WHERE state = 'pending'")
-    lang = (get_subscription(cq.from_user.id) or {}).get("language", "ar")
+    df = await admin_views.do("admin_pending", data_version(), list_df, PENDING_REQUESTS_SQL)
+    lang = user_lang(cq.from_user.id)
     
     if df.empty:
         text = "📭 لا توجد طلبات معلقة."
@@ -526,7 +1846,8 @@ async def admin_pending(cq: CallbackQuery):
 
         text = (
             get_text("admin_pending_title", lang) + "\n\n"
-            f"👤 المستخدم: {username}\n"
+            + ("🔁 تجديد لعضو نشط\n" if row['renewal'] else "")
+            + f"👤 المستخدم: {username}\n"
             f"📆 المدة: {duration} شهر\n"
             f"🏦 الطريقة: {method}\n"
         )
@@ -552,23 +1873,23 @@ async def show_user_details(message: Message, user_id: int, bot: Bot):
         await message.answer("❌ لم يتم العثور على المستخدم.")
         return
 
-    username = f"@{sub['username']}" if sub['username'] else "غير متوفر"
-    start_date = time.strftime('%Y-%m-%d', time.localtime(sub["start_ts"])) if sub["start_ts"] else "غير محدد"
-    end_date = time.strftime('%Y-%m-%d', time.localtime(sub["end_ts"])) if sub["end_ts"] else "غير محدد"
-    days_left = max(0, (sub["end_ts"] - int(time.time())) // (24 * 3600)) if sub["end_ts"] else 0
-    lang = sub.get("language", "ar")
+    username = f"@{sub.username}" if sub.username else "غير متوفر"
+    start_date = sub.start_date or "غير محدد"
+    end_date = sub.end_date or "غير محدد"
+    days_left = sub.days_left
+    lang = sub.lang
 
     text = (
         "🔍 **معلومات المستخدم**\n\n"
         f"🆔 `{user_id}`\n"
         f"👤 {username}\n"
         f"🌐 {'عربي' if lang == 'ar' else 'إنجليزي'}\n"
-        f"💳 {sub['duration_months']} شهر\n"
+        f"💳 {sub.duration_months} شهر\n"
         f"📅 البدء: `{start_date}`\n"
         f"📆 الانتهاء: `{end_date}`\n"
         f"⏳ المتبقية: `{days_left}` يوم\n"
-        f"📌 الحالة: `{sub['state'].upper()}`\n"
-        f"🏦 الدفع: `{sub['method']}`\n"
+        f"📌 الحالة: `{sub.state.name}`\n"
+        f"🏦 الدفع: `{sub.method}`\n"
     )
 
     kb = InlineKeyboardMarkup(inline_keyboard=[
@@ -588,32 +1909,38 @@ async def show_user_details(message: Message, user_id: int, bot: Bot):
         else:
             logging.warning("Error editing message: %s", e)
 
+def build_all_users_rows() -> list:
+    df = list_df()
+    if df.empty:
+        return []
+    df['days_left'] = df['end_ts'].apply(lambda x: max(0, (x - int(time.time())) // (24 * 3600)) if x else 0)
+    df = df.sort_values(by=['state', 'duration_months', 'days_left'], ascending=[False, False, False])
+    df = df.head(50)
+    return [(row['user_id'], row['username'], row['state']) for _, row in df.iterrows()]
+
 @router.callback_query(F.data == "admin_all_users")
 async def admin_all_users(cq: CallbackQuery):
     if cq.from_user.id != ADMIN_ID:
         await cq.answer("🚫 غير مصرح", show_alert=True)
         return
 
-    df = list_df()
-    if df.empty:
-        await cq.message.edit_text("📭 لا يوجد مستخدمين بعد.", reply_markup=admin_keyboard())
+    # الترتيب يعتمد على الأيام المتبقية، لذا يدخل اليوم الحالي في مفتاح الإصدار
+    version = (data_version(), int(time.time()) // (24 * 3600))
+    if view_is_fresh(cq.message, "admin_all_users", version):
         await cq.answer()
         return
 
-    df['days_left'] = df['end_ts'].apply(lambda x: max(0, (x - int(time.time())) // (24 * 3600)) if x else 0)
-    df = df.sort_values(by=['state', 'duration_months', 'days_left'], ascending=[False, False, False])
-    df = df.head(50)
+    rows = await admin_views.do("admin_all_users", version, build_all_users_rows)
+    if not rows:
+        await cq.message.edit_text("📭 لا يوجد مستخدمين بعد.", reply_markup=admin_keyboard())
+        await cq.answer()
+        return
 
     text = "👥 **جميع المستخدمين (أعلى 50)**\n\n"
     keyboard = []
 
-    for _, row in df.iterrows():
-        user_id = row['user_id']
-        username = f"@{row['username']}" if row['username'] else f"ID: {user_id}"
-        duration = row['duration_months']
-        days_left = row['days_left']
-        state = row['state']
-
+    for user_id, username, state in rows:
+        username = f"@{username}" if username else f"ID: {user_id}"
         status_emoji = "✅" if state == "active" else "⏳" if state == "pending" else "❌"
         keyboard.append([InlineKeyboardButton(text=f"{status_emoji} {username}", callback_data=f"view_user_{user_id}")])
 
@@ -621,7 +1948,8 @@ async def admin_all_users(cq: CallbackQuery):
     markup = InlineKeyboardMarkup(inline_keyboard=keyboard)
 
     try:
-        await cq.message.edit_text(text, reply_markup=markup)
+        edited = await cq.message.edit_text(text, reply_markup=markup)
+        mark_view_rendered(edited, "admin_all_users", version)
     except Exception as e:
         logging.warning("Error in admin_all_users: %s", e)
     await cq.answer()
@@ -641,8 +1969,9 @@ async def extend_menu(cq: CallbackQuery):
         await cq.answer("🚫 غير مصرح", show_alert=True)
         return
     user_id = int(cq.data.split("_")[2])
-    lang = (get_subscription(cq.from_user.id) or {}).get("language", "ar")
-    markup = get_duration_keyboard(user_id, "extend", lang)
+    lang = user_lang(cq.from_user.id)
+    sub = get_subscription(user_id)
+    markup = get_duration_keyboard(user_id, "extend", lang, sub.end_ts if sub else None)
     await cq.message.edit_text(f"➕ اختر عدد الأيام لتمديد اشتراك المستخدم {user_id}:", reply_markup=markup)
     await cq.answer()
 
@@ -652,16 +1981,19 @@ async def shorten_menu(cq: CallbackQuery):
         await cq.answer("🚫 غير مصرح", show_alert=True)
         return
     user_id = int(cq.data.split("_")[2])
-    lang = (get_subscription(cq.from_user.id) or {}).get("language", "ar")
-    markup = get_duration_keyboard(user_id, "shorten", lang)
+    lang = user_lang(cq.from_user.id)
+    sub = get_subscription(user_id)
+    markup = get_duration_keyboard(user_id, "shorten", lang, sub.end_ts if sub else None)
     await cq.message.edit_text(f"➖ اختر عدد الأيام لتقصير اشتراك المستخدم {user_id}:", reply_markup=markup)
     await cq.answer()
 
-def get_duration_keyboard(user_id: int, action: str, lang: str) -> InlineKeyboardMarkup:
+def get_duration_keyboard(user_id: int, action: str, lang: str, end_ts: Optional[int] = None) -> InlineKeyboardMarkup:
+    # تاريخ الانتهاء الحالي جزء من البيانات: الزر ينطبق على الحالة المعروضة فقط،
+    # ويتغير مفتاح منع التكرار بعد كل تعديل ناجح
     buttons = []
     for days in [7, 15, 30, 60, 90]:
         text = f"{'➕' if action == 'extend' else '➖'} {days} يوم"
-        callback_data = f"{action}_{user_id}_{days}"
+        callback_data = f"{action}_{user_id}_{days}_{end_ts or 0}"
         buttons.append([InlineKeyboardButton(text=text, callback_data=callback_data)])
     buttons.append([InlineKeyboardButton(text=btn("back", lang), callback_data=f"view_user_{user_id}")])
     return InlineKeyboardMarkup(inline_keyboard=buttons)
@@ -679,12 +2011,15 @@ async def modify_duration(cq: CallbackQuery, bot: Bot):
     days = int(parts[2])
     seconds = days * 24 * 3600
 
-    sub_dict = get_subscription(user_id)
-    if not sub_dict or sub_dict["state"] != "active":
+    sub = get_subscription(user_id)
+    if not sub or not sub.is_active:
         await cq.answer("❌ يمكن التعديل فقط على الاشتراكات النشطة.", show_alert=True)
         return
 
-    sub = SimpleNamespace(**sub_dict)
+    expected_end_ts = sub.end_ts
+    if len(parts) > 3 and int(parts[3]) != expected_end_ts:
+        await cq.answer("⚠️ تغير الاشتراك منذ عرض القائمة، افتحها من جديد.", show_alert=True)
+        return
     if action == "extend":
         sub.end_ts += seconds
         user_msg = f"🎉 تم تمديد اشتراكك لمدة {days} يوم! استمتع."
@@ -692,7 +2027,9 @@ async def modify_duration(cq: CallbackQuery, bot: Bot):
         sub.end_ts = max(sub.start_ts, sub.end_ts - seconds)
         user_msg = f"⚠️ تم تعديل مدة اشتراكك."
 
-    upsert_subscription(sub)
+    if not await transition_subscription(sub, SubState.ACTIVE, expected_end_ts):
+        await cq.answer("⚠️ تغير الاشتراك أثناء التعديل، حاول مرة أخرى.", show_alert=True)
+        return
     try:
         await bot.send_message(user_id, user_msg)
     except Exception as e:
@@ -700,6 +2037,46 @@ async def modify_duration(cq: CallbackQuery, bot: Bot):
 
     await show_user_details(cq.message, user_id, bot)
     await cq.answer()
+    return True
+
+async def activate_subscription(bot: Bot, user_id: int) -> bool:
+    """تفعيل الاشتراك بعد موافقة المشرف وإرسال رابط القناة أو إشعار التجديد."""
+    sub = get_subscription(user_id)
+    if not sub:
+        return False
+    renewal_request = await asyncio.to_thread(load_renewal_request, user_id) if sub.is_active else None
+    if sub.state is not SubState.PENDING and renewal_request is None:
+        return False
+    expected_state, expected_end_ts = sub.state, sub.end_ts
+    if renewal_request:
+        sub.method, sub.duration_months, sub.receipt_file_id = renewal_request
+    renewal = apply_subscription_period(sub, sub.duration_months or 1)
+    # الرابط يُستهلك فقط بعد نجاح الانتقال، فالتفعيل المتزامن لا يحرق رابطين
+    if not await transition_subscription(sub, expected_state, expected_end_ts):
+        return False
+    if renewal_request:
+        await asyncio.to_thread(delete_renewal_request, user_id)
+    if renewal:
+        await send_renewal_notice(bot, sub)
+    else:
+        await send_activation_link(bot, user_id, get_channel_link().strip())
+    return True
+
+async def send_activation_link(bot: Bot, user_id: int, link: str):
+    try:
+        kb = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="🔐 انضم إلى القناة الخاصة", url=link)]
+        ])
+        await bot.send_message(user_id, "✅ تم تفعيل اشتراكك! اضغط على الزر أدناه للانضمام:", reply_markup=kb)
+    except Exception as e:
+        logging.warning("فشل إرسال التفعيل: %s", e)
+        await bot.send_message(user_id, f"✅ تم تفعيل اشتراكك! رابط الدخول: {link}")
+
+async def send_renewal_notice(bot: Bot, sub: Subscription):
+    try:
+        await bot.send_message(sub.user_id, get_text("subscription_renewed", sub.lang, end_date=sub.end_date))
+    except Exception as e:
+        logging.warning("فشل إرسال إشعار التجديد: %s", e)
 
 @router.callback_query(F.data.startswith("approve_"))
 async def approve_user_handler(cq: CallbackQuery, bot: Bot):
@@ -707,32 +2084,14 @@ async def approve_user_handler(cq: CallbackQuery, bot: Bot):
         await cq.answer("🚫 غير مصرح", show_alert=True)
         return
     user_id = int(cq.data.split("_")[1])
-    sub_dict = get_subscription(user_id)
-    if not sub_dict or sub_dict["state"] != "pending":
-        text = f"❌ هذا المستخدم ليس لديه طلب معلق."
-    else:
-        sub = SimpleNamespace(**sub_dict)
-        now = int(time.time())
-        months = sub.duration_months or 1
-        add_seconds = months * 30 * 24 * 3600
-        sub.start_ts = now
-        sub.end_ts = now + add_seconds
-        sub.state = "active"
-        upsert_subscription(sub)
-        link = get_channel_link().strip()
-
-        try:
-            kb = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="🔐 انضم إلى القناة الخاصة", url=link)]
-            ])
-            await bot.send_message(user_id, "✅ تم تفعيل اشتراكك! اضغط على الزر أدناه للانضمام:", reply_markup=kb)
-        except Exception as e:
-            logging.warning("فشل إرسال التفعيل: %s", e)
-            await bot.send_message(user_id, f"✅ تم تفعيل اشتراكك! رابط الدخول: {link}")
-
+    activated = await activate_subscription(bot, user_id)
+    if activated:
         text = f"✅ تم تفعيل الاشتراك للمستخدم {user_id}"
+    else:
+        text = f"❌ هذا المستخدم ليس لديه طلب معلق."
     await cq.message.edit_text(text)
     await cq.answer()
+    return activated
 
 @router.callback_query(F.data.startswith("reject_"))
 async def reject_user_handler(cq: CallbackQuery, bot: Bot):
@@ -740,17 +2099,29 @@ async def reject_user_handler(cq: CallbackQuery, bot: Bot):
         await cq.answer("🚫 غير مصرح", show_alert=True)
         return
     user_id = int(cq.data.split("_")[1])
-    sub_dict = get_subscription(user_id)
-    if sub_dict:
-        sub = SimpleNamespace(**sub_dict)
-        sub.state = "rejected"
-        upsert_subscription(sub)
+    sub = get_subscription(user_id)
+    if sub and sub.is_active and await asyncio.to_thread(delete_renewal_request, user_id):
+        # رفض طلب التجديد فقط: الاشتراك الحالي يبقى سارياً حتى نهايته
+        try:
+            await bot.send_message(user_id, get_text("renewal_rejected", sub.lang, end_date=sub.end_date))
+        except Exception as e:
+            logging.warning("فشل إرسال الرفض: %s", e)
+        await cq.message.edit_text(f"❌ تم رفض طلب التجديد للمستخدم {user_id}")
+        await cq.answer()
+        return True
+    if sub and sub.state is not SubState.REJECTED:
+        expected_state = sub.state
+        sub.state = SubState.REJECTED
+        if not await transition_subscription(sub, expected_state, sub.end_ts):
+            await cq.answer("⚠️ تغيرت حالة الطلب، حاول مرة أخرى.", show_alert=True)
+            return
         try:
             await bot.send_message(user_id, "❌ تم رفض طلب اشتراكك.")
         except Exception as e:
             logging.warning("فشل إرسال الرفض: %s", e)
     await cq.message.edit_text(f"❌ تم رفض الطلب للمستخدم {user_id}")
     await cq.answer()
+    return True
 
 @router.callback_query(F.data.startswith("delete_"))
 async def delete_user_handler(cq: CallbackQuery):
@@ -758,12 +2129,20 @@ async def delete_user_handler(cq: CallbackQuery):
         await cq.answer("🚫 غير مصرح", show_alert=True)
         return
     user_id = int(cq.data.split("_")[1])
+    # نكتب أي تعديل معلق أولًا حتى لا يعيد إنشاء الصف بعد حذفه
+    await write_queue.flush()
     with closing(sqlite3.connect(DB_FILE)) as conn:
         cur = conn.cursor()
         cur.execute("DELETE FROM subscriptions WHERE user_id = ?", (user_id,))
+        cur.execute("DELETE FROM subscriptions_archive WHERE user_id = ?", (user_id,))
+        cur.execute("DELETE FROM renewal_requests WHERE user_id = ?", (user_id,))
         conn.commit()
+    active_user_ids.discard(user_id)
+    bump_data_version()
+    await asyncio.to_thread(delete_alert_preferences, user_id)
     await cq.message.edit_text(f"🗑 تم حذف المستخدم {user_id} من قاعدة البيانات.")
     await cq.answer()
+    return True
 
 @router.callback_query(F.data == "admin_export")
 async def admin_export(cq: CallbackQuery):
@@ -776,6 +2155,22 @@ async def admin_export(cq: CallbackQuery):
     await cq.message.answer_document(FSInputFile(file_path), caption="📄 بيانات المستخدمين")
     await cq.answer()
 
+@router.callback_query(F.data == "admin_export_all")
+async def admin_export_all(cq: CallbackQuery):
+    if cq.from_user.id != ADMIN_ID:
+        await cq.answer("🚫 غير مصرح", show_alert=True)
+        return
+    await cq.answer("⏳")
+    df = await asyncio.to_thread(
+        list_df,
+        f"SELECT {ARCHIVE_COLUMNS_SQL}, NULL AS archived_ts FROM subscriptions "
+        f"UNION ALL SELECT {ARCHIVE_COLUMNS_SQL}, archived_ts FROM subscriptions_archive "
+        "WHERE user_id NOT IN (SELECT user_id FROM subscriptions) ORDER BY user_id",
+    )
+    file_path = "subscriptions_all.csv"
+    df.to_csv(file_path, index=False)
+    await cq.message.answer_document(FSInputFile(file_path), caption="📦 بيانات المستخدمين مع الأرشيف")
+
 @router.callback_query(F.data == "admin_broadcast")
 async def admin_broadcast_prompt(cq: CallbackQuery, state: FSMContext):
     if cq.from_user.id != ADMIN_ID:
@@ -825,7 +2220,7 @@ async def admin_manage_links(cq: CallbackQuery):
     if cq.from_user.id != ADMIN_ID:
         await cq.answer("🚫 غير مصرح", show_alert=True)
         return
-    lang = (get_subscription(cq.from_user.id) or {}).get("language", "ar")
+    lang = user_lang(cq.from_user.id)
     await cq.message.edit_text("🔗 إدارة الروابط:", reply_markup=links_keyboard(lang))
     await cq.answer()
 
@@ -863,7 +2258,7 @@ async def admin_manage_wallets(cq: CallbackQuery):
     if cq.from_user.id != ADMIN_ID:
         await cq.answer("🚫 غير مصرح", show_alert=True)
         return
-    lang = (get_subscription(cq.from_user.id) or {}).get("language", "ar")
+    lang = user_lang(cq.from_user.id)
     await cq.message.edit_text("💳 المحافظ الحالية:", reply_markup=wallets_keyboard(lang))
     await cq.answer()
 
@@ -965,30 +2360,43 @@ async def admin_search_handle(message: Message, state: FSMContext, bot: Bot):
 
     if query.isdigit():
         sub = get_subscription(int(query))
-    elif query.startswith('@'):
-        df = list_df("SELECT * FROM subscriptions WHERE username = ?", (query[1:],))
-        if not df.empty:
-            sub = df.iloc[0].to_dict()
     else:
-        df = list_df("SELECT * FROM subscriptions WHERE username = ?", (query,))
-        if not df.empty:
-            sub = df.iloc[0].to_dict()
+        username = query.lstrip('@')
+        matches = list_subscriptions("WHERE username = ? LIMIT 1", (username,))
+        if matches:
+            sub = matches[0]
+        else:
+            # البحث يشمل الأرشيف؛ المستخدم يُعاد للجدول الحي عند فتحه
+            archived_id = find_archived_user_id(username)
+            if archived_id:
+                sub = get_subscription(archived_id)
 
     if not sub:
         await message.answer("❌ لم يتم العثور على مستخدم بهذا المعرف أو اسم المستخدم.")
         await state.set_state(Flow.choosing_subscription)
         return
 
-    await show_user_details(message, sub["user_id"], bot)
+    await show_user_details(message, sub.user_id, bot)
     await state.set_state(Flow.choosing_subscription)
 
 
 
 
 # ---------------------- الترحيب عند الدخول للقناة ----------------------
+def is_channel_access_allowed(user_id: int, status: str) -> bool:
+    if user_id == ADMIN_ID or status in (ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.CREATOR):
+        return True
+    return user_id in active_user_ids
+
 @router.chat_member(ChatMemberUpdatedFilter(IS_NOT_MEMBER >> IS_MEMBER))
 async def welcome_new_member(event: ChatMemberUpdated, bot: Bot):
     if PRIVATE_CHANNEL_ID and str(event.chat.id) == PRIVATE_CHANNEL_ID:
+        member = event.new_chat_member
+        # رابط دعوة مسرّب أو معاد توجيهه: الطرد فورًا بدون الرجوع لقاعدة البيانات
+        if not is_channel_access_allowed(member.user.id, member.status):
+            logging.warning("🚷 Unauthorized join to private channel: %s", member.user.id)
+            await lifecycle.critical(kick_from_channel(bot, member.user.id))
+            return
         try:
             lang = "ar"
             await bot.send_message(
@@ -999,66 +2407,1680 @@ async def welcome_new_member(event: ChatMemberUpdated, bot: Bot):
             logging.warning("فشل إرسال رسالة الترحيب: %s", e)
 
 # ---------------------- مهمة التذكير والطرد التلقائي ----------------------
+async def kick_from_channel(bot: Bot, user_id: int):
+    # حظر ثم فك الحظر: يُخرج المستخدم دون منعه من العودة لاحقًا
+    try:
+        await bot.ban_chat_member(int(PRIVATE_CHANNEL_ID), user_id)
+        await asyncio.sleep(1)
+        await bot.unban_chat_member(int(PRIVATE_CHANNEL_ID), user_id)
+    except Exception as e:
+        logging.warning("فشل طرد المستخدم %s من القناة: %s", user_id, e)
+
+async def run_reminders(bot: Bot):
+    subs = await asyncio.to_thread(
+        list_subscriptions, "WHERE state = 'active' AND end_ts IS NOT NULL"
+    )
+    now = int(time.time())
+    for sub in subs:
+        user_id = sub.user_id
+        # القائمة قُرئت في بداية الدورة: كتابة معلقة لاحقة (تجديد مثلاً) هي الأحدث
+        sub = write_queue.peek(user_id) or sub
+        if not sub.is_active or sub.end_ts is None:
+            continue
+        lang = sub.lang
+        time_left = sub.end_ts - now
+        days_left = time_left // DAY_SECONDS
+
+        if days_left == 3:
+            try:
+                await bot.send_message(user_id, get_text("reminder_3_days", lang))
+            except Exception as e:
+                logging.warning("فشل إرسال التحذير قبل 3 أيام لـ %s: %s", user_id, e)
+
+        if days_left == 1:
+            try:
+                await bot.send_message(user_id, get_text("reminder_1_day", lang))
+            except Exception as e:
+                logging.warning("فشل إرسال التحذير قبل يوم لـ %s: %s", user_id, e)
+
+        if time_left <= -DAY_SECONDS:
+            sub.state = SubState.ENDED
+            # تجديد (نجوم أو دفع على الشبكة) التزم أثناء الدورة: لا نكتب فوقه ولا نطرد من دفع للتو
+            if not await transition_subscription(sub, SubState.ACTIVE, sub.end_ts):
+                logging.info("Expiry of %s skipped, subscription changed meanwhile", user_id)
+                continue
+
+            if PRIVATE_CHANNEL_ID:
+                await lifecycle.critical(kick_from_channel(bot, user_id))
+
+            try:
+                await bot.send_message(user_id, get_text("sub_expired", lang))
+            except Exception as e:
+                logging.warning("فشل إرسال رسالة الانتهاء لـ %s: %s", user_id, e)
+
 async def reminder_task(bot: Bot):
     while True:
         try:
-            df = list_df()
-            now = int(time.time())
-            for _, row in df.iterrows():
-                user_id = int(row["user_id"])
-                if row["state"] != "active" or not row["end_ts"]:
-                    continue
-
-                time_left = row["end_ts"] - now
-                days_left = time_left // (24 * 3600)
-
-                if days_left == 3:
-                    try:
-                        lang = row["language"] or "ar"
-                        await bot.send_message(user_id, get_text("reminder_3_days", lang))
-                    except Exception as e:
-                        logging.warning("فشل إرسال التحذير قبل 3 أيام لـ %s: %s", user_id, e)
-
-                if days_left == 1:
-                    try:
-                        lang = row["language"] or "ar"
-                        await bot.send_message(user_id, get_text("reminder_1_day", lang))
-                    except Exception as e:
-                        logging.warning("فشل إرسال التحذير قبل يوم لـ %s: %s", user_id, e)
-
-                if time_left <= -24 * 3600:
-                    sub = SimpleNamespace(**row)
-                    if sub.state == "active":
-                        sub.state = "ended"
-                        upsert_subscription(sub)
-
-                        if PRIVATE_CHANNEL_ID:
-                            try:
-                                await bot.ban_chat_member(int(PRIVATE_CHANNEL_ID), user_id)
-                                await asyncio.sleep(1)
-                                await bot.unban_chat_member(int(PRIVATE_CHANNEL_ID), user_id)
-                            except Exception as e:
-                                logging.warning("فشل طرد المستخدم %s من القناة: %s", user_id, e)
-
-                        try:
-                            lang = row["language"] or "ar"
-                            await bot.send_message(user_id, get_text("sub_expired", lang))
-                        except Exception as e:
-                            logging.warning("فشل إرسال رسالة الانتهاء لـ %s: %s", user_id, e)
+            await run_reminders(bot)
         except Exception as e:
             logging.exception("Reminder task error: %s", e)
         await asyncio.sleep(3600)
 
+# ---------------------- المنشورات المجدولة ----------------------
+BROADCAST_DELAY = 0.05  # ~20 رسالة في الثانية، أقل من حد تيليجرام
+BROADCAST_TARGETS = {
+    "active": "✅ المشتركون النشطون",
+    "ended": "❌ الاشتراكات المنتهية",
+    "all": "👥 جميع المستخدمين",
+}
+
+def _parse_cron_field(field: str, lo: int, hi: int) -> set:
+    values = set()
+    for part in field.split(","):
+        step = 1
+        if "/" in part:
+            part, step = part.split("/", 1)
+            step = int(step)
+        if part == "*":
+            start, end = lo, hi
+        elif "-" in part:
+            start, end = (int(x) for x in part.split("-", 1))
+        else:
+            start = int(part)
+            end = hi if step > 1 else start
+        if step < 1 or start < lo or end > hi or start > end:
+            raise ValueError(f"Invalid cron field: {field}")
+        values.update(range(start, end + 1, step))
+    return values
+
+def parse_cron(expr: str) -> Tuple[set, set, set, set, set, bool]:
+    """
+    صيغة cron الخماسية: دقيقة ساعة يوم شهر يوم_الأسبوع (0 = الأحد).
+    مثل cron القياسي: إذا قُيّد يوم الشهر ويوم الأسبوع معاً يكفي تطابق أحدهما (day_or).
+    """
+    fields = expr.split()
+    if len(fields) != 5:
+        raise ValueError("Cron expression must have 5 fields")
+    minutes = _parse_cron_field(fields[0], 0, 59)
+    hours = _parse_cron_field(fields[1], 0, 23)
+    days = _parse_cron_field(fields[2], 1, 31)
+    months = _parse_cron_field(fields[3], 1, 12)
+    dows = {d % 7 for d in _parse_cron_field(fields[4], 0, 7)}
+    day_or = not fields[2].startswith("*") and not fields[4].startswith("*")
+    return minutes, hours, days, months, dows, day_or
+
+def cron_next(expr: str, after_ts: int) -> int:
+    minutes, hours, days, months, dows, day_or = parse_cron(expr)
+
+    def day_matches(t: datetime) -> bool:
+        in_days, in_dows = t.day in days, t.isoweekday() % 7 in dows
+        return (in_days or in_dows) if day_or else (in_days and in_dows)
+
+    t = datetime.fromtimestamp(after_ts).replace(second=0, microsecond=0) + timedelta(minutes=1)
+    limit = t + timedelta(days=366 * 5)
+    # نقفز بالشهر/اليوم/الساعة بدل المرور على كل دقيقة
+    while t < limit:
+        if t.month not in months:
+            t = (t.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+        elif not day_matches(t):
+            t = t.replace(hour=0, minute=0) + timedelta(days=1)
+        elif t.hour not in hours:
+            t = t.replace(minute=0) + timedelta(hours=1)
+        elif t.minute not in minutes:
+            t += timedelta(minutes=1)
+        else:
+            return int(t.timestamp())
+    raise ValueError(f"Cron expression never fires: {expr}")
+
+JOB_COLUMNS = ["id", "kind", "target", "payload", "run_at", "cron", "enabled", "last_run_ts", "created_ts"]
+
+class JobScheduler:
+    """
+    مجدول مهام دائم في SQLite: كومة واحدة (heap) مرتبة حسب وقت التنفيذ وحلقة واحدة
+    تنام حتى أقرب مهمة، مع حد أقصى للمهام المنفذة في نفس الوقت.
+    """
+
+    def __init__(self, max_concurrency: int = 2):
+        self.max_concurrency = max_concurrency
+        self._handlers: Dict[str, Any] = {}
+        self.labels: Dict[str, str] = {}
+        self._jobs: Dict[int, dict] = {}
+        self._heap: list = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._loop_task: Optional[asyncio.Task] = None
+        self._running: set = set()
+        self.bot: Optional[Bot] = None
+
+    def register(self, kind: str, func, label: str = None):
+        self._handlers[kind] = func
+        self.labels[kind] = label or kind
+
+    def ensure_job(self, kind: str, cron: str, target: str = None, payload: dict = None) -> int:
+        """ينشئ مهمة نظامية متكررة إذا لم تكن موجودة مسبقًا، ويحدّث جدولها إذا تغير cron المضبوط."""
+        for job in self._jobs.values():
+            if job["kind"] == kind:
+                if job["cron"] != cron:
+                    logging.info("⏰ Job %s (%s) rescheduled: %s -> %s", job["id"], kind, job["cron"], cron)
+                    run_at = cron_next(cron, int(time.time()))
+                    job["cron"] = cron
+                    # المدخل القديم في الكومة يُتجاهل لأن run_at لم يعد يطابقه
+                    if run_at != job["run_at"]:
+                        job["run_at"] = run_at
+                        self._push(job)
+                    self._save_job(job)
+                return job["id"]
+        return self.add_job(kind, target, payload or {}, cron=cron)
+
+    def _push(self, job: dict):
+        self._jobs[job["id"]] = job
+        heapq.heappush(self._heap, (job["run_at"], job["id"]))
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def load_jobs(self):
+        with closing(sqlite3.connect(DB_FILE)) as conn:
+            rows = conn.execute(
+                f"SELECT {', '.join(JOB_COLUMNS)} FROM scheduled_jobs WHERE enabled = 1"
+            ).fetchall()
+        now = int(time.time())
+        for row in rows:
+            job = dict(zip(JOB_COLUMNS, row))
+            # مهمة متكررة فاتها موعدها أثناء التوقف: ننتقل للموعد التالي،
+            # إلا إذا قُطع تشغيلها في المنتصف فنكمله الآن حتى لا يُتخطى باقي المستخدمين
+            if job["cron"] and job["run_at"] < now:
+                if "resume_after" in json.loads(job["payload"] or "{}"):
+                    job["run_at"] = now
+                else:
+                    job["run_at"] = cron_next(job["cron"], now)
+                self._save_job(job)
+            self._push(job)
+        logging.info("⏰ Loaded %d scheduled jobs", len(rows))
+
+    def add_job(self, kind: str, target: str, payload: dict, run_at: int = None, cron: str = None) -> int:
+        if kind not in self._handlers:
+            raise ValueError(f"Unknown job kind: {kind}")
+        now = int(time.time())
+        if cron:
+            run_at = cron_next(cron, now)
+        if run_at is None:
+            raise ValueError("run_at or cron is required")
+        payload_json = json.dumps(payload, ensure_ascii=False)
+        with closing(sqlite3.connect(DB_FILE)) as conn:
+            cur = conn.execute(
+                "INSERT INTO scheduled_jobs (kind, target, payload, run_at, cron, enabled, created_ts) VALUES (?, ?, ?, ?, ?, 1, ?)",
+                (kind, target, payload_json, run_at, cron, now),
+            )
+            conn.commit()
+            job_id = cur.lastrowid
+        self._push({
+            "id": job_id, "kind": kind, "target": target, "payload": payload_json,
+            "run_at": run_at, "cron": cron, "enabled": 1, "last_run_ts": None, "created_ts": now,
+        })
+        return job_id
+
+    def cancel_job(self, job_id: int) -> bool:
+        with closing(sqlite3.connect(DB_FILE)) as conn:
+            cur = conn.execute("UPDATE scheduled_jobs SET enabled = 0 WHERE id = ?", (job_id,))
+            conn.commit()
+        # العنصر يبقى في الكومة ويُتجاهل عند خروجه
+        self._jobs.pop(job_id, None)
+        return cur.rowcount > 0
+
+    def reload(self):
+        """إعادة تحميل المهام من قاعدة البيانات (بعد استعادة نسخة احتياطية)."""
+        self._jobs.clear()
+        self._heap.clear()
+        self.load_jobs()
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def list_jobs(self) -> list:
+        return sorted(self._jobs.values(), key=lambda j: j["run_at"])
+
+    def get_job(self, job_id: int) -> Optional[dict]:
+        return self._jobs.get(job_id)
+
+    def _save_job(self, job: dict):
+        with closing(sqlite3.connect(DB_FILE)) as conn:
+            conn.execute(
+                "UPDATE scheduled_jobs SET payload = ?, run_at = ?, cron = ?, enabled = ?, last_run_ts = ? WHERE id = ?",
+                (job["payload"], job["run_at"], job["cron"], job["enabled"], job["last_run_ts"], job["id"]),
+            )
+            conn.commit()
+
+    async def start(self, bot: Bot):
+        self.bot = bot
+        self._wakeup = asyncio.Event()
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.load_jobs()
+        self._loop_task = asyncio.create_task(self._run_loop())
+
+    async def _run_loop(self):
+        while True:
+            now = time.time()
+            while self._heap and self._heap[0][0] <= now:
+                run_at, job_id = heapq.heappop(self._heap)
+                job = self._jobs.get(job_id)
+                # مدخل قديم: المهمة أُلغيت أو أُعيدت جدولتها
+                if job is None or job["run_at"] != run_at:
+                    continue
+                task = asyncio.create_task(self._execute(job))
+                self._running.add(task)
+                task.add_done_callback(self._running.discard)
+
+            timeout = self._heap[0][0] - time.time() if self._heap else None
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def stop(self, timeout: float = 10.0):
+        if self._loop_task is not None:
+            self._loop_task.cancel()
+            await asyncio.gather(self._loop_task, return_exceptions=True)
+        if self._running:
+            _, pending = await asyncio.wait(self._running, timeout=timeout)
+            # المهام التي لم تنته تحفظ نقطة التوقف وتُستأنف بعد إعادة التشغيل
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    async def _execute(self, job: dict):
+        async with self._semaphore:
+            handler = self._handlers.get(job["kind"])
+            try:
+                if handler is None:
+                    raise ValueError(f"Unknown job kind: {job['kind']}")
+                await handler(self.bot, job)
+            except asyncio.CancelledError:
+                self._save_job(job)
+                logging.info("⏰ Job %s interrupted, checkpoint saved", job["id"])
+                raise
+            except Exception as e:
+                logging.exception("Scheduled job %s failed: %s", job["id"], e)
+
+        now = int(time.time())
+        job["last_run_ts"] = now
+        if job["cron"] and job["id"] in self._jobs:
+            job["run_at"] = cron_next(job["cron"], now)
+            self._save_job(job)
+            self._push(job)
+        else:
+            job["enabled"] = 0
+            self._jobs.pop(job["id"], None)
+            self._save_job(job)
+
+scheduler = JobScheduler()
+
+def target_user_ids(target: str, after_user_id: int = 0) -> list:
+    with closing(sqlite3.connect(DB_FILE)) as conn:
+        # المؤرشفون ما زالوا جمهوراً للمنشورات
+        if target == "all":
+            rows = conn.execute(
+                "SELECT user_id FROM subscriptions WHERE user_id > ? "
+                "UNION SELECT user_id FROM subscriptions_archive WHERE user_id > ? ORDER BY user_id",
+                (after_user_id, after_user_id),
+            ).fetchall()
+        else:
+            rows = conn.execute(
+                "SELECT user_id FROM subscriptions WHERE state = ? AND user_id > ? "
+                "UNION SELECT user_id FROM subscriptions_archive WHERE state = ? AND user_id > ? ORDER BY user_id",
+                (target, after_user_id, target, after_user_id),
+            ).fetchall()
+    return [row[0] for row in rows]
+
+async def run_broadcast_job(bot: Bot, job: dict):
+    payload = json.loads(job["payload"])
+    # resume_after: آخر مستخدم وصله المنشور قبل انقطاع سابق (إعادة تشغيل)
+    last_user_id = payload.get("resume_after", 0)
+    user_ids = await asyncio.to_thread(target_user_ids, job["target"], last_user_id)
+    sent = 0
+    try:
+        for user_id in user_ids:
+            try:
+                await bot.copy_message(user_id, payload["from_chat_id"], payload["message_id"])
+                sent += 1
+            except TelegramRetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+                try:
+                    await bot.copy_message(user_id, payload["from_chat_id"], payload["message_id"])
+                    sent += 1
+                except Exception as e2:
+                    logging.warning("فشل إرسال المنشور المجدول لـ %s: %s", user_id, e2)
+            except Exception as e:
+                logging.warning("فشل إرسال المنشور المجدول لـ %s: %s", user_id, e)
+            last_user_id = user_id
+            await asyncio.sleep(BROADCAST_DELAY)
+    except asyncio.CancelledError:
+        payload["resume_after"] = last_user_id
+        job["payload"] = json.dumps(payload, ensure_ascii=False)
+        raise
+    payload.pop("resume_after", None)
+    job["payload"] = json.dumps(payload, ensure_ascii=False)
+    logging.info("⏰ Job %s sent to %d/%d users", job["id"], sent, len(user_ids))
+
+scheduler.register("broadcast", run_broadcast_job, label="📣 منشور")
+
+# مهام النظام (المطابقة، النسخ، الأرشفة) يعيد ensure_job إنشاءها عند كل تشغيل، فلا تُلغى من اللوحة
+CANCELLABLE_JOB_KINDS = {"broadcast"}
+
+def describe_job(job: dict) -> str:
+    when = job["cron"] or time.strftime('%Y-%m-%d %H:%M', time.localtime(job["run_at"]))
+    next_run = time.strftime('%Y-%m-%d %H:%M', time.localtime(job["run_at"]))
+    if job["kind"] == "broadcast":
+        label = BROADCAST_TARGETS.get(job["target"], job["target"])
+    else:
+        label = scheduler.labels.get(job["kind"], job["kind"])
+    return f"#{job['id']} | {label} | <code>{when}</code> | التالي: {next_run}"
+
+@router.callback_query(F.data == "sched_list")
+async def admin_scheduled_jobs(cq: CallbackQuery):
+    if cq.from_user.id != ADMIN_ID:
+        await cq.answer("🚫 غير مصرح", show_alert=True)
+        return
+    jobs = scheduler.list_jobs()
+    text = "⏰ <b>المنشورات المجدولة</b>\n\n"
+    text += "\n".join(describe_job(job) for job in jobs) if jobs else "لا توجد منشورات مجدولة."
+    kb = [
+        [InlineKeyboardButton(text=f"🗑 إلغاء #{job['id']}", callback_data=f"sched_cancel_{job['id']}")]
+        for job in jobs if job["kind"] in CANCELLABLE_JOB_KINDS
+    ]
+    kb.append([InlineKeyboardButton(text="➕ جدولة منشور جديد", callback_data="sched_new")])
+    kb.append([InlineKeyboardButton(text="🔙 رجوع", callback_data="admin_panel")])
+    await cq.message.edit_text(text, reply_markup=InlineKeyboardMarkup(inline_keyboard=kb))
+    await cq.answer()
+
+@router.callback_query(F.data.startswith("sched_cancel_"))
+async def admin_cancel_scheduled_job(cq: CallbackQuery):
+    if cq.from_user.id != ADMIN_ID:
+        await cq.answer("🚫 غير مصرح", show_alert=True)
+        return
+    job_id = int(cq.data.split("_")[2])
+    job = scheduler.get_job(job_id)
+    if job is not None and job["kind"] not in CANCELLABLE_JOB_KINDS:
+        await cq.answer("⚠️ هذه مهمة نظام ولا يمكن إلغاؤها.", show_alert=True)
+        return
+    scheduler.cancel_job(job_id)
+    await cq.answer(f"🗑 تم إلغاء المنشور #{job_id}")
+    await admin_scheduled_jobs(cq)
+
+@router.callback_query(F.data == "sched_new")
+async def admin_new_scheduled_job(cq: CallbackQuery, state: FSMContext):
+    if cq.from_user.id != ADMIN_ID:
+        await cq.answer("🚫 غير مصرح", show_alert=True)
+        return
+    kb = [[InlineKeyboardButton(text=label, callback_data=f"sched_target_{key}")] for key, label in BROADCAST_TARGETS.items()]
+    kb.append([InlineKeyboardButton(text="🔙 رجوع", callback_data="sched_list")])
+    await cq.message.edit_text("👥 اختر الفئة المستهدفة:", reply_markup=InlineKeyboardMarkup(inline_keyboard=kb))
+    await cq.answer()
+
+@router.callback_query(F.data.startswith("sched_target_"))
+async def admin_scheduled_job_target(cq: CallbackQuery, state: FSMContext):
+    if cq.from_user.id != ADMIN_ID:
+        await cq.answer("🚫 غير مصرح", show_alert=True)
+        return
+    await state.update_data(sched_target=cq.data.split("sched_target_")[1])
+    await cq.message.edit_text(
+        "🕒 أرسل موعد النشر:\n\n"
+        "• مرة واحدة: <code>2025-01-31 09:00</code>\n"
+        "• متكرر (cron): <code>0 9 * * 1-5</code> (كل يوم عمل الساعة 9)"
+    )
+    await state.set_state(Flow.schedule_time_waiting)
+    await cq.answer()
+
+@router.message(Flow.schedule_time_waiting)
+async def admin_scheduled_job_time(message: Message, state: FSMContext):
+    if message.from_user.id != ADMIN_ID:
+        return
+    value = (message.text or "").strip()
+    run_at, cron = None, None
+    try:
+        run_at = int(datetime.strptime(value, "%Y-%m-%d %H:%M").timestamp())
+    except ValueError:
+        try:
+            cron_next(value, int(time.time()))
+            cron = value
+        except ValueError:
+            await message.answer("❌ صيغة غير صحيحة. أعد المحاولة:")
+            return
+    if run_at is not None and run_at <= int(time.time()):
+        await message.answer("❌ هذا الموعد مضى بالفعل. أرسل موعدًا في المستقبل:")
+        return
+    await state.update_data(sched_run_at=run_at, sched_cron=cron)
+    await message.answer("✉️ أرسل الآن المنشور (نص أو صورة أو ملف):")
+    await state.set_state(Flow.schedule_message_waiting)
+
+@router.message(Flow.schedule_message_waiting)
+async def admin_scheduled_job_message(message: Message, state: FSMContext):
+    if message.from_user.id != ADMIN_ID:
+        return
+    data = await state.get_data()
+    job_id = scheduler.add_job(
+        "broadcast",
+        data["sched_target"],
+        {"from_chat_id": message.chat.id, "message_id": message.message_id},
+        run_at=data.get("sched_run_at"),
+        cron=data.get("sched_cron"),
+    )
+    await message.answer(f"✅ تمت جدولة المنشور #{job_id}.", reply_markup=admin_keyboard())
+    await state.set_state(Flow.choosing_subscription)
+
+# ---------------------- مطابقة أعضاء القناة الخاصة ----------------------
+RECONCILE_CRON = os.getenv("RECONCILE_CRON", "30 */6 * * *")
+RECONCILE_BATCH_SIZE = 20
+RECONCILE_BATCH_PAUSE = 1.0
+
+def _is_channel_member(member) -> bool:
+    if member.status in (ChatMemberStatus.MEMBER, ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.CREATOR):
+        return True
+    return member.status == ChatMemberStatus.RESTRICTED and getattr(member, "is_member", False)
+
+def load_known_user_ids() -> list:
+    with closing(sqlite3.connect(DB_FILE)) as conn:
+        return conn.execute(
+            "SELECT user_id FROM subscriptions UNION SELECT user_id FROM subscriptions_archive ORDER BY user_id"
+        ).fetchall()
+
+async def reconcile_channel_members(bot: Bot, job: dict = None) -> Counter:
+    """
+    يفحص كل المستخدمين المعروفين عبر get_chat_member على دفعات:
+    يطرد الأعضاء غير المشتركين ويعد المشتركين النشطين الذين لم ينضموا بعد.
+    """
+    report = Counter()
+    if not PRIVATE_CHANNEL_ID:
+        return report
+    channel_id = int(PRIVATE_CHANNEL_ID)
+    rows = await asyncio.to_thread(load_known_user_ids)
+
+    for i, (user_id,) in enumerate(rows):
+        if i and i % RECONCILE_BATCH_SIZE == 0:
+            await asyncio.sleep(RECONCILE_BATCH_PAUSE)
+        try:
+            member = await bot.get_chat_member(channel_id, user_id)
+        except TelegramRetryAfter as e:
+            await asyncio.sleep(e.retry_after)
+            try:
+                member = await bot.get_chat_member(channel_id, user_id)
+            except Exception as e2:
+                logging.warning("فشل فحص عضوية %s: %s", user_id, e2)
+                report["errors"] += 1
+                continue
+        except Exception as e:
+            logging.warning("فشل فحص عضوية %s: %s", user_id, e)
+            report["errors"] += 1
+            continue
+
+        report["checked"] += 1
+        if not _is_channel_member(member):
+            if user_id in active_user_ids:
+                report["active_not_joined"] += 1
+            continue
+        if not is_channel_access_allowed(user_id, member.status):
+            report["unauthorized"] += 1
+            await lifecycle.critical(kick_from_channel(bot, user_id))
+
+    logging.info("🔄 Channel reconciliation: %s", dict(report))
+    if report["unauthorized"] or job is None:
+        try:
+            await bot.send_message(
+                ADMIN_ID,
+                "🔄 <b>مطابقة أعضاء القناة</b>\n\n"
+                f"🔍 تم الفحص: <code>{report['checked']}</code>\n"
+                f"🚷 أعضاء غير مشتركين (تم طردهم): <code>{report['unauthorized']}</code>\n"
+                f"⏳ مشتركون لم ينضموا بعد: <code>{report['active_not_joined']}</code>\n"
+                f"⚠️ أخطاء: <code>{report['errors']}</code>"
+            )
+        except Exception as e:
+            logging.warning("فشل إرسال تقرير المطابقة: %s", e)
+    return report
+
+scheduler.register("reconcile_channel", reconcile_channel_members, label="🔄 مطابقة أعضاء القناة")
+
+@router.message(F.text == "/reconcile")
+async def reconcile_command(message: Message, bot: Bot):
+    if message.from_user.id != ADMIN_ID:
+        return
+    if not PRIVATE_CHANNEL_ID:
+        await message.answer("❌ PRIVATE_CHANNEL_ID غير محدد.")
+        return
+    await message.answer("🔄 جاري فحص أعضاء القناة...")
+    lifecycle.spawn(reconcile_channel_members(bot), name="reconcile_channel")
+
+# ---------------------- التحقق التلقائي من الدفع على الشبكة ----------------------
+AUTO_VERIFY_PAYMENTS = os.getenv("AUTO_VERIFY_PAYMENTS", "0") == "1"
+PAYMENT_POLL_INTERVAL = int(os.getenv("PAYMENT_POLL_INTERVAL", "30"))
+CHECKOUT_TTL = int(os.getenv("CHECKOUT_TTL_HOURS", "24")) * 3600
+TRON_API_URL = os.getenv("TRON_API_URL", "https://api.trongrid.io").rstrip("/")
+TRON_API_KEY = os.getenv("TRON_API_KEY")
+ETHERSCAN_API_URL = os.getenv("ETHERSCAN_API_URL", "https://api.etherscan.io/api")
+ETHERSCAN_API_KEY = os.getenv("ETHERSCAN_API_KEY")
+TRANSFER_PAGE_SIZE = 200
+# حد أعلى للصفحات في الدورة الواحدة، والباقي يُكمل من المؤشر في الدورة التالية
+TRANSFER_MAX_PAGES = int(os.getenv("TRANSFER_MAX_PAGES", "10"))
+
+AMOUNT_DECIMALS = 6  # USDT/USDC على TRC20 و ERC20
+# عقود العملات المعتمدة فقط: الرمز (symbol) وحده يمكن تزويره
+TOKEN_CONTRACTS = {
+    ("TRC20", "USDT"): "TR7NHqjeKQxGTCi8q8ZY4pL8otSzgjLj6t",
+    ("TRC20", "USDC"): "TEkxiTehnzSmSe2XqrBj4w32RUN966rdz8",
+    ("ERC20", "USDT"): "0xdAC17F958D2ee523a2206206994597C13D831ec7",
+    ("ERC20", "USDC"): "0xA0b86991c6218b36c1d19D4a2e9Eb0cE3606eB48",
+}
+CONTRACT_TOKENS = {(network, contract.lower()): token for (network, token), contract in TOKEN_CONTRACTS.items()}
+CHECKOUT_COLUMNS = ["id", "user_id", "method", "network", "token", "address", "duration_months", "amount_units", "created_ts"]
+
+def parse_crypto_method(method: str) -> Optional[Tuple[str, str]]:
+    """'USDT TRC20' -> ('USDT', 'TRC20')، أو None إذا لم تكن طريقة دفع مدعومة للتحقق التلقائي."""
+    parts = method.upper().split()
+    if len(parts) == 2 and (parts[1], parts[0]) in TOKEN_CONTRACTS:
+        return parts[0], parts[1]
+    return None
+
+def format_amount(amount_units: int) -> str:
+    return f"{amount_units / 10 ** AMOUNT_DECIMALS:.2f}"
+
+def create_checkout(user_id: int, method: str, address: str, duration_months: int) -> Optional[dict]:
+    """
+    ينشئ طلب دفع بمبلغ فريد (السعر + سنتات مميزة) لكل عنوان وعملة،
+    حتى يمكن ربط التحويل بالمستخدم دون الحاجة لمذكرة.
+    """
+    parsed = parse_crypto_method(method)
+    price = PLAN_PRICES_USD.get(duration_months)
+    if not parsed or not price:
+        return None
+    token, network = parsed
+    now = int(time.time())
+    with closing(sqlite3.connect(DB_FILE, isolation_level=None)) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("UPDATE payment_checkouts SET status = 'expired' WHERE status = 'open' AND expires_ts < ?", (now,))
+            row = conn.execute(
+                f"SELECT {', '.join(CHECKOUT_COLUMNS)} FROM payment_checkouts "
+                "WHERE status = 'open' AND user_id = ? AND method = ? AND address = ? AND duration_months = ?",
+                (user_id, method, address, duration_months),
+            ).fetchone()
+            if row:
+                conn.execute("COMMIT")
+                return dict(zip(CHECKOUT_COLUMNS, row))
+
+            base = price * 10 ** AMOUNT_DECIMALS
+            cent = 10 ** (AMOUNT_DECIMALS - 2)
+            taken = {r[0] for r in conn.execute(
+                "SELECT amount_units FROM payment_checkouts WHERE status = 'open' AND address = ? AND token = ?",
+                (address, token),
+            )}
+            amount_units = next((base + k * cent for k in range(1, 1000) if base + k * cent not in taken), None)
+            if amount_units is None:
+                conn.execute("ROLLBACK")
+                logging.warning("⚠️ No free unique amount left for %s %s", method, price)
+                return None
+            cur = conn.execute(
+                "INSERT INTO payment_checkouts (user_id, method, network, token, address, duration_months, amount_units, status, created_ts, expires_ts) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, 'open', ?, ?)",
+                (user_id, method, network, token, address, duration_months, amount_units, now, now + CHECKOUT_TTL),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    return dict(zip(CHECKOUT_COLUMNS, (cur.lastrowid, user_id, method, network, token, address, duration_months, amount_units, now)))
+
+def load_open_checkouts() -> list:
+    now = int(time.time())
+    with closing(sqlite3.connect(DB_FILE)) as conn:
+        conn.execute("UPDATE payment_checkouts SET status = 'expired' WHERE status = 'open' AND expires_ts < ?", (now,))
+        conn.commit()
+        rows = conn.execute(
+            f"SELECT {', '.join(CHECKOUT_COLUMNS)} FROM payment_checkouts WHERE status = 'open'"
+        ).fetchall()
+    return [dict(zip(CHECKOUT_COLUMNS, row)) for row in rows]
+
+@traced("db")
+def settle_checkout_tx(checkout: dict, tx_hash: str) -> Optional[Tuple[Subscription, bool]]:
+    """
+    يعلّم الطلب مدفوعاً ويفعّل الاشتراك في معاملة واحدة: إما أن يحدث الاثنان أو لا شيء،
+    فيبقى الطلب مفتوحاً ويُعاد فحصه في الدورة التالية. يعيد None إذا عولج الطلب أو المعاملة من قبل.
+    """
+    now = int(time.time())
+    with closing(sqlite3.connect(DB_FILE, isolation_level=None)) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            cur = conn.execute(
+                "UPDATE payment_checkouts SET status = 'paid', tx_hash = ?, paid_ts = ? WHERE id = ? AND status = 'open'",
+                (tx_hash, now, checkout["id"]),
+            )
+            if cur.rowcount != 1:
+                conn.execute("ROLLBACK")
+                return None
+            sub, renewal = activate_in_transaction(
+                conn, checkout["user_id"], checkout["duration_months"], checkout["method"], now,
+            )
+            conn.execute("COMMIT")
+        except sqlite3.IntegrityError:
+            # نفس المعاملة استُخدمت مسبقًا لطلب آخر
+            conn.execute("ROLLBACK")
+            return None
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    on_subscription_written(sub)
+    return sub, renewal
+
+def load_payment_cursor(network: str, address: str) -> Optional[Tuple[int, int]]:
+    with closing(sqlite3.connect(DB_FILE)) as conn:
+        return conn.execute(
+            "SELECT position, position_ts FROM payment_cursors WHERE network = ? AND address = ?", (network, address),
+        ).fetchone()
+
+def save_payment_cursor(network: str, address: str, position: int, position_ts: int):
+    with closing(sqlite3.connect(DB_FILE)) as conn:
+        conn.execute(
+            "INSERT INTO payment_cursors (network, address, position, position_ts) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(network, address) DO UPDATE SET position = excluded.position, position_ts = excluded.position_ts",
+            (network, address, position, position_ts),
+        )
+        conn.commit()
+
+async def fetch_trc20_transfers(session: aiohttp.ClientSession, address: str, since_ts: int, position: Optional[int] = None) -> list:
+    """التحويلات الواردة بترتيب تصاعدي من position (طابع الكتلة بالملي ثانية) عبر كل الصفحات."""
+    headers = {"TRON-PRO-API-KEY": TRON_API_KEY} if TRON_API_KEY else {}
+    params = {
+        "only_to": "true", "only_confirmed": "true", "order_by": "block_timestamp,asc",
+        "min_timestamp": max(position or 0, since_ts * 1000), "limit": TRANSFER_PAGE_SIZE,
+    }
+    transfers = []
+    for _ in range(TRANSFER_MAX_PAGES):
+        async with session.get(f"{TRON_API_URL}/v1/accounts/{address}/transactions/trc20", params=params, headers=headers) as resp:
+            resp.raise_for_status()
+            data = await resp.json()
+        for item in data.get("data", []):
+            if item.get("to") != address:
+                continue
+            info = item.get("token_info") or {}
+            transfers.append({
+                "tx_hash": item["transaction_id"],
+                "contract": (info.get("address") or "").lower(),
+                "decimals": int(info.get("decimals", AMOUNT_DECIMALS)),
+                "value": int(item["value"]),
+                "ts": int(item["block_timestamp"]) // 1000,
+                "position": int(item["block_timestamp"]),
+            })
+        fingerprint = (data.get("meta") or {}).get("fingerprint")
+        if not fingerprint:
+            break
+        params["fingerprint"] = fingerprint
+    return transfers
+
+async def etherscan_get(session: aiohttp.ClientSession, params: dict):
+    if ETHERSCAN_API_KEY:
+        params = {**params, "apikey": ETHERSCAN_API_KEY}
+    async with session.get(ETHERSCAN_API_URL, params=params) as resp:
+        resp.raise_for_status()
+        data = await resp.json(content_type=None)
+    result = data.get("result")
+    if data.get("status") != "1":
+        # status=0 مع "No transactions found" أو رسالة خطأ نصية
+        if data.get("message") != "No transactions found":
+            raise RuntimeError(f"Explorer error: {data.get('message')} {result}")
+        return []
+    return result
+
+async def fetch_erc20_transfers(session: aiohttp.ClientSession, address: str, since_ts: int, position: Optional[int] = None) -> list:
+    """التحويلات الواردة بترتيب تصاعدي من position (رقم الكتلة) عبر كل الصفحات."""
+    if position is None:
+        position = int(await etherscan_get(session, {
+            "module": "block", "action": "getblocknobytime", "timestamp": since_ts, "closest": "before",
+        }))
+    params = {
+        "module": "account", "action": "tokentx", "address": address,
+        "startblock": position, "sort": "asc", "offset": TRANSFER_PAGE_SIZE,
+    }
+    transfers = []
+    for page in range(1, TRANSFER_MAX_PAGES + 1):
+        params["page"] = page
+        result = await etherscan_get(session, params)
+        for item in result:
+            ts = int(item["timeStamp"])
+            if ts < since_ts or item.get("to", "").lower() != address.lower():
+                continue
+            transfers.append({
+                "tx_hash": item["hash"],
+                "contract": item.get("contractAddress", "").lower(),
+                "decimals": int(item.get("tokenDecimal", AMOUNT_DECIMALS)),
+                "value": int(item["value"]),
+                "ts": ts,
+                "position": int(item["blockNumber"]),
+            })
+        if len(result) < TRANSFER_PAGE_SIZE:
+            break
+    return transfers
+
+TRANSFER_FETCHERS = {"TRC20": fetch_trc20_transfers, "ERC20": fetch_erc20_transfers}
+
+async def fetch_new_transfers(session: aiohttp.ClientSession, network: str, address: str, since_ts: int) -> list:
+    """يكمل من آخر مؤشر محفوظ للعنوان، إلا إذا كان أقدم من أقدم طلب مفتوح فيبدأ من الطلب مباشرة."""
+    cursor = await asyncio.to_thread(load_payment_cursor, network, address)
+    position = cursor[0] if cursor and cursor[1] >= since_ts else None
+    return await TRANSFER_FETCHERS[network](session, address, since_ts, position)
+
+settle_failures_alerted: set = set()
+
+async def settle_checkout(bot: Bot, checkout: dict, tx_hash: str) -> bool:
+    user_id = checkout["user_id"]
+    # المعاملة تقرأ الصف من القرص مباشرة، فنكتب التعديلات المعلقة أولًا
+    await write_queue.flush()
+    try:
+        settled = await asyncio.to_thread(settle_checkout_tx, checkout, tx_hash)
+    except Exception:
+        # الطلب يبقى مفتوحاً وسيُعاد فحصه، والمشرف يُنبَّه مرة واحدة فقط
+        logging.exception("Failed to settle checkout %s (tx %s)", checkout["id"], tx_hash)
+        if checkout["id"] not in settle_failures_alerted:
+            settle_failures_alerted.add(checkout["id"])
+            try:
+                await bot.send_message(
+                    ADMIN_ID,
+                    f"🚨 تم رصد دفع للطلب {checkout['id']} (المستخدم {user_id}) لكن تعذر التفعيل، سيُعاد المحاولة تلقائياً.\n"
+                    f"🔗 المعاملة: <code>{tx_hash}</code>"
+                )
+            except Exception as e:
+                logging.warning("فشل إرسال إشعار الدفع للمشرف: %s", e)
+        raise
+    if settled is None:
+        return False
+    settle_failures_alerted.discard(checkout["id"])
+    sub, renewal = settled
+    if renewal:
+        # عضو حالي في القناة: لا حاجة لحجز رابط دعوة جديد
+        await send_renewal_notice(bot, sub)
+    else:
+        await send_activation_link(bot, user_id, get_channel_link().strip())
+    logging.info("💰 Checkout %s paid by tx %s (user %s)", checkout["id"], tx_hash, user_id)
+    try:
+        await bot.send_message(
+            ADMIN_ID,
+            f"💰 دفع تلقائي مؤكد!\n"
+            f"🆔 المستخدم: {user_id}\n"
+            f"📅 المدة: {checkout['duration_months']} شهر\n"
+            f"🏦 الطريقة: {checkout['method']}\n"
+            f"💵 المبلغ: {format_amount(checkout['amount_units'])} {checkout['token']}\n"
+            f"🔗 المعاملة: <code>{tx_hash}</code>\n"
+            f"{'🔁 تم التجديد' if renewal else '✅ تم التفعيل'} حتى {sub.end_date}"
+        )
+    except Exception as e:
+        logging.warning("فشل إرسال إشعار الدفع للمشرف: %s", e)
+    return True
+
+async def check_pending_payments(bot: Bot, session: aiohttp.ClientSession) -> int:
+    started = int(time.time())
+    checkouts = await asyncio.to_thread(load_open_checkouts)
+    if not checkouts:
+        return 0
+
+    # طلب واحد لكل عنوان محفظة مهما كان عدد المستخدمين المنتظرين عليه
+    groups: Dict[Tuple[str, str], list] = defaultdict(list)
+    for checkout in checkouts:
+        groups[(checkout["network"], checkout["address"])].append(checkout)
+    keys = list(groups)
+    results = await asyncio.gather(
+        *[fetch_new_transfers(session, network, address, min(c["created_ts"] for c in groups[(network, address)]))
+          for network, address in keys],
+        return_exceptions=True,
+    )
+
+    settled = 0
+    for (network, address), transfers in zip(keys, results):
+        if isinstance(transfers, Exception):
+            logging.warning("فشل جلب التحويلات لـ %s %s: %s", network, address, transfers)
+            continue
+        by_amount = {(c["token"], c["amount_units"]): c for c in groups[(network, address)]}
+        # المؤشر لا يتجاوز أول تحويل لم يُحسم: تسوية فشلت، أو تحويل أحدث من قائمة الطلبات المحملة
+        # (قد يخص طلباً أُنشئ بعد تحميلها)
+        hold = None
+        for transfer in transfers:
+            if hold is None and transfer["ts"] >= started:
+                hold = transfer
+            token = CONTRACT_TOKENS.get((network, transfer["contract"]))
+            amount_units = transfer["value"] * 10 ** AMOUNT_DECIMALS // 10 ** transfer["decimals"]
+            checkout = by_amount.get((token, amount_units))
+            if checkout is None or transfer["ts"] < checkout["created_ts"]:
+                continue
+            try:
+                # وسم الطلب كمدفوع والتفعيل لا يُقطعان في المنتصف عند الإيقاف
+                if await lifecycle.critical(settle_checkout(bot, checkout, transfer["tx_hash"])):
+                    settled += 1
+            except Exception:
+                hold = hold or transfer
+                continue
+            by_amount.pop((token, amount_units), None)
+        if transfers:
+            # التحويلات مرتبة تصاعدياً والجلب يشمل المؤشر نفسه، فلا يضيع تحويل يشاركه نفس الكتلة
+            last = hold or transfers[-1]
+            await asyncio.to_thread(save_payment_cursor, network, address, last["position"], last["ts"])
+    return settled
+
+async def payment_watcher(bot: Bot):
+    timeout = aiohttp.ClientTimeout(total=20)
+    async with aiohttp.ClientSession(timeout=timeout) as session:
+        while True:
+            try:
+                await check_pending_payments(bot, session)
+            except Exception as e:
+                logging.exception("Payment watcher error: %s", e)
+            await asyncio.sleep(PAYMENT_POLL_INTERVAL)
+
+# ---------------------- جلب أخبار الفوركس ونشرها ----------------------
+NEWS_ENABLED = os.getenv("NEWS_ENABLED", "0") == "1"
+NEWS_POLL_INTERVAL = int(os.getenv("NEWS_POLL_INTERVAL", "120"))
+NEWS_MAX_AGE = int(os.getenv("NEWS_MAX_AGE_HOURS", "12")) * 3600
+NEWS_CALENDAR_LOOKAHEAD = int(os.getenv("NEWS_CALENDAR_LOOKAHEAD_HOURS", "24")) * 3600
+# تيليجرام يسمح بحوالي 20 رسالة في الدقيقة للقناة الواحدة
+NEWS_SEND_INTERVAL = float(os.getenv("NEWS_SEND_INTERVAL", "3"))
+NEWS_INDEX_RETENTION = 30 * 24 * 3600
+NEWS_TIERS = ("free", "premium")
+
+@traced("file")
+def load_news_feeds() -> list:
+    try:
+        with open(NEWS_FEEDS_FILE, "r", encoding="utf-8") as f:
+            feeds = json.load(f)
+    except Exception as e:
+        logging.error("❌ Failed to load news feeds: %s", e)
+        return []
+    valid = []
+    for feed in feeds if isinstance(feeds, list) else []:
+        if feed.get("url") and feed.get("kind", "rss") in ("rss", "calendar") and feed.get("tier", "free") in NEWS_TIERS:
+            valid.append(feed)
+        else:
+            logging.warning("⚠️ Ignoring invalid news feed entry: %s", feed)
+    return valid
+
+def news_chat_for(tier: str):
+    """القناة العامة للأخبار المجانية والخاصة للمميزة، أو None إذا لم تُضبط."""
+    if tier == "premium":
+        return int(PRIVATE_CHANNEL_ID) if PRIVATE_CHANNEL_ID else None
+    channel = PUBLIC_CHANNEL_USERNAME.strip()
+    if channel.lstrip("-").isdigit():
+        return int(channel)
+    if channel.startswith("@"):
+        return channel
+    # اسم المستخدم كما في رابط t.me، وأي اسم عرض بمسافات لا يصلح للإرسال
+    return f"@{channel}" if channel.replace("_", "").isalnum() else None
+
+def news_hash(*parts) -> str:
+    return hashlib.sha256("\x1f".join(str(p).strip().lower() for p in parts).encode("utf-8")).hexdigest()[:32]
+
+def _parse_feed_time(value: Optional[str]) -> Optional[int]:
+    if not value:
+        return None
+    try:
+        return int(parsedate_to_datetime(value).timestamp())
+    except (TypeError, ValueError, IndexError):
+        pass
+    try:
+        return int(datetime.fromisoformat(value.strip().replace("Z", "+00:00")).timestamp())
+    except ValueError:
+        return None
+
+def _xml_child(node, *names) -> Optional[str]:
+    for child in node:
+        if child.tag.rsplit("}", 1)[-1] in names:
+            if child.text and child.text.strip():
+                return child.text.strip()
+            if child.get("href"):
+                return child.get("href")
+    return None
+
+def parse_rss(body: bytes) -> list:
+    """RSS 2.0 و Atom: عنصر item أو entry لكل خبر."""
+    root = ElementTree.fromstring(body)
+    items = []
+    for node in root.iter():
+        if node.tag.rsplit("}", 1)[-1] not in ("item", "entry"):
+            continue
+        title = _xml_child(node, "title")
+        link = _xml_child(node, "link")
+        if not title:
+            continue
+        guid = _xml_child(node, "guid", "id") or link or title
+        items.append({
+            "hash": news_hash(guid),
+            "title": title,
+            "link": link,
+            "published_ts": _parse_feed_time(_xml_child(node, "pubDate", "published", "updated")),
+        })
+    return items
+
+def parse_calendar(body: bytes, impacts: Optional[list] = None) -> list:
+    """تقويم اقتصادي بصيغة JSON (مثل ff_calendar_thisweek.json): title, country, date, impact, forecast, previous."""
+    events = json.loads(body)
+    wanted = {i.lower() for i in impacts} if impacts else None
+    items = []
+    for event in events if isinstance(events, list) else []:
+        title, when = event.get("title"), _parse_feed_time(event.get("date"))
+        if not title or not when:
+            continue
+        impact = event.get("impact") or ""
+        if wanted and impact.lower() not in wanted:
+            continue
+        items.append({
+            "hash": news_hash(event.get("country", ""), title, event.get("date")),
+            "title": title,
+            "link": None,
+            "published_ts": when,
+            "country": event.get("country", ""),
+            "impact": impact,
+            "forecast": event.get("forecast") or "-",
+            "previous": event.get("previous") or "-",
+        })
+    return items
+
+def format_news_item(item: dict, tier: str) -> str:
+    title = html.escape(item["title"])
+    if "impact" in item:
+        when = time.strftime('%Y-%m-%d %H:%M', time.gmtime(item["published_ts"]))
+        text = (
+            f"🗓 <b>{html.escape(item['country'])} — {title}</b>\n"
+            f"⏰ {when} UTC | ⚠️ {html.escape(item['impact'])}\n"
+            f"📊 التوقع: {html.escape(str(item['forecast']))} | السابق: {html.escape(str(item['previous']))}"
+        )
+    else:
+        text = f"📰 <b>{title}</b>"
+        if item.get("link"):
+            text += f"\n🔗 <a href=\"{html.escape(item['link'], quote=True)}\">التفاصيل</a>"
+    return f"💎 {text}" if tier == "premium" else text
+
+def load_feed_state() -> Dict[str, Tuple[Optional[str], Optional[str]]]:
+    with closing(sqlite3.connect(DB_FILE)) as conn:
+        rows = conn.execute("SELECT url, etag, last_modified FROM news_feed_state").fetchall()
+    return {url: (etag, last_modified) for url, etag, last_modified in rows}
+
+@traced("db")
+def index_news_items(feed: dict, items: list, etag: Optional[str], last_modified: Optional[str], now: int = None) -> list:
+    """
+    يسجل العناصر في فهرس الأخبار (المفتاح هو الهاش) ويعيد الجديدة المنتظرة للنشر.
+    أول جلب لأي مصدر يملأ الفهرس دون نشر حتى لا تُغرق القناة بأرشيف المصدر.
+    """
+    now = now or int(time.time())
+    tier = feed.get("tier", "free")
+    fresh = []
+    with closing(sqlite3.connect(DB_FILE, isolation_level=None)) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            seeding = conn.execute("SELECT 1 FROM news_feed_state WHERE url = ?", (feed["url"],)).fetchone() is None
+            for item in items:
+                published = item["published_ts"] or now
+                if feed.get("kind") == "calendar":
+                    # الأحداث البعيدة لا تُسجل الآن حتى تُنشر عند اقترابها
+                    if published > now + NEWS_CALENDAR_LOOKAHEAD or published < now - NEWS_MAX_AGE:
+                        continue
+                skip = seeding or published < now - NEWS_MAX_AGE
+                cur = conn.execute(
+                    "INSERT OR IGNORE INTO news_items (hash, feed, tier, title, body, published_ts, seen_ts, posted_ts) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        item["hash"], feed.get("name") or feed["url"], tier, item["title"],
+                        format_news_item(item, tier), published, now, now if skip else None,
+                    ),
+                )
+                if cur.rowcount == 1 and not skip:
+                    fresh.append(item)
+            conn.execute(
+                "INSERT INTO news_feed_state (url, etag, last_modified, last_fetch_ts) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(url) DO UPDATE SET etag = excluded.etag, last_modified = excluded.last_modified, "
+                "last_fetch_ts = excluded.last_fetch_ts",
+                (feed["url"], etag, last_modified, now),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    if seeding and items:
+        logging.info("📰 Seeded news index for %s with %d items", feed["url"], len(items))
+    return fresh
+
+@traced("db")
+def load_unposted_news(now: int = None) -> list:
+    """الأخبار التي لم تُنشر بعد (جديدة أو فشل إرسالها سابقاً) ما دامت حديثة."""
+    now = now or int(time.time())
+    with closing(sqlite3.connect(DB_FILE)) as conn:
+        conn.execute("DELETE FROM news_items WHERE seen_ts < ?", (now - NEWS_INDEX_RETENTION,))
+        conn.commit()
+        return conn.execute(
+            "SELECT hash, tier, body FROM news_items WHERE posted_ts IS NULL AND seen_ts >= ? "
+            "ORDER BY published_ts, seen_ts",
+            (now - NEWS_MAX_AGE,),
+        ).fetchall()
+
+@traced("db")
+def mark_news_posted(item_hash: str, chat):
+    with closing(sqlite3.connect(DB_FILE)) as conn:
+        conn.execute("UPDATE news_items SET posted_ts = ?, chat = ? WHERE hash = ?", (int(time.time()), str(chat), item_hash))
+        conn.commit()
+
+async def fetch_feed(session: aiohttp.ClientSession, feed: dict, state: Tuple[Optional[str], Optional[str]]):
+    """GET شرطي: يعيد (العناصر، etag، last_modified) أو None عند 304 Not Modified."""
+    etag, last_modified = state
+    if feed.get("kind") == "calendar":
+        # الأحداث البعيدة تُتخطى حتى تقترب، فيجب إعادة تحليل التقويم حتى لو لم يتغير
+        etag = last_modified = None
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    async with session.get(feed["url"], headers=headers) as resp:
+        if resp.status == 304:
+            return None
+        resp.raise_for_status()
+        body = await resp.read()
+        etag, last_modified = resp.headers.get("ETag"), resp.headers.get("Last-Modified")
+    if feed.get("kind") == "calendar":
+        items = await asyncio.to_thread(parse_calendar, body, feed.get("impacts"))
+    else:
+        items = await asyncio.to_thread(parse_rss, body)
+    return items, etag, last_modified
+
+class ChannelSender:
+    """يرسل لكل قناة بالترتيب مع فاصل زمني ثابت، والقنوات المختلفة بالتوازي، ويحترم RetryAfter."""
+
+    def __init__(self, interval: float = NEWS_SEND_INTERVAL):
+        self.interval = interval
+        self._locks: Dict[Any, asyncio.Lock] = defaultdict(asyncio.Lock)
+        self._last_sent: Dict[Any, float] = {}
+
+    async def send(self, bot: Bot, chat, text: str) -> bool:
+        async with self._locks[chat]:
+            wait = self._last_sent.get(chat, 0.0) + self.interval - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            try:
+                try:
+                    await bot.send_message(chat, text, disable_web_page_preview=True)
+                except TelegramRetryAfter as e:
+                    await asyncio.sleep(e.retry_after)
+                    await bot.send_message(chat, text, disable_web_page_preview=True)
+                return True
+            except Exception as e:
+                logging.warning("فشل نشر الخبر في %s: %s", chat, e)
+                return False
+            finally:
+                self._last_sent[chat] = time.monotonic()
+
+news_sender = ChannelSender()
+
+async def run_news_cycle(bot: Bot, session: aiohttp.ClientSession) -> int:
+    feeds = await asyncio.to_thread(load_news_feeds)
+    if not feeds:
+        return 0
+    state = await asyncio.to_thread(load_feed_state)
+    results = await asyncio.gather(
+        *[fetch_feed(session, feed, state.get(feed["url"], (None, None))) for feed in feeds],
+        return_exceptions=True,
+    )
+
+    fresh = []
+    for feed, result in zip(feeds, results):
+        if isinstance(result, Exception):
+            logging.warning("فشل جلب مصدر الأخبار %s: %s", feed["url"], result)
+            continue
+        if result is not None:
+            items, etag, last_modified = result
+            fresh += await asyncio.to_thread(index_news_items, feed, items, etag, last_modified)
+    if fresh:
+        # التنبيهات الخاصة تُرسل بالتوازي مع النشر في القنوات
+        lifecycle.spawn(dispatch_news_alerts(bot, fresh), name="news_alerts")
+
+    outbox: Dict[Any, list] = defaultdict(list)
+    unrouted: Counter = Counter()
+    for item_hash, tier, body in await asyncio.to_thread(load_unposted_news):
+        chat = news_chat_for(tier)
+        if chat is None:
+            unrouted[tier] += 1
+        else:
+            outbox[chat].append((item_hash, body))
+    for tier, count in unrouted.items():
+        logging.warning("⚠️ No channel configured for %s news, %d items waiting", tier, count)
+
+    async def drain(chat, entries: list) -> int:
+        posted = 0
+        for item_hash, text in entries:
+            if await news_sender.send(bot, chat, text):
+                await asyncio.to_thread(mark_news_posted, item_hash, chat)
+                posted += 1
+        return posted
+
+    counts = await asyncio.gather(*[drain(chat, entries) for chat, entries in outbox.items()])
+    return sum(counts)
+
+async def news_watcher(bot: Bot):
+    timeout = aiohttp.ClientTimeout(total=20)
+    async with aiohttp.ClientSession(timeout=timeout, headers={"User-Agent": "ForexNewsBot/1.0"}) as session:
+        while True:
+            try:
+                posted = await run_news_cycle(bot, session)
+                if posted:
+                    logging.info("📰 Posted %d news items", posted)
+            except Exception as e:
+                logging.exception("News watcher error: %s", e)
+            await asyncio.sleep(NEWS_POLL_INTERVAL)
+
+# ---------------------- تنبيهات الأزواج لكل مشترك ----------------------
+ALERT_PAIRS = tuple(p.strip().upper() for p in os.getenv(
+    "ALERT_PAIRS", "EURUSD,GBPUSD,USDJPY,XAUUSD,AUDUSD,USDCAD,USDCHF,NZDUSD"
+).split(",") if p.strip())
+IMPACT_LEVELS = ("low", "medium", "high")
+ALERT_RATE = float(os.getenv("ALERT_RATE", "25"))  # رسالة في الثانية لكل البوت، أقل من حد تيليجرام (30)
+ALERT_CONCURRENCY = int(os.getenv("ALERT_CONCURRENCY", "10"))
+PAIR_ALIASES = {"GOLD": "XAUUSD", "ذهب": "XAUUSD", "الذهب": "XAUUSD"}
+
+def impact_rank(impact: Optional[str]) -> int:
+    impact = (impact or "low").lower()
+    return IMPACT_LEVELS.index(impact) if impact in IMPACT_LEVELS else 0
+
+class AlertIndex:
+    """
+    فهرس مقلوب في الذاكرة: زوج -> مجموعة المستخدمين، مع أدنى مستوى تأثير لكل مستخدم.
+    التوزيع يمر فقط على المستخدمين المطابقين بدل قراءة الجدول كاملاً.
+    """
+
+    def __init__(self):
+        self.by_pair: Dict[str, set] = defaultdict(set)
+        self.min_impact: Dict[int, int] = {}
+
+    def load(self):
+        with closing(sqlite3.connect(DB_FILE)) as conn:
+            pairs = conn.execute("SELECT user_id, pair FROM alert_pairs").fetchall()
+            levels = conn.execute("SELECT user_id, min_impact FROM alert_settings").fetchall()
+        # يُبنى الفهرس ثم يُستبدل دفعة واحدة: load يُستدعى من خيط عند الاستعادة والتوزيع يقرأ بالتوازي
+        by_pair: Dict[str, set] = defaultdict(set)
+        for user_id, pair in pairs:
+            by_pair[pair].add(user_id)
+        self.by_pair = by_pair
+        self.min_impact = {user_id: impact_rank(level) for user_id, level in levels}
+
+    def pairs_for(self, user_id: int) -> set:
+        return {pair for pair, users in self.by_pair.items() if user_id in users}
+
+    def set_pair(self, user_id: int, pair: str, enabled: bool):
+        if enabled:
+            self.by_pair[pair].add(user_id)
+        else:
+            self.by_pair[pair].discard(user_id)
+
+    def remove_user(self, user_id: int):
+        for users in self.by_pair.values():
+            users.discard(user_id)
+        self.min_impact.pop(user_id, None)
+
+    def match(self, pairs, impact: Optional[str]) -> set:
+        rank = impact_rank(impact)
+        matched: set = set()
+        for pair in pairs:
+            matched |= self.by_pair.get(pair, set())
+        # التقاطع يمر على المجموعة الأصغر
+        matched &= active_user_ids
+        return {user_id for user_id in matched if self.min_impact.get(user_id, 0) <= rank}
+
+alert_index = AlertIndex()
+
+@traced("db")
+def toggle_alert_pair(user_id: int, pair: str) -> bool:
+    """يفعّل أو يلغي زوجاً للمستخدم ويعيد الحالة الجديدة."""
+    with closing(sqlite3.connect(DB_FILE)) as conn:
+        cur = conn.execute("DELETE FROM alert_pairs WHERE user_id = ? AND pair = ?", (user_id, pair))
+        enabled = cur.rowcount == 0
+        if enabled:
+            conn.execute("INSERT INTO alert_pairs (user_id, pair) VALUES (?, ?)", (user_id, pair))
+        conn.commit()
+    alert_index.set_pair(user_id, pair, enabled)
+    return enabled
+
+@traced("db")
+def cycle_alert_impact(user_id: int) -> str:
+    level = IMPACT_LEVELS[(alert_index.min_impact.get(user_id, 0) + 1) % len(IMPACT_LEVELS)]
+    with closing(sqlite3.connect(DB_FILE)) as conn:
+        conn.execute(
+            "INSERT INTO alert_settings (user_id, min_impact) VALUES (?, ?) "
+            "ON CONFLICT(user_id) DO UPDATE SET min_impact = excluded.min_impact",
+            (user_id, level),
+        )
+        conn.commit()
+    alert_index.min_impact[user_id] = impact_rank(level)
+    return level
+
+@traced("db")
+def delete_alert_preferences(user_id: int):
+    with closing(sqlite3.connect(DB_FILE)) as conn:
+        conn.execute("DELETE FROM alert_pairs WHERE user_id = ?", (user_id,))
+        conn.execute("DELETE FROM alert_settings WHERE user_id = ?", (user_id,))
+        conn.commit()
+    alert_index.remove_user(user_id)
+
+def detect_pairs(item: dict) -> list:
+    """أحداث التقويم: كل زوج يحتوي عملة الحدث. الأخبار: الأزواج المذكورة في العنوان."""
+    if item.get("country"):
+        currency = item["country"].upper()
+        return [pair for pair in ALERT_PAIRS if currency in (pair[:3], pair[3:])]
+    title = item["title"].upper()
+    found = {pair for pair in ALERT_PAIRS if pair in title or f"{pair[:3]}/{pair[3:]}" in title}
+    found.update(pair for alias, pair in PAIR_ALIASES.items() if alias.upper() in title and pair in ALERT_PAIRS)
+    return sorted(found)
+
+class AsyncRateLimiter:
+    """يوزع الإرسال على فترات ثابتة (rate رسالة/ثانية) مهما كان عدد المرسلين المتزامنين."""
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate
+        self._next = 0.0
+
+    async def acquire(self):
+        now = time.monotonic()
+        slot = max(now, self._next)
+        self._next = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+alert_limiter = AsyncRateLimiter(ALERT_RATE)
+
+async def fan_out_alert(bot: Bot, pairs, impact: Optional[str], text: str) -> int:
+    user_ids = alert_index.match(pairs, impact)
+    if not user_ids:
+        return 0
+    semaphore = asyncio.Semaphore(ALERT_CONCURRENCY)
+    header = f"🔔 {' · '.join(pairs)}\n\n"
+
+    async def deliver(user_id: int) -> bool:
+        async with semaphore:
+            await alert_limiter.acquire()
+            try:
+                try:
+                    await bot.send_message(user_id, header + text, disable_web_page_preview=True)
+                except TelegramRetryAfter as e:
+                    await asyncio.sleep(e.retry_after)
+                    await bot.send_message(user_id, header + text, disable_web_page_preview=True)
+                return True
+            except Exception as e:
+                logging.warning("فشل إرسال التنبيه لـ %s: %s", user_id, e)
+                return False
+
+    results = await asyncio.gather(*[deliver(user_id) for user_id in user_ids])
+    sent = sum(results)
+    logging.info("🔔 Alert %s (%s) sent to %d/%d users", ",".join(pairs), impact or "-", sent, len(user_ids))
+    return sent
+
+async def dispatch_news_alerts(bot: Bot, items: list) -> int:
+    sent = 0
+    for item in items:
+        pairs = detect_pairs(item)
+        if pairs:
+            sent += await fan_out_alert(bot, pairs, item.get("impact"), format_news_item(item, "free"))
+    return sent
+
+def alerts_keyboard(user_id: int, lang: str) -> InlineKeyboardMarkup:
+    selected = alert_index.pairs_for(user_id)
+    buttons, row = [], []
+    for pair in ALERT_PAIRS:
+        mark = "✅" if pair in selected else "▫️"
+        row.append(InlineKeyboardButton(text=f"{mark} {pair}", callback_data=f"alert_pair_{pair}"))
+        if len(row) == 2:
+            buttons.append(row)
+            row = []
+    if row:
+        buttons.append(row)
+    level = IMPACT_LEVELS[alert_index.min_impact.get(user_id, 0)]
+    buttons.append([InlineKeyboardButton(text=btn(f"impact_{level}", lang), callback_data="alert_impact")])
+    buttons.append([InlineKeyboardButton(text=btn("back", lang), callback_data="go_start")])
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
+@router.callback_query(F.data == "alerts")
+async def alerts_menu(cq: CallbackQuery):
+    lang = user_lang(cq.from_user.id)
+    await cq.message.edit_text(get_text("alerts_menu", lang), reply_markup=alerts_keyboard(cq.from_user.id, lang))
+    await cq.answer()
+
+@router.callback_query(F.data.startswith("alert_pair_"))
+async def alerts_toggle_pair(cq: CallbackQuery):
+    pair = cq.data[len("alert_pair_"):]
+    if pair not in ALERT_PAIRS:
+        await cq.answer()
+        return
+    lang = user_lang(cq.from_user.id)
+    enabled = await asyncio.to_thread(toggle_alert_pair, cq.from_user.id, pair)
+    await cq.message.edit_reply_markup(reply_markup=alerts_keyboard(cq.from_user.id, lang))
+    await cq.answer(f"{'✅' if enabled else '▫️'} {pair}")
+
+@router.callback_query(F.data == "alert_impact")
+async def alerts_cycle_impact(cq: CallbackQuery):
+    lang = user_lang(cq.from_user.id)
+    level = await asyncio.to_thread(cycle_alert_impact, cq.from_user.id)
+    await cq.message.edit_reply_markup(reply_markup=alerts_keyboard(cq.from_user.id, lang))
+    await cq.answer(btn(f"impact_{level}", lang))
+
+@router.message(F.text.startswith("/alert "))
+async def admin_send_alert(message: Message, bot: Bot):
+    """/alert EURUSD,XAUUSD high نص التنبيه — تنبيه يدوي للمشتركين المطابقين."""
+    if message.from_user.id != ADMIN_ID:
+        return
+    parts = message.text.split(maxsplit=3)
+    if len(parts) < 4 or parts[2].lower() not in IMPACT_LEVELS:
+        await message.answer("الاستخدام: /alert EURUSD,XAUUSD high نص التنبيه")
+        return
+    pairs = [p for p in parts[1].upper().split(",") if p in ALERT_PAIRS]
+    if not pairs:
+        await message.answer(f"❌ الأزواج المتاحة: {', '.join(ALERT_PAIRS)}")
+        return
+    matched = len(alert_index.match(pairs, parts[2]))
+    await message.answer(f"🔔 جاري الإرسال إلى {matched} مشترك...")
+    lifecycle.spawn(fan_out_alert(bot, pairs, parts[2].lower(), html.escape(parts[3])), name="alert_fan_out")
+
+# ---------------------- النسخ الاحتياطي والاستعادة ----------------------
+BACKUP_DIR = os.getenv("BACKUP_DIR", "backups")
+BACKUP_CRON = os.getenv("BACKUP_CRON", "0 3 * * *")
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", "14"))
+BACKUP_PAGES_PER_STEP = 256
+BACKUP_STEP_PAUSE = 0.005
+SNAPSHOT_CONFIG_FILES = [LINKS_FILE, WALLETS_FILE, NEWS_FEEDS_FILE]
+
+def _sha256_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _copy_sqlite(src_path: str, dst_path: str):
+    # SQLite online backup API: نسخ على خطوات صغيرة مع مهلة بينها حتى لا تُحجب الكتابات
+    with closing(sqlite3.connect(src_path)) as src, closing(sqlite3.connect(dst_path)) as dst:
+        src.backup(dst, pages=BACKUP_PAGES_PER_STEP, progress=lambda *_: time.sleep(BACKUP_STEP_PAUSE))
+
+def list_snapshots() -> list:
+    if not os.path.isdir(BACKUP_DIR):
+        return []
+    return sorted((f for f in os.listdir(BACKUP_DIR) if f.startswith("snapshot-") and f.endswith(".zip")), reverse=True)
+
+def create_snapshot(label: str = "") -> str:
+    """لقطة مضغوطة: نسخة متسقة من قاعدة البيانات + ملفات الإعداد + manifest بالبصمات."""
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    name = f"snapshot-{time.strftime('%Y%m%d-%H%M%S')}{'-' + label if label else ''}.zip"
+    path = os.path.join(BACKUP_DIR, name)
+    with tempfile.TemporaryDirectory() as tmp:
+        db_copy = os.path.join(tmp, os.path.basename(DB_FILE))
+        _copy_sqlite(DB_FILE, db_copy)
+        files = {os.path.basename(DB_FILE): db_copy}
+        for config_file in SNAPSHOT_CONFIG_FILES:
+            if os.path.exists(config_file):
+                files[os.path.basename(config_file)] = config_file
+        with closing(sqlite3.connect(db_copy)) as conn:
+            schema = get_schema_version(conn)
+        manifest = {
+            "created_ts": int(time.time()),
+            "schema_version": schema,
+            "files": {arcname: _sha256_file(src) for arcname, src in files.items()},
+        }
+        with zipfile.ZipFile(path + ".tmp", "w", compression=zipfile.ZIP_DEFLATED) as zf:
+            for arcname, src in files.items():
+                zf.write(src, arcname)
+            zf.writestr("manifest.json", json.dumps(manifest, indent=2))
+    os.replace(path + ".tmp", path)
+    prune_snapshots()
+    return path
+
+def prune_snapshots():
+    # اللقطات اليدوية وما قبل الاستعادة تخضع لنفس حد الاحتفاظ
+    for name in list_snapshots()[BACKUP_KEEP:]:
+        try:
+            os.remove(os.path.join(BACKUP_DIR, name))
+        except OSError as e:
+            logging.warning("فشل حذف نسخة قديمة %s: %s", name, e)
+
+def verify_snapshot(path: str, extract_to: str) -> Tuple[bool, str]:
+    """يتحقق من CRC والبصمات وسلامة قاعدة البيانات، ويفك الملفات في extract_to."""
+    try:
+        with zipfile.ZipFile(path) as zf:
+            bad = zf.testzip()
+            if bad:
+                return False, f"ملف تالف داخل الأرشيف: {bad}"
+            manifest = json.loads(zf.read("manifest.json"))
+            zf.extractall(extract_to)
+    except (zipfile.BadZipFile, zlib.error, KeyError, ValueError, OSError) as e:
+        return False, f"أرشيف غير صالح: {e}"
+
+    for arcname, expected in manifest.get("files", {}).items():
+        extracted = os.path.join(extract_to, arcname)
+        if not os.path.exists(extracted) or _sha256_file(extracted) != expected:
+            return False, f"البصمة غير مطابقة: {arcname}"
+
+    db_copy = os.path.join(extract_to, os.path.basename(DB_FILE))
+    if not os.path.exists(db_copy):
+        return False, "قاعدة البيانات غير موجودة في النسخة"
+    with closing(sqlite3.connect(db_copy)) as conn:
+        result = conn.execute("PRAGMA integrity_check").fetchone()[0]
+        if result != "ok":
+            return False, f"فحص السلامة فشل: {result}"
+        users = conn.execute("SELECT COUNT(*) FROM subscriptions").fetchone()[0]
+    created = time.strftime('%Y-%m-%d %H:%M', time.localtime(manifest.get("created_ts", 0)))
+    return True, f"✅ النسخة سليمة ({users} مستخدم، {created}، إصدار المخطط {manifest.get('schema_version')})"
+
+def restore_snapshot(path: str) -> Tuple[bool, str]:
+    with tempfile.TemporaryDirectory() as tmp:
+        ok, message = verify_snapshot(path, tmp)
+        if not ok:
+            return False, message
+        # لقطة أمان للحالة الحالية قبل الكتابة فوقها
+        create_snapshot("pre-restore")
+        _copy_sqlite(os.path.join(tmp, os.path.basename(DB_FILE)), DB_FILE)
+        for config_file in SNAPSHOT_CONFIG_FILES:
+            extracted = os.path.join(tmp, os.path.basename(config_file))
+            if os.path.exists(extracted):
+                shutil.copyfile(extracted, config_file)
+    # نسخة أقدم قد تكون بمخطط أقدم
+    run_migrations()
+    load_active_user_ids()
+    alert_index.load()
+    bump_data_version()
+    return True, message
+
+async def run_backup_job(bot: Bot, job: dict = None) -> str:
+    await write_queue.flush()
+    path = await asyncio.to_thread(create_snapshot)
+    logging.info("💾 Snapshot created: %s", path)
+    return path
+
+scheduler.register("backup", run_backup_job, label="💾 نسخة احتياطية")
+
+@router.message(F.text == "/backup")
+async def backup_command(message: Message, bot: Bot):
+    if message.from_user.id != ADMIN_ID:
+        return
+    await message.answer("💾 جاري إنشاء نسخة احتياطية...")
+    try:
+        path = await run_backup_job(bot)
+        await message.answer_document(FSInputFile(path), caption=f"💾 {os.path.basename(path)}")
+    except Exception as e:
+        logging.exception("Backup failed: %s", e)
+        await message.answer(f"❌ فشل النسخ الاحتياطي: {e}")
+
+@router.message(F.text == "/restore")
+async def restore_command(message: Message):
+    if message.from_user.id != ADMIN_ID:
+        return
+    snapshots = list_snapshots()
+    if not snapshots:
+        await message.answer("📭 لا توجد نسخ احتياطية.")
+        return
+    kb = [[InlineKeyboardButton(text=f"📦 {name}", callback_data=f"restore_pick_{name}")] for name in snapshots[:20]]
+    await message.answer("♻️ اختر النسخة المراد استعادتها:", reply_markup=InlineKeyboardMarkup(inline_keyboard=kb))
+
+@router.callback_query(F.data.startswith("restore_pick_"))
+async def restore_pick(cq: CallbackQuery):
+    if cq.from_user.id != ADMIN_ID:
+        await cq.answer("🚫 غير مصرح", show_alert=True)
+        return
+    name = cq.data.split("restore_pick_", 1)[1]
+    if name not in list_snapshots():
+        await cq.answer("❌ النسخة غير موجودة.", show_alert=True)
+        return
+    with tempfile.TemporaryDirectory() as tmp:
+        ok, message = await asyncio.to_thread(verify_snapshot, os.path.join(BACKUP_DIR, name), tmp)
+    if not ok:
+        await cq.message.edit_text(f"❌ {message}")
+        await cq.answer()
+        return
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="⚠️ تأكيد الاستعادة", callback_data=f"restore_do_{name}")],
+        [InlineKeyboardButton(text="🔙 رجوع", callback_data="admin_panel")],
+    ])
+    await cq.message.edit_text(f"{message}\n\n⚠️ ستُستبدل البيانات الحالية بهذه النسخة.", reply_markup=kb)
+    await cq.answer()
+
+# الضغط المزدوج على نفس الزر يمنعه IdempotencyMiddleware، والقفل يمنع استعادتين متزامنتين من رسالتين مختلفتين
+restore_lock = asyncio.Lock()
+
+@router.callback_query(F.data.startswith("restore_do_"))
+async def restore_do(cq: CallbackQuery):
+    if cq.from_user.id != ADMIN_ID:
+        await cq.answer("🚫 غير مصرح", show_alert=True)
+        return
+    name = cq.data.split("restore_do_", 1)[1]
+    if name not in list_snapshots():
+        await cq.answer("❌ النسخة غير موجودة.", show_alert=True)
+        return
+    if restore_lock.locked():
+        await cq.answer("⏳ توجد استعادة جارية بالفعل.", show_alert=True)
+        return
+    async with restore_lock:
+        await cq.answer("♻️ جاري الاستعادة...")
+        await write_queue.flush()
+        ok, message = await asyncio.to_thread(restore_snapshot, os.path.join(BACKUP_DIR, name))
+        if ok:
+            scheduler.reload()
+            await cq.message.edit_text(f"♻️ تمت الاستعادة من {name}\n{message}")
+        else:
+            await cq.message.edit_text(f"❌ فشلت الاستعادة: {message}")
+        return ok
+
+# ---------------------- أرشفة الصفوف الباردة ----------------------
+ARCHIVE_CRON = os.getenv("ARCHIVE_CRON", "30 4 * * *")
+ARCHIVE_BATCH = int(os.getenv("ARCHIVE_BATCH", "500"))
+# عمر الصف منذ آخر كتابة (بالأيام) قبل نقله للأرشيف؛ الاشتراكات النشطة والمعلقة لا تُؤرشف أبداً
+ARCHIVE_AFTER_DAYS = {"new": 14, "rejected": 30, "ended": 90}
+
+@traced("db")
+def archive_batch(after_user_id: int, skip_ids: set, now: int = None) -> Tuple[int, Optional[int]]:
+    """
+    ينقل دفعة واحدة من الصفوف الباردة (مرتبة بـ user_id) في معاملة واحدة.
+    يعيد (عدد المنقول، آخر user_id فُحص) أو (0، None) عند انتهاء الجدول.
+    """
+    now = now or int(time.time())
+    cold_sql = " OR ".join("(state = ? AND updated_ts < ?)" for _ in ARCHIVE_AFTER_DAYS)
+    cold_params = [p for state, days in ARCHIVE_AFTER_DAYS.items() for p in (state, now - days * DAY_SECONDS)]
+    with closing(sqlite3.connect(DB_FILE, isolation_level=None)) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            candidates = [row[0] for row in conn.execute(
+                f"SELECT user_id FROM subscriptions WHERE user_id > ? AND ({cold_sql}) ORDER BY user_id LIMIT ?",
+                (after_user_id, *cold_params, ARCHIVE_BATCH),
+            )]
+            if not candidates:
+                conn.execute("COMMIT")
+                return 0, None
+            ids = [user_id for user_id in candidates if user_id not in skip_ids]
+            if ids:
+                placeholders = ", ".join("?" * len(ids))
+                conn.execute(
+                    f"INSERT OR REPLACE INTO subscriptions_archive ({ARCHIVE_COLUMNS_SQL}, archived_ts) "
+                    f"SELECT {ARCHIVE_COLUMNS_SQL}, ? FROM subscriptions WHERE user_id IN ({placeholders})",
+                    (now, *ids),
+                )
+                conn.execute(f"DELETE FROM subscriptions WHERE user_id IN ({placeholders})", ids)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    return len(ids), candidates[-1]
+
+async def run_archive_job(bot: Bot, job: dict = None) -> int:
+    # الكتابات المعلقة تُفرغ أولاً، ومن بقي في الطابور يُتخطى حتى لا يُعاد إنشاؤه بعد نقله
+    await write_queue.flush()
+    moved, cursor = 0, 0
+    while True:
+        count, cursor = await asyncio.to_thread(archive_batch, cursor, write_queue.pending_user_ids())
+        if cursor is None:
+            break
+        moved += count
+        # فاصل قصير بين الدفعات حتى لا تحجز قاعدة البيانات عن المعالجات
+        await asyncio.sleep(0.05)
+    if moved:
+        bump_data_version()
+    logging.info("🗄 Archived %d cold subscription rows", moved)
+    return moved
+
+scheduler.register("archive", run_archive_job, label="🗄 أرشفة الصفوف الباردة")
+
+def count_rows() -> Tuple[int, int]:
+    with closing(sqlite3.connect(DB_FILE)) as conn:
+        hot = conn.execute("SELECT COUNT(*) FROM subscriptions").fetchone()[0]
+        cold = conn.execute("SELECT COUNT(*) FROM subscriptions_archive").fetchone()[0]
+    return hot, cold
+
+@router.message(F.text == "/archive")
+async def archive_command(message: Message, bot: Bot):
+    if message.from_user.id != ADMIN_ID:
+        return
+    moved = await run_archive_job(bot)
+    hot, cold = await asyncio.to_thread(count_rows)
+    await message.answer(
+        f"🗄 تم نقل <code>{moved}</code> صف إلى الأرشيف.\n"
+        f"🔥 الجدول الحي: <code>{hot}</code> | 🧊 الأرشيف: <code>{cold}</code>"
+    )
+
 # ---------------------- بدء البوت ----------------------
-async def main():
-    init_db()
-    bot = Bot(TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+def create_bot(token: str = None, session=None) -> Bot:
+    bot = Bot(token or TOKEN, session=session, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+    bot.session.middleware(TracingRequestMiddleware())
+    return bot
+
+def create_dispatcher(capture: bool = CAPTURE_UPDATES, throttle: bool = True) -> Dispatcher:
     dp = Dispatcher()
+    # الروتر مشترك على مستوى الوحدة، فالتعطيل (لإعادة التشغيل السريعة) يكون عبر المفتاح لا بإزالة الـ middleware
+    throttler.enabled = throttle
+    if capture:
+        dp.update.outer_middleware(UpdateCaptureMiddleware())
+    dp.update.outer_middleware(TracingMiddleware())
+    dp.update.outer_middleware(LifecycleMiddleware())
     dp.include_router(router)
-    await bot.delete_webhook(drop_pending_updates=True)
-    asyncio.create_task(reminder_task(bot))
+    return dp
+
+async def main():
+    init_db()
+    bot = create_bot()
+    dp = create_dispatcher()
+    if CAPTURE_UPDATES:
+        logging.info("📼 Capturing anonymized updates to %s", CAPTURE_FILE)
+    # نحتفظ بالتحديثات التي وصلت أثناء إعادة التشغيل بدل إسقاطها
+    await bot.delete_webhook(drop_pending_updates=False)
+    lifecycle.spawn(reminder_task(bot), name="reminder_task")
+    await scheduler.start(bot)
+    if PRIVATE_CHANNEL_ID:
+        scheduler.ensure_job("reconcile_channel", RECONCILE_CRON)
+    scheduler.ensure_job("backup", BACKUP_CRON)
+    scheduler.ensure_job("archive", ARCHIVE_CRON)
+    if AUTO_VERIFY_PAYMENTS:
+        lifecycle.spawn(payment_watcher(bot), name="payment_watcher")
+    if NEWS_ENABLED:
+        lifecycle.spawn(news_watcher(bot), name="news_watcher")
+    write_queue.start()
+    lifecycle.on_shutdown(scheduler.stop)
+    lifecycle.on_shutdown(write_queue.stop)
+    lifecycle.on_shutdown(bot.session.close)
     logging.info("Bot is starting...")
-    await dp.start_polling(bot)
+    try:
+        # aiogram يوقف الاستقبال عند SIGTERM/SIGINT، ثم نُفرغ المهام الجارية قبل إغلاق الجلسة
+        await dp.start_polling(bot, close_bot_session=False)
+    finally:
+        await lifecycle.shutdown()
 
 if __name__ == "__main__":
     try:
@@ -0,0 +1,238 @@
+"""
+إعادة تشغيل التحديثات المسجلة (CAPTURE_UPDATES=1) عبر نفس الـ Dispatcher والروتر
+مقابل Bot API وهمي ونسخة من قاعدة البيانات، لقياس زمن الاستجابة والإنتاجية بين الإصدارات.
+
+    python replay.py captured_updates.jsonl --speed 10 --out new.json --baseline old.json
+
+--speed 1 يعيد التوقيت المسجل، 10 أسرع بعشر مرات، و0 بأقصى سرعة.
+تحديثات المستخدم الواحد تُعالج بالترتيب المسجل، والمستخدمون المختلفون بالتوازي كما في الـ polling.
+"""
+import argparse
+import asyncio
+import glob
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import typing
+from collections import Counter
+from contextlib import closing
+
+from aiogram.client.session.base import BaseSession
+from aiogram.types import Message, User
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+REPLAY_TOKEN = "123456:REPLAY"
+REPLAY_BOT_USER = {"id": 123456, "is_bot": True, "first_name": "replay", "username": "replay_bot"}
+
+class ReplaySession(BaseSession):
+    """Bot API وهمي: يرد على كل طريقة بنتيجة صالحة بدون اتصال بالشبكة، مع تأخير اختياري ثابت."""
+
+    def __init__(self, latency_ms: float = 0.0):
+        super().__init__()
+        self.latency = latency_ms / 1000
+        self.calls: Counter = Counter()
+        self._message_id = 0
+
+    def _fake_result(self, method):
+        returning = method.__returning__
+        options = typing.get_args(returning) or (returning,)
+        if Message in options:
+            self._message_id += 1
+            chat_id = getattr(method, "chat_id", None)
+            return {
+                "message_id": self._message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id if isinstance(chat_id, int) else 0, "type": "private"},
+                "text": getattr(method, "text", None) or "",
+            }
+        if bool in options:
+            return True
+        if User in options:
+            return REPLAY_BOT_USER
+        if type(method).__name__ == "GetChatMember":
+            return {"status": "member", "user": {"id": method.user_id, "is_bot": False, "first_name": "replay"}}
+        if type(method).__name__.startswith(("CreateChatInviteLink", "EditChatInviteLink")):
+            return {
+                "invite_link": "https://t.me/+replay",
+                "creator": REPLAY_BOT_USER,
+                "creates_join_request": False,
+                "is_primary": False,
+                "is_revoked": False,
+            }
+        if typing.get_origin(returning) is list:
+            return []
+        return True
+
+    async def make_request(self, bot, method, timeout=None):
+        self.calls[type(method).__name__] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        content = json.dumps({"ok": True, "result": self._fake_result(method)}, default=str)
+        response = self.check_response(bot=bot, method=method, status_code=200, content=content)
+        return response.result
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b""
+
+    async def close(self):
+        pass
+
+def load_capture(path: str) -> list:
+    records = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                records.append(json.loads(line))
+    # الترتيب المسجل مستقر حتى لو اختلطت ملفات التدوير
+    records.sort(key=lambda r: (r["ts"], r["update"]["update_id"]))
+    return records
+
+def update_user_key(update: dict):
+    for key, event in update.items():
+        if key == "update_id" or not isinstance(event, dict):
+            continue
+        sender = event.get("from") or event.get("user") or event.get("chat") or {}
+        return sender.get("id")
+    return None
+
+def percentile(values: list, pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return round(ordered[index], 2)
+
+def prepare_workdir(db_file: str) -> str:
+    """نسخة معزولة من قاعدة البيانات وملفات الإعدادات حتى لا تلمس إعادة التشغيل البيانات الحقيقية."""
+    workdir = tempfile.mkdtemp(prefix="replay_")
+    for path in glob.glob(os.path.join(REPO_DIR, "*.json")):
+        shutil.copy2(path, workdir)
+    target = os.path.join(workdir, os.path.basename(db_file))
+    if os.path.exists(db_file):
+        with closing(sqlite3.connect(db_file)) as src, closing(sqlite3.connect(target)) as dst:
+            src.backup(dst)
+    return workdir
+
+async def replay(records: list, speed: float, latency_ms: float, throttle: bool = False) -> dict:
+    import bot as app
+
+    app.init_db()
+    session = ReplaySession(latency_ms)
+    tg = app.create_bot(REPLAY_TOKEN, session=session)
+    # الإعادة بسرعة أعلى من التسجيل تتجاوز حدود الـ throttler وتُسقط تحديثات بصمت
+    dp = app.create_dispatcher(capture=False, throttle=throttle)
+    rejected_before = sum(app.throttler.rejections.values())
+    app.write_queue.start()
+
+    latencies: list = []
+    errors: Counter = Counter()
+    last_by_user: dict = {}
+
+    async def feed(update: dict, previous: asyncio.Task):
+        if previous is not None:
+            await asyncio.gather(previous, return_exceptions=True)
+        started = time.perf_counter()
+        try:
+            await dp.feed_raw_update(tg, update)
+        except Exception as e:
+            errors[type(e).__name__] += 1
+        latencies.append((time.perf_counter() - started) * 1000)
+
+    tasks = []
+    first_ts = records[0]["ts"] if records else 0
+    started = time.perf_counter()
+    for record in records:
+        if speed > 0:
+            delay = (record["ts"] - first_ts) / speed - (time.perf_counter() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        user_key = update_user_key(record["update"])
+        task = asyncio.create_task(feed(record["update"], last_by_user.get(user_key)))
+        if user_key is not None:
+            last_by_user[user_key] = task
+        tasks.append(task)
+    await asyncio.gather(*tasks)
+    await app.write_queue.stop()
+    wall = time.perf_counter() - started
+    await tg.session.close()
+
+    return {
+        "updates": len(records),
+        "errors": dict(errors),
+        "throttled": sum(app.throttler.rejections.values()) - rejected_before,
+        "speed": speed,
+        "api_latency_ms": latency_ms,
+        "wall_s": round(wall, 3),
+        "throughput_ups": round(len(records) / wall, 2) if wall else 0.0,
+        "latency_ms": {
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+            "max": round(max(latencies), 2) if latencies else 0.0,
+        },
+        "api_calls": dict(session.calls.most_common()),
+    }
+
+def compare(result: dict, baseline: dict, threshold: float) -> list:
+    """يعيد قائمة بالتراجعات التي تتجاوز النسبة المسموحة مقارنة بالنتيجة المرجعية."""
+    regressions = []
+    for key in ("p50", "p95", "p99"):
+        old, new = baseline["latency_ms"][key], result["latency_ms"][key]
+        if old and (new - old) / old * 100 > threshold:
+            regressions.append(f"latency {key}: {old}ms -> {new}ms")
+    old, new = baseline["throughput_ups"], result["throughput_ups"]
+    if old and (old - new) / old * 100 > threshold:
+        regressions.append(f"throughput: {old}/s -> {new}/s")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay captured updates against a fake Bot API")
+    parser.add_argument("capture", help="captured_updates.jsonl (أو أحد ملفات التدوير)")
+    parser.add_argument("--speed", type=float, default=1.0, help="1 = التوقيت المسجل، 0 = بأقصى سرعة")
+    parser.add_argument("--db", default=os.path.join(REPO_DIR, "subscriptions.db"), help="قاعدة البيانات التي تُنسخ قبل التشغيل")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="تأخير وهمي لكل استدعاء Bot API بالملي ثانية")
+    parser.add_argument("--throttle", action="store_true", help="تفعيل الـ throttler كما في الإنتاج (التحديثات المرفوضة تُحسب في throttled)")
+    parser.add_argument("--out", help="حفظ النتيجة بصيغة JSON")
+    parser.add_argument("--baseline", help="نتيجة JSON سابقة للمقارنة")
+    parser.add_argument("--threshold", type=float, default=20.0, help="نسبة التراجع المسموحة %%")
+    args = parser.parse_args()
+
+    records = load_capture(args.capture)
+    workdir = prepare_workdir(os.path.abspath(args.db))
+    os.environ.update({
+        "BOT_TOKEN": REPLAY_TOKEN,
+        "ADMIN_ID": "1",  # CAPTURE_ADMIN_ID
+        "DB_FILE": os.path.join(workdir, os.path.basename(args.db)),
+        "CAPTURE_UPDATES": "0",
+        "SLOW_LOG_FILE": os.path.join(workdir, "slow_updates.jsonl"),
+    })
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_DIR)
+    logging.getLogger("aiogram").setLevel(logging.WARNING)
+
+    try:
+        result = asyncio.run(replay(records, args.speed, args.api_latency, args.throttle))
+    finally:
+        os.chdir(REPO_DIR)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(json.dumps(result, indent=2, ensure_ascii=False))
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            regressions = compare(result, json.load(f), args.threshold)
+        for line in regressions:
+            print(f"⚠️ regression: {line}")
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,23 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+# القيم تُضبط قبل الاستيراد؛ load_dotenv لا يستبدل المتغيرات الموجودة
+os.environ["BOT_TOKEN"] = "123456:TEST"
+os.environ["ADMIN_ID"] = "999"
+os.environ["SLOW_LOG_FILE"] = os.devnull
+
+import bot as app  # noqa: E402
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """قاعدة بيانات مؤقتة مُرحّلة لكل اختبار."""
+    path = str(tmp_path / "test.db")
+    monkeypatch.setattr(app, "DB_FILE", path)
+    app.init_db()
+    yield path
+    app.active_user_ids.clear()
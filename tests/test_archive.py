@@ -0,0 +1,61 @@
+import sqlite3
+import threading
+from contextlib import closing
+
+import bot as app
+from bot import SubState, Subscription
+
+
+def archive_user(db, user_id):
+    app.upsert_subscription(Subscription(user_id, username="cold", state=SubState.REJECTED))
+    with closing(sqlite3.connect(db)) as conn:
+        conn.execute("UPDATE subscriptions SET updated_ts = 0 WHERE user_id = ?", (user_id,))
+        conn.commit()
+    assert app.archive_batch(0, set()) == (1, user_id)
+
+
+def count(db, table, user_id):
+    with closing(sqlite3.connect(db)) as conn:
+        return conn.execute(f"SELECT COUNT(*) FROM {table} WHERE user_id = ?", (user_id,)).fetchone()[0]
+
+
+def test_returning_user_is_rehydrated(db):
+    archive_user(db, 7)
+    assert count(db, "subscriptions", 7) == 0
+
+    sub = app.get_subscription(7)
+    assert sub.username == "cold"
+    assert sub.state is SubState.REJECTED
+    assert count(db, "subscriptions", 7) == 1
+    assert count(db, "subscriptions_archive", 7) == 0
+
+
+def test_miss_does_not_write(db):
+    with closing(sqlite3.connect(db)) as conn:
+        assert app.rehydrate_subscription(conn, 404) is False
+        # لم تبدأ أي معاملة كتابة لمستخدم غير موجود
+        assert not conn.in_transaction
+    assert app.get_subscription(404) is None
+
+
+def test_rehydrate_keeps_live_row(db):
+    archive_user(db, 7)
+    app.upsert_subscription(Subscription(7, username="live"))
+    assert app.get_subscription(7).username == "live"
+    with closing(sqlite3.connect(db)) as conn:
+        assert app.rehydrate_subscription(conn, 7) is False
+
+
+def test_data_version_bumps_from_threads():
+    before = app.data_version()
+
+    def bump():
+        for _ in range(1000):
+            app.bump_data_version()
+
+    threads = [threading.Thread(target=bump) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert app.data_version() == before + 8000
@@ -0,0 +1,158 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import bot as app
+from bot import IdempotencyMiddleware
+
+
+class FakeCallback:
+    def __init__(self, data, message_id=1):
+        self.data = data
+        self.inline_message_id = None
+        self.message = SimpleNamespace(chat=SimpleNamespace(id=999), message_id=message_id, edit_text=self.edit_text)
+        self.from_user = SimpleNamespace(id=app.ADMIN_ID)
+        self.answers = []
+        self.edits = []
+
+    async def answer(self, text=None, **kwargs):
+        self.answers.append(text)
+
+    async def edit_text(self, text, **kwargs):
+        self.edits.append(text)
+
+
+def run(middleware, handler, event):
+    async def approve_user_handler(cq):
+        return await handler(cq)
+
+    data = {"handler": SimpleNamespace(callback=approve_user_handler)}
+    return asyncio.run(middleware(lambda e, d: approve_user_handler(e), event, data))
+
+
+def make_middleware():
+    return IdempotencyMiddleware(handlers=("approve_user_handler",))
+
+
+def test_committed_result_blocks_repeat():
+    mw = make_middleware()
+    calls = []
+
+    async def handler(cq):
+        calls.append(cq.data)
+        return True
+
+    assert run(mw, handler, FakeCallback("approve_5")) is True
+    repeat = FakeCallback("approve_5")
+    assert run(mw, handler, repeat) is None
+    assert calls == ["approve_5"]
+    assert mw.duplicates == 1
+    assert repeat.answers and repeat.answers[0].startswith("✅")
+
+
+def test_failed_transition_can_be_retried():
+    mw = make_middleware()
+    calls = []
+
+    async def handler(cq):
+        calls.append(cq.data)
+        return None  # CAS خسر السباق: "حاول مرة أخرى"
+
+    run(mw, handler, FakeCallback("approve_5"))
+    run(mw, handler, FakeCallback("approve_5"))
+    assert len(calls) == 2
+    assert mw.duplicates == 0
+
+
+def test_exception_is_not_cached():
+    mw = make_middleware()
+    calls = []
+
+    async def handler(cq):
+        calls.append(cq.data)
+        if len(calls) == 1:
+            raise RuntimeError("boom")
+        return True
+
+    try:
+        run(mw, handler, FakeCallback("approve_5"))
+    except RuntimeError:
+        pass
+    assert run(mw, handler, FakeCallback("approve_5")) is True
+    assert len(calls) == 2
+
+
+def test_concurrent_double_tap_runs_once():
+    mw = make_middleware()
+    calls = []
+
+    async def approve_user_handler(cq):
+        calls.append(cq.data)
+        await asyncio.sleep(0.01)
+        return True
+
+    async def main():
+        data = {"handler": SimpleNamespace(callback=approve_user_handler)}
+        events = [FakeCallback("approve_5") for _ in range(3)]
+        await asyncio.gather(*(mw(lambda e, d: approve_user_handler(e), ev, data) for ev in events))
+        return events
+
+    events = asyncio.run(main())
+    assert calls == ["approve_5"]
+    assert [ev.answers for ev in events[1:]] == [["⏳ جاري التنفيذ..."], ["⏳ جاري التنفيذ..."]]
+
+
+def test_other_handlers_and_messages_pass_through():
+    mw = make_middleware()
+    calls = []
+
+    async def handler(cq):
+        calls.append((cq.message.message_id, cq.data))
+        return True
+
+    run(mw, handler, FakeCallback("approve_5", message_id=1))
+    run(mw, handler, FakeCallback("approve_5", message_id=2))
+    run(mw, handler, FakeCallback("approve_6", message_id=1))
+    assert len(calls) == 3
+
+    async def go_start(cq):
+        return True
+
+    data = {"handler": SimpleNamespace(callback=go_start)}
+    asyncio.run(mw(lambda e, d: go_start(e), FakeCallback("x"), data))
+    asyncio.run(mw(lambda e, d: go_start(e), FakeCallback("x"), data))
+    assert mw.duplicates == 0
+
+
+def test_restore_runs_once_per_double_tap(monkeypatch):
+    restored = []
+
+    def slow_restore(path):
+        restored.append(path)
+        time.sleep(0.05)
+        return True, "ok"
+
+    async def no_flush():
+        pass
+
+    monkeypatch.setattr(app, "list_snapshots", lambda: ["a.db", "b.db"])
+    monkeypatch.setattr(app, "restore_snapshot", slow_restore)
+    monkeypatch.setattr(app.write_queue, "flush", no_flush)
+    monkeypatch.setattr(app.scheduler, "reload", lambda: None)
+
+    async def main():
+        data = {"handler": SimpleNamespace(callback=app.restore_do)}
+        events = [
+            FakeCallback("restore_do_a.db", message_id=1),
+            FakeCallback("restore_do_a.db", message_id=1),
+            # رسالة تأكيد أخرى لنسخة مختلفة أثناء الاستعادة
+            FakeCallback("restore_do_b.db", message_id=2),
+        ]
+        await asyncio.gather(*(app.idempotency(lambda e, d: app.restore_do(e), ev, data) for ev in events))
+        return events
+
+    first, repeat, other = asyncio.run(main())
+    assert len(restored) == 1 and restored[0].endswith("a.db")
+    assert repeat.answers == ["⏳ جاري التنفيذ..."]
+    assert other.answers == ["⏳ توجد استعادة جارية بالفعل."]
+    assert first.edits and first.edits[0].startswith("♻️")
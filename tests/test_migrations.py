@@ -0,0 +1,70 @@
+import sqlite3
+from contextlib import closing
+
+import pytest
+
+import bot as app
+
+
+def applied_versions(path):
+    with closing(sqlite3.connect(path)) as conn:
+        return [row[0] for row in conn.execute("SELECT version FROM schema_version ORDER BY version")]
+
+
+def schema(path):
+    with closing(sqlite3.connect(path)) as conn:
+        return sorted(conn.execute("SELECT type, name, sql FROM sqlite_master").fetchall(), key=str)
+
+
+def test_migrations_are_idempotent(tmp_path):
+    path = str(tmp_path / "fresh.db")
+    app.run_migrations(path)
+    first = schema(path)
+    app.run_migrations(path)
+
+    assert applied_versions(path) == [version for version, _, _ in app.MIGRATIONS]
+    assert schema(path) == first
+
+
+def test_legacy_database_is_upgraded(tmp_path):
+    path = str(tmp_path / "legacy.db")
+    # المخطط القديم قبل نظام الترحيل، ببيانات غير نظيفة
+    with closing(sqlite3.connect(path)) as conn:
+        conn.execute(
+            "CREATE TABLE subscriptions (user_id INTEGER PRIMARY KEY, username TEXT, method TEXT, duration_months INTEGER, "
+            "start_ts INTEGER, end_ts INTEGER, state TEXT, receipt_file_id TEXT, language TEXT)"
+        )
+        conn.executemany(
+            "INSERT INTO subscriptions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [
+                (1, "ok", "USDT TRC20", 3, 100, 200, "active", None, "en"),
+                (2, "bad", None, 0, None, None, "unknown", None, None),
+            ],
+        )
+        conn.commit()
+
+    app.run_migrations(path)
+    app.run_migrations(path)
+
+    assert applied_versions(path)[-1] == app.MIGRATIONS[-1][0]
+    with closing(sqlite3.connect(path)) as conn:
+        rows = conn.execute(
+            "SELECT user_id, username, duration_months, state, language FROM subscriptions ORDER BY user_id"
+        ).fetchall()
+    assert rows == [(1, "ok", 3, "active", "en"), (2, "bad", None, "new", "ar")]
+
+
+def test_failed_migration_rolls_back(tmp_path, monkeypatch):
+    path = str(tmp_path / "broken.db")
+    app.run_migrations(path)
+    latest = app.MIGRATIONS[-1][0]
+    monkeypatch.setattr(app, "MIGRATIONS", app.MIGRATIONS + [
+        (latest + 1, "broken", ["CREATE TABLE half_done (id INTEGER)", "SELECT * FROM missing_table"]),
+    ])
+
+    with pytest.raises(sqlite3.OperationalError):
+        app.run_migrations(path)
+
+    assert applied_versions(path)[-1] == latest
+    with closing(sqlite3.connect(path)) as conn:
+        assert conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'half_done'").fetchone() is None
@@ -0,0 +1,121 @@
+import asyncio
+import json
+import time
+from email.utils import formatdate
+
+import aiohttp
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+import bot as app
+from replay import ReplaySession
+
+
+class RecordingSession(ReplaySession):
+    def __init__(self):
+        super().__init__()
+        self.sent = []
+
+    async def make_request(self, bot, method, timeout=None):
+        if type(method).__name__ == "SendMessage":
+            self.sent.append((method.chat_id, method.text))
+        return await super().make_request(bot, method, timeout)
+
+
+def rss(*titles):
+    items = "".join(
+        f"<item><title>{t}</title><link>https://example.com/{t}</link><guid>{t}</guid>"
+        f"<pubDate>{formatdate(time.time())}</pubDate></item>"
+        for t in titles
+    )
+    return f"<rss><channel>{items}</channel></rss>".encode()
+
+
+class FeedServer:
+    """مصدر أخبار محلي: يدعم ETag ويسجل حالة كل رد."""
+
+    def __init__(self):
+        self.feeds = {}
+        self.statuses = []
+        self.app = web.Application()
+        self.app.router.add_get("/{name}", self.handle)
+
+    def publish(self, name, body, etag=None):
+        self.feeds[name] = (body, etag)
+
+    async def handle(self, request):
+        body, etag = self.feeds[request.match_info["name"]]
+        if etag and request.headers.get("If-None-Match") == etag:
+            self.statuses.append((request.match_info["name"], 304))
+            return web.Response(status=304)
+        self.statuses.append((request.match_info["name"], 200))
+        return web.Response(body=body, headers={"ETag": etag} if etag else {})
+
+
+def setup_news(monkeypatch, tmp_path, server, port):
+    feeds = [
+        {"name": "free", "url": f"http://127.0.0.1:{port}/free", "tier": "free"},
+        {"name": "premium", "url": f"http://127.0.0.1:{port}/premium", "tier": "premium"},
+        {"name": "calendar", "url": f"http://127.0.0.1:{port}/calendar", "tier": "free", "kind": "calendar"},
+    ]
+    path = tmp_path / "feeds.json"
+    path.write_text(json.dumps(feeds))
+    monkeypatch.setattr(app, "NEWS_FEEDS_FILE", str(path))
+    monkeypatch.setattr(app, "PUBLIC_CHANNEL_USERNAME", "@public_news")
+    monkeypatch.setattr(app, "PRIVATE_CHANNEL_ID", "-100")
+    monkeypatch.setattr(app, "news_sender", app.ChannelSender(interval=0))
+
+
+def calendar(*events):
+    return json.dumps([
+        {"title": title, "country": "USD", "impact": "High", "date": formatdate(when), "forecast": "1%", "previous": "2%"}
+        for title, when in events
+    ]).encode()
+
+
+def test_news_cycle_against_local_feed_server(db, monkeypatch, tmp_path):
+    feed_server = FeedServer()
+    now = int(time.time())
+    far_event = ("Far CPI", now + 2 * 24 * 3600)
+
+    async def scenario():
+        server = TestServer(feed_server.app)
+        await server.start_server()
+        setup_news(monkeypatch, tmp_path, feed_server, server.port)
+        session = RecordingSession()
+        bot = app.create_bot("123456:TEST", session=session)
+        try:
+            async with aiohttp.ClientSession() as http:
+                # أول جلب يملأ الفهرس فقط ولا ينشر أرشيف المصادر
+                feed_server.publish("free", rss("old-1", "old-2"), etag='"v1"')
+                feed_server.publish("premium", rss("vip-old"))
+                feed_server.publish("calendar", calendar(("Old NFP", now - 3600)), etag='"c1"')
+                assert await app.run_news_cycle(bot, http) == 0
+                assert session.sent == []
+
+                # عنصر جديد في كل مصدر يُوجه حسب الفئة، والمكرر يُتجاهل عبر جدول الهاش
+                feed_server.publish("free", rss("old-1", "old-2", "fresh"), etag='"v2"')
+                feed_server.publish("premium", rss("vip-old", "vip-new"))
+                feed_server.publish("calendar", calendar(("Old NFP", now - 3600), far_event), etag='"c2"')
+                assert await app.run_news_cycle(bot, http) == 2
+                routed = {(chat, "fresh" in text, "vip-new" in text) for chat, text in session.sent}
+                assert routed == {("@public_news", True, False), (-100, False, True)}
+                assert all(text.startswith("💎") for chat, text in session.sent if chat == -100)
+
+                # لا تغيير: RSS يرد 304، والمصدر بدون ETag يُعاد تحليله دون إعادة النشر
+                feed_server.statuses.clear()
+                assert await app.run_news_cycle(bot, http) == 0
+                assert ("free", 304) in feed_server.statuses
+                assert ("premium", 200) in feed_server.statuses
+                assert len(session.sent) == 2
+
+                # الحدث البعيد يُنشر عند اقترابه حتى لو لم يتغير التقويم
+                monkeypatch.setattr(app, "NEWS_CALENDAR_LOOKAHEAD", 3 * 24 * 3600)
+                assert await app.run_news_cycle(bot, http) == 1
+                assert ("calendar", 200) in feed_server.statuses
+                assert "Far CPI" in session.sent[-1][1]
+                assert session.sent[-1][0] == "@public_news"
+        finally:
+            await server.close()
+
+    asyncio.run(scenario())
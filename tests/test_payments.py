@@ -0,0 +1,153 @@
+import asyncio
+import sqlite3
+import time
+from contextlib import closing
+
+import aiohttp
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+import bot as app
+from bot import SubState
+from replay import ReplaySession
+
+WALLET = "TWalletStandIn"
+USDT = app.TOKEN_CONTRACTS[("TRC20", "USDT")]
+
+
+class TronStandIn:
+    """بديل محلي لـ TronGrid: ترتيب تصاعدي، min_timestamp، وصفحات عبر fingerprint."""
+
+    def __init__(self):
+        self.transfers = []
+        self.requests = []
+
+    def make_app(self):
+        web_app = web.Application()
+        web_app.router.add_get("/v1/accounts/{address}/transactions/trc20", self.handle)
+        return web_app
+
+    def add(self, tx_hash, amount_units, ts, contract=USDT):
+        self.transfers.append({
+            "transaction_id": tx_hash,
+            "token_info": {"address": contract, "decimals": app.AMOUNT_DECIMALS},
+            "to": WALLET,
+            "value": str(amount_units),
+            "block_timestamp": ts * 1000,
+        })
+
+    async def handle(self, request):
+        query = request.query
+        self.requests.append(dict(query))
+        start, limit = int(query.get("fingerprint", 0)), int(query["limit"])
+        items = sorted(
+            (t for t in self.transfers if t["block_timestamp"] >= int(query["min_timestamp"])),
+            key=lambda t: t["block_timestamp"],
+        )
+        meta = {"fingerprint": str(start + limit)} if start + limit < len(items) else {}
+        return web.json_response({"data": items[start:start + limit], "meta": meta})
+
+
+@pytest.fixture
+def explorer(db, monkeypatch, tmp_path):
+    links = tmp_path / "links.json"
+    links.write_text("[]")
+    monkeypatch.setattr(app, "LINKS_FILE", str(links))
+    monkeypatch.setattr(app, "TRANSFER_PAGE_SIZE", 2)
+    return TronStandIn()
+
+
+def open_checkout(user_id, created_ts):
+    checkout = app.create_checkout(user_id, "USDT TRC20", WALLET, 1)
+    with closing(sqlite3.connect(app.DB_FILE)) as conn:
+        conn.execute("UPDATE payment_checkouts SET created_ts = ? WHERE id = ?", (created_ts, checkout["id"]))
+        conn.commit()
+    return {**checkout, "created_ts": created_ts}
+
+
+def checkout_status(checkout_id):
+    with closing(sqlite3.connect(app.DB_FILE)) as conn:
+        return conn.execute("SELECT status, tx_hash FROM payment_checkouts WHERE id = ?", (checkout_id,)).fetchone()
+
+
+def poll(explorer, monkeypatch, times=1):
+    async def scenario():
+        server = TestServer(explorer.make_app())
+        await server.start_server()
+        monkeypatch.setattr(app, "TRON_API_URL", f"http://127.0.0.1:{server.port}")
+        bot = app.create_bot("123456:TEST", session=ReplaySession())
+        try:
+            async with aiohttp.ClientSession() as http:
+                return [await app.check_pending_payments(bot, http) for _ in range(times)]
+        finally:
+            await server.close()
+
+    return asyncio.run(scenario())
+
+
+def is_active(user_id):
+    sub = app.get_subscription(user_id)
+    return sub is not None and sub.state is SubState.ACTIVE
+
+
+def test_unique_amount_match_ignores_spoofed_contract(explorer, monkeypatch):
+    now = int(time.time())
+    first = open_checkout(1, now - 600)
+    second = open_checkout(2, now - 600)
+    assert first["amount_units"] != second["amount_units"]
+
+    explorer.add("noise-1", 5_000_000, now - 500)
+    # نفس مبلغ الطلب الأول لكن من عقد مزيف يحمل رمز USDT
+    explorer.add("spoofed", first["amount_units"], now - 400, contract="TFakeUsdtContract")
+    explorer.add("noise-2", 7_000_000, now - 350)
+    explorer.add("paid", second["amount_units"], now - 300)
+
+    assert poll(explorer, monkeypatch) == [1]
+    assert checkout_status(first["id"]) == ("open", None)
+    assert checkout_status(second["id"]) == ("paid", "paid")
+    assert not is_active(1) and is_active(2)
+    # الصفحات تُتابع عبر fingerprint، والمؤشر يُحفظ عند آخر تحويل
+    assert sum("fingerprint" in r for r in explorer.requests) == 1
+    assert app.load_payment_cursor("TRC20", WALLET) == ((now - 300) * 1000, now - 300)
+
+
+def test_tx_hash_cannot_settle_two_checkouts(explorer, monkeypatch):
+    now = int(time.time())
+    first = open_checkout(1, now - 600)
+    explorer.add("tx-1", first["amount_units"], now - 300)
+    assert poll(explorer, monkeypatch) == [1]
+
+    # طلب جديد يأخذ نفس المبلغ بعد إغلاق الأول، وتاريخه يسبق التحويل
+    second = open_checkout(2, now - 600)
+    assert second["amount_units"] == first["amount_units"]
+    assert poll(explorer, monkeypatch) == [0]
+    assert checkout_status(second["id"]) == ("open", None)
+    assert not is_active(2)
+
+
+def test_cursor_holds_at_unsettled_transfer(explorer, monkeypatch):
+    now = int(time.time())
+    first = open_checkout(1, now - 600)
+    second = open_checkout(2, now - 600)
+    explorer.add("tx-1", first["amount_units"], now - 400)
+    explorer.add("tx-2", second["amount_units"], now - 300)
+
+    real_settle = app.settle_checkout_tx
+
+    def flaky_settle(checkout, tx_hash):
+        if checkout["id"] == first["id"]:
+            raise sqlite3.OperationalError("database is locked")
+        return real_settle(checkout, tx_hash)
+
+    monkeypatch.setattr(app, "settle_checkout_tx", flaky_settle)
+    assert poll(explorer, monkeypatch) == [1]
+    assert checkout_status(first["id"]) == ("open", None)
+    assert app.load_payment_cursor("TRC20", WALLET) == ((now - 400) * 1000, now - 400)
+
+    monkeypatch.setattr(app, "settle_checkout_tx", real_settle)
+    explorer.requests.clear()
+    assert poll(explorer, monkeypatch) == [1]
+    assert explorer.requests[0]["min_timestamp"] == str((now - 400) * 1000)
+    assert checkout_status(first["id"]) == ("paid", "tx-1")
+    assert is_active(1) and is_active(2)
@@ -0,0 +1,50 @@
+import asyncio
+import time
+
+import bot as app
+from bot import SubState, Subscription
+from replay import ReplaySession
+
+
+def expired_member(user_id):
+    now = int(time.time())
+    sub = Subscription(user_id, start_ts=now - 40 * app.DAY_SECONDS, end_ts=now - 2 * app.DAY_SECONDS, state=SubState.ACTIVE)
+    app.upsert_subscription(sub)
+    return sub
+
+
+def run_reminders():
+    session = ReplaySession()
+
+    async def scenario():
+        await app.run_reminders(app.create_bot("123456:TEST", session=session))
+
+    asyncio.run(scenario())
+    return session
+
+
+def test_expired_member_is_ended_and_kicked(db, monkeypatch):
+    monkeypatch.setattr(app, "PRIVATE_CHANNEL_ID", "-100")
+    expired_member(5)
+    session = run_reminders()
+    assert app.get_subscription(5).state is SubState.ENDED
+    assert 5 not in app.active_user_ids
+    assert session.calls["BanChatMember"] == 1
+
+
+def test_renewal_during_the_pass_is_not_overwritten(db, monkeypatch):
+    monkeypatch.setattr(app, "PRIVATE_CHANNEL_ID", "-100")
+    stale = app.list_subscriptions("WHERE user_id = ?", (expired_member(5).user_id,))
+    # التجديد يلتزم بعد قراءة القائمة وقبل الوصول إلى هذا المستخدم
+    renewed = app.get_subscription(5)
+    app.apply_subscription_period(renewed, 1)
+    app.upsert_subscription(renewed)
+    monkeypatch.setattr(app, "list_subscriptions", lambda *args: stale)
+
+    session = run_reminders()
+    current = app.get_subscription(5)
+    assert current.state is SubState.ACTIVE
+    assert current.end_ts == renewed.end_ts
+    assert 5 in app.active_user_ids
+    assert session.calls["BanChatMember"] == 0
+    assert session.calls["SendMessage"] == 0
@@ -0,0 +1,83 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import bot as app
+from bot import SubState, Subscription
+from replay import ReplaySession
+
+
+class FakeState:
+    def __init__(self, data):
+        self.data = data
+
+    async def get_data(self):
+        return self.data
+
+    async def set_state(self, state):
+        pass
+
+
+class FakeMessage:
+    def __init__(self, user_id):
+        self.from_user = SimpleNamespace(id=user_id, username="member")
+        self.photo = [SimpleNamespace(file_id="receipt-2")]
+        self.answers = []
+
+    async def answer(self, text, **kwargs):
+        self.answers.append(text)
+
+
+def active_member(user_id, days_left=20):
+    now = int(time.time())
+    sub = Subscription(user_id, username="member", method="USDT TRC20", duration_months=1,
+                       start_ts=now - 10 * app.DAY_SECONDS, end_ts=now + days_left * app.DAY_SECONDS,
+                       state=SubState.ACTIVE)
+    app.upsert_subscription(sub)
+    return sub
+
+
+def send_receipt(user_id):
+    async def scenario():
+        bot = app.create_bot("123456:TEST", session=ReplaySession())
+        await app.receive_receipt(FakeMessage(user_id), FakeState({"payment_method": "USDT TRC20", "duration_months": 3}), bot)
+        return bot
+
+    return asyncio.run(scenario())
+
+
+def test_renewal_receipt_keeps_member_active(db):
+    sub = active_member(5)
+    send_receipt(5)
+
+    current = app.get_subscription(5)
+    assert current.state is SubState.ACTIVE
+    assert current.end_ts == sub.end_ts
+    assert 5 in app.active_user_ids
+    assert app.load_renewal_request(5) == ("USDT TRC20", 3, "receipt-2")
+
+
+def test_approving_renewal_extends_remaining_period(db):
+    sub = active_member(5)
+    send_receipt(5)
+
+    async def approve():
+        session = ReplaySession()
+        bot = app.create_bot("123456:TEST", session=session)
+        assert await app.activate_subscription(bot, 5)
+        return session
+
+    session = asyncio.run(approve())
+    current = app.get_subscription(5)
+    assert current.end_ts == sub.end_ts + 3 * 30 * app.DAY_SECONDS
+    assert current.duration_months == 3
+    assert app.load_renewal_request(5) is None
+    # عضو حالي: إشعار تجديد فقط، بدون رابط دعوة جديد
+    assert session.calls["SendMessage"] == 1
+
+
+def test_receipt_from_expired_user_is_pending(db):
+    active_member(5, days_left=-1)
+    send_receipt(5)
+    assert app.get_subscription(5).state is SubState.PENDING
+    assert app.load_renewal_request(5) is None
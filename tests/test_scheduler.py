@@ -0,0 +1,163 @@
+import asyncio
+import json
+import sqlite3
+import time
+from contextlib import closing
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+
+import bot as app
+from bot import JobScheduler
+
+
+async def noop(bot, job):
+    pass
+
+
+def make_scheduler():
+    scheduler = JobScheduler()
+    scheduler.register("broadcast", noop)
+    return scheduler
+
+
+def overdue(db, job_id, payload):
+    with closing(sqlite3.connect(db)) as conn:
+        conn.execute(
+            "UPDATE scheduled_jobs SET run_at = ?, payload = ? WHERE id = ?",
+            (int(time.time()) - 3600, json.dumps(payload), job_id),
+        )
+        conn.commit()
+
+
+def test_interrupted_cron_job_resumes_immediately(db):
+    job_id = make_scheduler().add_job("broadcast", "all", {}, cron="0 9 * * *")
+    overdue(db, job_id, {"from_chat_id": 1, "message_id": 2, "resume_after": 42})
+
+    scheduler = make_scheduler()
+    scheduler.load_jobs()
+    job = scheduler._jobs[job_id]
+    assert job["run_at"] <= int(time.time())
+    assert json.loads(job["payload"])["resume_after"] == 42
+
+
+def test_missed_cron_job_moves_to_next_occurrence(db):
+    job_id = make_scheduler().add_job("broadcast", "all", {}, cron="0 9 * * *")
+    overdue(db, job_id, {"from_chat_id": 1, "message_id": 2})
+
+    scheduler = make_scheduler()
+    scheduler.load_jobs()
+    now = int(time.time())
+    assert scheduler._jobs[job_id]["run_at"] == app.cron_next("0 9 * * *", now)
+
+
+def ts(*args):
+    return int(datetime(*args).timestamp())
+
+
+@pytest.mark.parametrize("expr, after, expected", [
+    ("30 9 * * *", (2026, 1, 5, 10, 0), (2026, 1, 6, 9, 30)),
+    ("*/15 * * * *", (2026, 1, 5, 10, 1), (2026, 1, 5, 10, 15)),
+    ("0 9 * * 1-5", (2026, 1, 2, 10, 0), (2026, 1, 5, 9, 0)),
+    ("0 0 1 */3 *", (2026, 1, 1, 0, 0), (2026, 4, 1, 0, 0)),
+    ("0 12 29 2 *", (2026, 1, 1, 0, 0), (2028, 2, 29, 12, 0)),
+    # يوم الشهر ويوم الأسبوع مقيدان معاً: يوم 1 أو أي اثنين، فالاثنين 5 يناير يسبق 1 فبراير
+    ("0 0 1 * 1", (2026, 1, 1, 0, 0), (2026, 1, 5, 0, 0)),
+    ("0 0 13 * 5", (2026, 1, 1, 0, 0), (2026, 1, 2, 0, 0)),
+    ("0 8 * * 7", (2026, 1, 1, 0, 0), (2026, 1, 4, 8, 0)),
+])
+def test_cron_next(expr, after, expected):
+    assert app.cron_next(expr, ts(*after)) == ts(*expected)
+
+
+@pytest.mark.parametrize("expr", ["0 9 * *", "60 * * * *", "0 0 0 * *", "0 0 * * 8", "5-1 * * * *"])
+def test_cron_rejects_invalid_expressions(expr):
+    with pytest.raises(ValueError):
+        app.cron_next(expr, ts(2026, 1, 1, 0, 0))
+
+
+def test_cron_that_never_fires_raises():
+    with pytest.raises(ValueError):
+        app.cron_next("0 0 31 2 *", ts(2026, 1, 1, 0, 0))
+
+
+def test_ensure_job_follows_changed_cron(db):
+    scheduler = make_scheduler()
+    job_id = scheduler.ensure_job("broadcast", "30 */6 * * *")
+    assert scheduler.ensure_job("broadcast", "30 */6 * * *") == job_id
+
+    restarted = make_scheduler()
+    restarted.load_jobs()
+    assert restarted.ensure_job("broadcast", "0 3 * * *") == job_id
+    expected = app.cron_next("0 3 * * *", int(time.time()))
+    assert restarted._jobs[job_id]["run_at"] == expected
+
+    reloaded = make_scheduler()
+    reloaded.load_jobs()
+    assert [(j["id"], j["cron"], j["run_at"]) for j in reloaded.list_jobs()] == [(job_id, "0 3 * * *", expected)]
+
+
+class FakeState:
+    def __init__(self):
+        self.data = {}
+        self.state = None
+
+    async def update_data(self, **kwargs):
+        self.data.update(kwargs)
+
+    async def set_state(self, state):
+        self.state = state
+
+
+class FakeMessage:
+    def __init__(self, text=None):
+        self.text = text
+        self.from_user = SimpleNamespace(id=app.ADMIN_ID)
+        self.answers = []
+
+    async def answer(self, text, **kwargs):
+        self.answers.append(text)
+
+    async def edit_text(self, text, reply_markup=None, **kwargs):
+        self.answers.append(text)
+        self.reply_markup = reply_markup
+
+
+class FakeCallback:
+    def __init__(self, data):
+        self.data = data
+        self.from_user = SimpleNamespace(id=app.ADMIN_ID)
+        self.message = FakeMessage()
+        self.alerts = []
+
+    async def answer(self, text=None, show_alert=False):
+        self.alerts.append(text)
+
+
+def test_one_shot_time_in_the_past_is_rejected():
+    past = datetime.fromtimestamp(time.time() - 3600).strftime("%Y-%m-%d %H:%M")
+    state = FakeState()
+    asyncio.run(app.admin_scheduled_job_time(FakeMessage(past), state))
+    assert state.data == {} and state.state is None
+
+    future = datetime.fromtimestamp(time.time() + 7200).strftime("%Y-%m-%d %H:%M")
+    asyncio.run(app.admin_scheduled_job_time(FakeMessage(future), state))
+    assert state.data["sched_run_at"] > time.time()
+
+
+def test_system_jobs_cannot_be_cancelled_from_panel(db, monkeypatch):
+    scheduler = make_scheduler()
+    scheduler.register("backup", noop)
+    monkeypatch.setattr(app, "scheduler", scheduler)
+    system_id = scheduler.ensure_job("backup", "0 3 * * *")
+    post_id = scheduler.add_job("broadcast", "all", {}, cron="0 9 * * *")
+
+    listing = FakeCallback("sched_list")
+    asyncio.run(app.admin_scheduled_jobs(listing))
+    buttons = [row[0].callback_data for row in listing.message.reply_markup.inline_keyboard]
+    assert f"sched_cancel_{post_id}" in buttons
+    assert f"sched_cancel_{system_id}" not in buttons
+
+    asyncio.run(app.admin_cancel_scheduled_job(FakeCallback(f"sched_cancel_{system_id}")))
+    assert scheduler.get_job(system_id) is not None
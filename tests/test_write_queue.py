@@ -0,0 +1,104 @@
+import asyncio
+
+import pytest
+
+import bot as app
+from bot import Subscription, WriteBehindQueue
+
+
+def failing_once(error):
+    real = WriteBehindQueue._write_batch
+    calls = []
+
+    def write_batch(rows):
+        calls.append(rows)
+        if len(calls) == 1:
+            raise error
+        return real(rows)
+
+    return write_batch, calls
+
+
+def test_batch_coalesces_and_writes(db):
+    async def scenario():
+        queue = WriteBehindQueue(flush_interval=0)
+        queue.start()
+        queue.submit(Subscription(1, username="old"))
+        future = queue.submit(Subscription(1, username="new"), durable=True)
+        queue.submit(Subscription(2))
+        await future
+        await queue.stop()
+
+    asyncio.run(scenario())
+    assert app.get_subscription(1).username == "new"
+    assert app.get_subscription(2) is not None
+
+
+def test_failed_batch_fails_waiters_and_requeues_rows(db, monkeypatch):
+    async def scenario():
+        queue = WriteBehindQueue()
+        queue.start()
+        queue._task.cancel()
+        write_batch, calls = failing_once(OSError("unable to open database file"))
+        monkeypatch.setattr(queue, "_write_batch", write_batch)
+
+        future = queue.submit(Subscription(1, username="a"), durable=True)
+        with pytest.raises(OSError):
+            await queue.flush()
+        with pytest.raises(OSError):
+            # المنتظر يجب أن يُحسم، لا أن يعلق إلى الأبد
+            await asyncio.wait_for(future, 1)
+        # الصف لم يضع: ما زال مرئياً للقراءات ويُكتب في المحاولة التالية
+        assert queue.peek(1).username == "a"
+        await queue.flush()
+        assert len(calls) == 2
+        assert queue.pending_user_ids() == set()
+
+    asyncio.run(scenario())
+    assert app.get_subscription(1).username == "a"
+
+
+def test_newer_write_wins_over_requeued_row(db, monkeypatch):
+    async def scenario():
+        queue = WriteBehindQueue()
+        queue.start()
+        queue._task.cancel()
+        real = WriteBehindQueue._write_batch
+
+        def write_batch(rows):
+            if not hasattr(write_batch, "failed"):
+                write_batch.failed = True
+                # كتابة أحدث تصل أثناء المحاولة الفاشلة
+                queue._pending[1] = Subscription(1, username="newer").to_params()
+                raise RuntimeError("boom")
+            return real(rows)
+
+        monkeypatch.setattr(queue, "_write_batch", write_batch)
+        queue.submit(Subscription(1, username="older"))
+        with pytest.raises(RuntimeError):
+            await queue.flush()
+        await queue.flush()
+
+    asyncio.run(scenario())
+    assert app.get_subscription(1).username == "newer"
+
+
+def test_run_loop_survives_failure_and_retries(db, monkeypatch):
+    monkeypatch.setattr(app, "WRITE_RETRY_MIN_DELAY", 0.01)
+
+    async def scenario():
+        queue = WriteBehindQueue(flush_interval=0)
+        write_batch, calls = failing_once(OSError("disk I/O error"))
+        monkeypatch.setattr(queue, "_write_batch", write_batch)
+        queue.start()
+        queue.submit(Subscription(1, username="a"))
+        for _ in range(100):
+            await asyncio.sleep(0.01)
+            if len(calls) == 2 and not queue.pending_user_ids():
+                break
+        assert queue.running
+        assert len(calls) == 2
+        await queue.stop()
+
+    asyncio.run(scenario())
+    assert app.get_subscription(1).username == "a"